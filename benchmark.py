@@ -0,0 +1,742 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for VotingBot hot paths.
+
+Usage:
+    python benchmark.py parse [--messages N]
+    python benchmark.py fuzz [--lengths 1000,4000,16000,64000]
+    python benchmark.py outbound [--messages N] [--topics N]
+    python benchmark.py storage [--votes N] [--backends memory,sqlite,...]
+    python benchmark.py restart [--votes N] [--backend sqlite]
+    python benchmark.py startup [--streams N] [--backend sqlite]
+    python benchmark.py codec [--voters 10,1000,100000]
+    python benchmark.py ballots [--voters 10,100,...] [--backends ...]
+    python benchmark.py load [--workloads hot_poll,...] [--messages N]
+                             [--backend memory] [--output results.json]
+    python benchmark.py writebehind [--messages N] [--backend sqlite]
+    python benchmark.py tally [--voters 1000,10000,100000] [--options N]
+    python benchmark.py scoreboard [--votes N] [--polls N] [--seconds S]
+
+Every benchmark prints one JSON object per line so results can be compared
+between runs.
+"""
+
+from __future__ import unicode_literals
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import parsley
+import requests
+import codec
+import database
+import loadgen
+import tally
+from fakes import FakeEventServer, FakeZulipClient, private_message, \
+    stream_message
+from metrics import Metrics
+from outbound import OutboundDispatcher
+import voting_bot
+from voting_bot import VotingBot, ONE_LINER_GRAMMAR
+from writebehind import VoteLog, WriteBehindStorage
+
+
+PUBLIC_MESSAGES = [
+    "VotingBot karaoke: 2",
+    "VotingBot karaoke 1",
+    "VotingBot karaoke\n0",
+    "VotingBot karaoke: results",
+    "VotingBot karaoke add Another option",
+    "VotingBot lunch: pizza, tacos, sushi",
+    "VotingBot movie night\nHackers\nThe Matrix\nStar Wars",
+    "VotingBot help",
+]
+
+
+def report(name, **fields):
+    fields["benchmark"] = name
+    print json.dumps(fields, sort_keys=True)
+
+
+def timed(func, messages):
+    start = time.time()
+    for content in messages:
+        func(content)
+    elapsed = time.time() - start
+
+    return elapsed
+
+
+def bench_parse(args):
+    messages = [PUBLIC_MESSAGES[i % len(PUBLIC_MESSAGES)]
+                for i in xrange(args.messages)]
+
+    def parse_rebuilding_grammar(content):
+        # what _parse_public_message used to cost: a new grammar per message
+        voting_bot._one_liner_grammar = parsley.makeGrammar(ONE_LINER_GRAMMAR,
+                                                            {})
+        user_content = content[len(content.split()[0]):]
+        return VotingBot._parse_user_content(user_content)
+
+    def parse_grammar(content):
+        user_content = content[len(content.split()[0]):]
+        return VotingBot._parse_user_content(user_content)
+
+    def parse_fast_path(content):
+        user_content = content[len(content.split()[0]):]
+        return VotingBot._parse_uncached(user_content)
+
+    VotingBot.parse_cache.clear()
+    for name, func in [("rebuild_grammar", parse_rebuilding_grammar),
+                       ("compiled_grammar", parse_grammar),
+                       ("fast_path", parse_fast_path),
+                       ("cached", VotingBot._parse_public_message)]:
+        elapsed = timed(func, messages)
+        report("parse", variant=name, messages=len(messages),
+               us_per_message=elapsed / len(messages) * 1e6,
+               messages_per_second=len(messages) / elapsed)
+
+    report("parse_cache", **VotingBot.parse_cache.stats())
+
+
+def bench_fuzz(args):
+    """Parse time of adversarial messages, by length. The grammar is only
+        run up to --grammar-length, it gets slow.
+    """
+    for length in [int(n) for n in args.lengths.split(",")]:
+        messages = loadgen.adversarial_messages(length)
+
+        variants = [("linear", VotingBot._parse_uncached)]
+        if length <= args.grammar_length:
+            variants.append(("grammar", VotingBot._parse_user_content))
+
+        for name, parse in variants:
+            times = []
+            for _, content in messages:
+                start = time.time()
+                parse(content)
+                times.append(time.time() - start)
+
+            times.sort()
+            report("fuzz", parser=name, length=length, messages=len(times),
+                   p50_us=loadgen.percentile(times, 0.5) * 1e6,
+                   max_us=times[-1] * 1e6,
+                   us_per_kchar=times[-1] / length * 1e9)
+
+
+class StubZulipHandler(BaseHTTPRequestHandler):
+
+    """Answers every POST like Zulip's send_message endpoint, and GETs of
+        /api/v1/streams with the server's streams.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # write each response in one segment, like a real server would
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests += 1
+        if self.path.endswith("/subscriptions"):
+            self.server.subscribed += urlparse.parse_qs(body)[
+                "subscriptions"][0].count('"name"')
+
+        self._reply(b'{"result": "success", "msg": "", "id": 1}')
+
+    def do_GET(self):
+        self.server.requests += 1
+
+        if self.path.startswith("/api/v1/streams"):
+            self._reply(json.dumps({"result": "success", "msg": "",
+                                    "streams": [{"name": name} for name
+                                                in self.server.streams]}))
+        else:
+            self._reply(b'{"result": "success", "msg": ""}')
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubZulipServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StubZulipHandler)
+        self.requests = 0
+        self.subscribed = 0
+        self.streams = []
+        self.site = "http://127.0.0.1:%d" % self.server_port
+        self.url = self.site + "/api/v1/messages"
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class HttpSender(object):
+
+    """Minimal zulip client posting messages to url."""
+
+    def __init__(self, url, session=None):
+        self.url = url
+        self.post = session.post if session else requests.post
+
+    def send_message(self, msg):
+        return self.post(self.url, data=msg).json()
+
+
+def outbound_messages(count, topics):
+    for i in xrange(count):
+        topic = "topic %d" % (i % topics)
+        if i % 2:
+            yield {"type": "private", "to": "voter%d@hi.com" % i,
+                   "content": "One vote in this topic: " + topic}, None
+        else:
+            yield ({"type": "stream", "to": "voting", "subject": topic,
+                    "content": "There is a new option in topic: " + topic},
+                   ("options", topic))
+
+
+def bench_outbound(args):
+    server = StubZulipServer()
+    messages = list(outbound_messages(args.messages, args.topics))
+
+    def direct(sender):
+        for msg, _ in messages:
+            sender.send_message(msg)
+
+    def dispatched(sender):
+        dispatcher = OutboundDispatcher(sender, rate=None,
+                                        coalesce_window=args.window,
+                                        registry=Metrics()).start()
+        for msg, coalesce_key in messages:
+            dispatcher.send(msg, coalesce_key)
+        dispatcher.close()
+
+    for name, run, session in [("per_request", direct, None),
+                               ("session", direct, requests.Session()),
+                               ("dispatcher", dispatched, requests.Session())]:
+        server.requests = 0
+        start = time.time()
+        run(HttpSender(server.url, session))
+        elapsed = time.time() - start
+
+        report("outbound", variant=name, messages=len(messages),
+               http_requests=server.requests, seconds=elapsed,
+               messages_per_second=len(messages) / elapsed)
+
+    server.shutdown()
+    server.server_close()
+
+
+STORAGES = {
+    "memory": lambda tmp_dir: database.MemoryVotingTopics(),
+    "sqlite": lambda tmp_dir: database.VotingTopics(
+        database.sqlite_url(os.path.join(tmp_dir, "blob.db"))),
+    "sqlite-relational": lambda tmp_dir: database.RelationalVotingTopics(
+        database.sqlite_url(os.path.join(tmp_dir, "relational.db"))),
+    "postgres": lambda tmp_dir: database.VotingTopics(),
+    "postgres-relational": lambda tmp_dir: database.RelationalVotingTopics(),
+}
+
+
+def bench_storage(args):
+    tmp_dir = tempfile.mkdtemp()
+    voters = ["voter%d@hi.com" % i for i in xrange(args.voters)]
+
+    try:
+        for name in args.backends.split(","):
+            storage = STORAGES[name](tmp_dir)
+            storage.clear()
+            storage["lunch"] = {"title": "Lunch",
+                                "options": {0: ["Pizza", 0], 1: ["Tacos", 0]},
+                                "people_who_have_voted": {},
+                                "owner_email": "owner@hi.com"}
+
+            start = time.time()
+            for i in xrange(args.votes):
+                storage.cast_vote("lunch", voters[i % len(voters)], i % 2)
+            vote_seconds = time.time() - start
+
+            start = time.time()
+            for i in xrange(args.votes):
+                "lunch" in storage and storage["lunch"]
+            read_seconds = time.time() - start
+
+            report("storage", backend=name, votes=args.votes,
+                   votes_per_second=args.votes / vote_seconds,
+                   reads_per_second=args.votes / read_seconds)
+            storage.clear()
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_ballots(args):
+    """Per vote latency, reading the header and casting the ballot like
+        add_vote does, against the number of voters already in the poll.
+    """
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        for name in args.backends.split(","):
+            storage = STORAGES[name](tmp_dir)
+
+            for voters in [int(n) for n in args.voters.split(",")]:
+                storage.clear()
+                vote = {"title": "Lunch", "owner_email": "owner@hi.com",
+                        "options": {0: ["Pizza", 0], 1: ["Tacos", 0]},
+                        "people_who_have_voted": {}}
+                for i in xrange(voters):
+                    vote["people_who_have_voted"]["voter%d@hi.com" % i] = i % 2
+                    vote["options"][i % 2][1] += 1
+                storage["lunch"] = vote
+
+                latencies = []
+                for i in xrange(args.votes):
+                    # half change an existing ballot, half are new voters
+                    voter = "voter%d@hi.com" % (i * 7919 % voters if i % 2
+                                                else voters + i)
+                    start = time.time()
+                    storage.header("lunch")
+                    storage.cast_vote("lunch", voter, i % 2)
+                    latencies.append(time.time() - start)
+
+                latencies.sort()
+                report("ballots", backend=name, voters=voters,
+                       votes=args.votes,
+                       mean_us=sum(latencies) / len(latencies) * 1e6,
+                       p50_us=latencies[len(latencies) // 2] * 1e6,
+                       p99_us=latencies[len(latencies) * 99 // 100] * 1e6)
+
+            storage.clear()
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_load(args):
+    """End to end: loadgen workloads through VotingBot.respond."""
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+
+    try:
+        for name in args.workloads.split(","):
+            storage = STORAGES[args.backend](tmp_dir)
+            storage.clear()
+
+            result = loadgen.run_workload(name, args.messages, storage)
+            result["backend"] = args.backend
+            results.append(result)
+            report("load", **result)
+
+            storage.clear()
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def bench_writebehind(args):
+    """Vote floods on a hot poll, straight to the storage and through the
+        write-behind buffer, with and without a vote log.
+    """
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        for mode in ["direct", "buffered", "buffered+log"]:
+            storage = STORAGES[args.backend](tmp_dir)
+            storage.clear()
+            buffered = None
+            if mode != "direct":
+                vote_log = None
+                if mode.endswith("log"):
+                    vote_log = VoteLog(os.path.join(tmp_dir, "votes.log"))
+                buffered = WriteBehindStorage(storage, vote_log=vote_log,
+                                              registry=Metrics()).start()
+
+            result = loadgen.run_workload("hot_poll", args.messages,
+                                          buffered or storage)
+
+            start = time.time()
+            if buffered:
+                buffered.close()
+            drain = time.time() - start
+
+            votes = sum(count for _, count in
+                        storage["hot"]["options"].values())
+            report("writebehind", mode=mode, backend=args.backend,
+                   messages=result["messages"],
+                   votes_per_second=result["messages_per_second"],
+                   p99_ms=result["p99_ms"], drain_ms=drain * 1000,
+                   stored_votes=votes)
+            storage.clear()
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_restart(args):
+    """Restart a bot while votes keep coming in: time from starting the new
+        bot to its first reply, and votes lost in the gap, with and without
+        resuming the checkpointed event queue.
+    """
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        for resume in [False, True]:
+            server = FakeEventServer()
+            storage = STORAGES[args.backend](tmp_dir)
+            storage.clear()
+            storage["lunch"] = {"title": "Lunch",
+                                "options": {0: ["Pizza", 0], 1: ["Tacos", 0]},
+                                "people_who_have_voted": {},
+                                "owner_email": "owner@hi.com"}
+
+            def run_bot():
+                if args.backend != "memory":
+                    # a new process opens its own storage
+                    bot_storage = STORAGES[args.backend](tmp_dir)
+                else:
+                    bot_storage = storage
+                bot = VotingBot("voting-bot@hi.com", "key", "VotingBot",
+                                ["voting"], voting_topics=bot_storage,
+                                client=FakeZulipClient(server=server))
+                thread = threading.Thread(target=bot.main, kwargs={
+                    "narrow": True, "resume": resume})
+                thread.start()
+                return bot, thread
+
+            bot, thread = run_bot()
+            queues = len(bot.message_narrows())
+            while len(server.queues) < queues:
+                time.sleep(0.001)
+            bot.stop()
+            thread.join()
+
+            for i in xrange(args.votes):
+                server.post(private_message("lunch\n%d" % (i % 2),
+                                            "voter%d@hi.com" % i))
+
+            start = time.time()
+            bot, thread = run_bot()
+            while not bot.client.sent:
+                # a fresh queue never sees the backlog, probe it
+                if not resume and len(server.queues) == 2 * queues:
+                    server.post(private_message("lunch\n0", "probe@hi.com"))
+                time.sleep(0.001)
+            cold_start = time.time() - start
+
+            idle_since = time.time()
+            sent = len(bot.client.sent)
+            while time.time() - idle_since < 0.2:
+                time.sleep(0.01)
+                if len(bot.client.sent) != sent:
+                    sent, idle_since = len(bot.client.sent), time.time()
+            bot.stop()
+            thread.join()
+
+            voters = bot.voting_topics["lunch"]["people_who_have_voted"]
+            voters.pop("probe@hi.com", None)
+            report("restart", backend=args.backend, resume=resume,
+                   votes=args.votes, cold_start_ms=cold_start * 1000,
+                   dropped=args.votes - len(voters))
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# run in a new process for every boot, so the imports are cold
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.time()
+import voting_bot
+imported = time.time()
+import database
+storage = getattr(database, sys.argv[1])(sys.argv[2] or None)
+opened = time.time()
+client = voting_bot.zulip_client("voting-bot@hi.com", "key", site=sys.argv[3])
+connected = time.time()
+bot = voting_bot.VotingBot("voting-bot@hi.com", "key", "VotingBot", [],
+                           client=client, voting_topics=storage)
+print json.dumps({"import_ms": (imported - start) * 1000,
+                  "storage_ms": (opened - imported) * 1000,
+                  "client_ms": (connected - opened) * 1000,
+                  "subscribe_ms": (time.time() - connected) * 1000,
+                  "total_ms": (time.time() - start) * 1000})
+"""
+
+EAGER_IMPORTS = """
+import time
+import urlparse
+start = time.time()
+import zulip, requests, parsley, dataset, voting_bot
+print (time.time() - start) * 1000
+"""
+
+STARTUP_STORAGES = {
+    "sqlite": ("VotingTopics", "blob.db"),
+    "sqlite-relational": ("RelationalVotingTopics", "relational.db"),
+    "postgres": ("VotingTopics", None),
+    "postgres-relational": ("RelationalVotingTopics", None),
+}
+
+
+def bench_startup(args):
+    """Time a bot process from its first import to being subscribed to a
+        realm of streams on a stub Zulip server: on its first boot, when it
+        lists and subscribes to every stream as every boot used to, and on a
+        restart with its subscriptions saved in the storage.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.mkdtemp()
+    server = StubZulipServer()
+    server.streams = ["stream %d" % i for i in xrange(args.streams)]
+    storage_class, db_file = STARTUP_STORAGES[args.backend]
+    url = database.sqlite_url(os.path.join(tmp_dir, db_file)) \
+        if db_file else ""
+
+    def child(script, *argv):
+        return subprocess.check_output([sys.executable, "-c", script] +
+                                       list(argv), cwd=here)
+
+    try:
+        eager = float(child(EAGER_IMPORTS))
+        for boot in ["first", "restart"]:
+            if boot == "first" and not db_file:
+                getattr(database, storage_class)().set_subscriptions(set())
+
+            server.requests = server.subscribed = 0
+            timings = json.loads(child(STARTUP_SCRIPT, storage_class, url,
+                                       server.site))
+            report("startup", backend=args.backend, boot=boot,
+                   streams=args.streams, http_requests=server.requests,
+                   subscribed=server.subscribed, eager_import_ms=eager,
+                   **timings)
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir)
+
+
+def bench_codec(args):
+    for voters in [int(n) for n in args.voters.split(",")]:
+        vote = {"title": "Lunch", "owner_email": "owner@hi.com",
+                "options": {i: ["Option %d" % i, 0] for i in range(5)},
+                "people_who_have_voted": {}}
+        for i in xrange(voters):
+            vote["people_who_have_voted"]["voter%d@hi.com" % i] = i % 5
+            vote["options"][i % 5][1] += 1
+
+        rounds = max(1, 100000 // max(voters, 1))
+        for name, encode, decode in [
+                ("json", json.dumps, database.VotingTopics._load_json_voting),
+                ("binary", codec.encode_voting, codec.decode_voting)]:
+            encoded = encode(vote)
+            assert decode(encoded) == vote
+
+            encode_seconds = timed(lambda _: encode(vote), xrange(rounds))
+            decode_seconds = timed(lambda _: decode(encoded), xrange(rounds))
+
+            report("codec", encoding=name, voters=voters, bytes=len(encoded),
+                   encode_us=encode_seconds / rounds * 1e6,
+                   decode_us=decode_seconds / rounds * 1e6)
+
+
+def bench_tally(args):
+    """Results of approval and instant runoff polls with many ballots."""
+    rng = random.Random(0)
+    options = range(args.options)
+
+    for voters in [int(n) for n in args.voters.split(",")]:
+        for mode in [tally.APPROVAL, tally.RANKED]:
+            vote = {"title": "Lunch", "mode": mode,
+                    "options": {i: ["Option %d" % i, 0] for i in options},
+                    "people_who_have_voted": {}}
+            for i in xrange(voters):
+                ballot = rng.sample(options, rng.randint(1, len(options)))
+                if mode == tally.APPROVAL:
+                    ballot.sort()
+                vote["people_who_have_voted"]["voter%d@hi.com" % i] = ballot
+
+            start = time.time()
+            poll = tally.tally_from_voting(vote)
+            build = time.time() - start
+
+            start = time.time()
+            poll.render_results()
+            results = time.time() - start
+
+            # a changed vote and the results again, as a bot serves them
+            changes = 20
+            start = time.time()
+            for i in xrange(changes):
+                ballot = rng.sample(options, 2)
+                poll.vote(ballot, vote["people_who_have_voted"][
+                    "voter%d@hi.com" % i])
+                vote["people_who_have_voted"]["voter%d@hi.com" % i] = ballot
+                poll.render_results()
+            revote = (time.time() - start) / changes
+
+            fields = {}
+            if mode == tally.RANKED:
+                fields = {"rounds": len(poll.rounds()),
+                          "rankings": len(poll.weights)}
+            report("tally", mode=mode, voters=voters, options=args.options,
+                   build_ms=build * 1000, results_ms=results * 1000,
+                   vote_and_results_ms=revote * 1000, **fields)
+
+
+def bench_scoreboard(args):
+    """Votes on a few polls spread over some seconds: Zulip requests with
+        a confirmation per vote, and with live scoreboards edited at most
+        every interval seconds.
+    """
+    votes = [stream_message("VotingBot poll %d: %d" % (i % args.polls, i % 3),
+                            "voter%d@hi.com" % i) for i in xrange(args.votes)]
+
+    for live in [False, True]:
+        client = FakeZulipClient()
+        bot = VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                        client=client, registry=Metrics(),
+                        voting_topics=database.MemoryVotingTopics(),
+                        live_scoreboard=live)
+        for poll in xrange(args.polls):
+            bot.respond(stream_message("VotingBot poll %d: a, b, c" % poll,
+                                       "owner@hi.com"))
+        if live:
+            bot.scoreboard.interval = args.interval
+            bot.scoreboard.start()
+
+        sent = len(client.sent)
+        start = time.time()
+        for i, msg in enumerate(votes):
+            bot.respond(dict(msg))
+            # votes arrive evenly over the run
+            delay = start + (i + 1) * args.seconds / len(votes) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if live:
+            bot.scoreboard.stop()
+            bot.scoreboard.thread.join()
+            bot.scoreboard.flush()
+        elapsed = time.time() - start
+
+        requests = len(client.sent) - sent + len(client.updated)
+        report("scoreboard", live=live, votes=len(votes), polls=args.polls,
+               seconds=elapsed, zulip_requests=requests,
+               edits=len(client.updated),
+               requests_per_vote=float(requests) / len(votes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    subparsers = parser.add_subparsers()
+
+    parse = subparsers.add_parser("parse", help="public message parsing")
+    parse.add_argument("--messages", type=int, default=2000)
+    parse.set_defaults(func=bench_parse)
+
+    fuzz = subparsers.add_parser("fuzz", help="adversarial message parsing")
+    fuzz.add_argument("--lengths", default="1000,4000,16000,64000")
+    fuzz.add_argument("--grammar-length", type=int, default=16000)
+    fuzz.set_defaults(func=bench_fuzz)
+
+    outbound = subparsers.add_parser("outbound", help="outbound sends")
+    outbound.add_argument("--messages", type=int, default=1000)
+    outbound.add_argument("--topics", type=int, default=5)
+    outbound.add_argument("--window", type=float, default=0.05)
+    outbound.set_defaults(func=bench_outbound)
+
+    storage = subparsers.add_parser("storage", help="storage backends")
+    storage.add_argument("--votes", type=int, default=2000)
+    storage.add_argument("--voters", type=int, default=200)
+    storage.add_argument("--backends", default="memory,sqlite,sqlite-relational",
+                         help="any of " + ", ".join(sorted(STORAGES)))
+    storage.set_defaults(func=bench_storage)
+
+    restart = subparsers.add_parser("restart", help="bot restarts")
+    restart.add_argument("--votes", type=int, default=200)
+    restart.add_argument("--backend", default="sqlite",
+                         choices=sorted(STORAGES))
+    restart.set_defaults(func=bench_restart)
+
+    startup = subparsers.add_parser("startup", help="bot cold starts")
+    startup.add_argument("--streams", type=int, default=500)
+    startup.add_argument("--backend", default="sqlite",
+                         choices=sorted(STARTUP_STORAGES))
+    startup.set_defaults(func=bench_startup)
+
+    codec_parser = subparsers.add_parser("codec", help="voting encodings")
+    codec_parser.add_argument("--voters", default="10,1000,100000")
+    codec_parser.set_defaults(func=bench_codec)
+
+    ballots = subparsers.add_parser("ballots", help="votes on large polls")
+    ballots.add_argument("--voters", default="10,100,1000,10000,100000")
+    ballots.add_argument("--votes", type=int, default=200)
+    ballots.add_argument("--backends", default="memory,sqlite,sqlite-relational",
+                         help="comma separated, from %s" % ",".join(STORAGES))
+    ballots.set_defaults(func=bench_ballots)
+
+    load = subparsers.add_parser("load", help="end to end workloads")
+    load.add_argument("--workloads", default=",".join(sorted(
+        loadgen.WORKLOADS)))
+    load.add_argument("--messages", type=int, default=1000)
+    load.add_argument("--backend", default="memory",
+                      help="one of %s" % ",".join(STORAGES))
+    load.add_argument("--output", help="also write the results to this "
+                      "JSON file, to compare between runs")
+    load.set_defaults(func=bench_load)
+
+    writebehind = subparsers.add_parser("writebehind",
+                                        help="buffered vote floods")
+    writebehind.add_argument("--messages", type=int, default=2000)
+    writebehind.add_argument("--backend", default="sqlite",
+                             help="one of %s" % ",".join(STORAGES))
+    writebehind.set_defaults(func=bench_writebehind)
+
+    tally_parser = subparsers.add_parser("tally", help="approval and "
+                                         "instant runoff results")
+    tally_parser.add_argument("--voters", default="1000,10000,100000")
+    tally_parser.add_argument("--options", type=int, default=8)
+    tally_parser.set_defaults(func=bench_tally)
+
+    scoreboard = subparsers.add_parser("scoreboard",
+                                       help="live results messages")
+    scoreboard.add_argument("--votes", type=int, default=5000)
+    scoreboard.add_argument("--polls", type=int, default=3)
+    scoreboard.add_argument("--seconds", type=float, default=5.0)
+    scoreboard.add_argument("--interval", type=float, default=1.0)
+    scoreboard.set_defaults(func=bench_scoreboard)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Small in-process caches shared by the bot and the database layer.
+
+LRUCache is a bounded mapping that evicts the least recently used entry once
+it grows past maxsize. Entries can optionally expire ttl seconds after being
+set, which bounds how stale a cache can get when several bot instances write to
+the same database. It keeps hit/miss counters so callers can check that the
+cache is actually pulling its weight.
+"""
+
+
+class LRUCache(object):
+
+    """Bounded, thread safe least-recently-used cache."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        entry = self._data.get(key)
+        return entry is not None and not self._expired(entry)
+
+    def _expired(self, entry):
+        return entry[1] is not None and entry[1] < time.time()
+
+    def get(self, key, default=None):
+        '''Return the cached value for key (refreshing its recency) or default.
+        '''
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or self._expired(entry):
+                self.misses += 1
+                return default
+
+            self._data[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        expires_at = time.time() + self.ttl if self.ttl else None
+
+        self._data.pop(key, None)
+        self._data[key] = (value, expires_at)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def add(self, key, value=True):
+        '''Set key unless it's already cached, atomically. Returns whether
+            it was added.
+        '''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and not self._expired(entry):
+                return False
+
+            self._set(key, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._data), "maxsize": self.maxsize,
+                "ttl": self.ttl}
@@ -0,0 +1,175 @@
+from __future__ import unicode_literals
+import json
+import struct
+import sys
+from array import array
+from itertools import izip
+
+"""
+Compact binary encoding of a voting dictionary.
+
+A record is a fixed header followed by three sections:
+
+    header   format version, flags, number of options, number of voters and
+             the byte lengths of the strings and ballots sections
+    strings  title, owner email, any other voting keys as JSON (a missing
+             or None owner email included), option descriptions and voter
+             emails, UTF-8 and NUL separated
+    counts   one int32 vote count per option
+    ballots  each voter's option number, uint16 (uint32 with WIDE_BALLOTS),
+             in the same order as the voter emails. With LIST_BALLOTS, the
+             ballots of approval and ranked polls, each voter's number of
+             options as a uint16 and then all of their options end to end
+
+Decoding is one struct unpack, one decode and split of the strings and two
+array loads; there are no per option or per voter fix-ups like the JSON rows
+need for their string keys. Everything is little endian. The first byte is
+the format version, which can't be "{", so JSON rows are told apart from it.
+
+A ballot is an option number, or a list of them on approval and ranked polls.
+The stored option counts are the votes for each ballot's first_choice.
+encode_choices packs a list ballot on its own, for the ballot tables.
+"""
+
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct(b"<BBIIII")
+
+HAS_OWNER = 1
+WIDE_BALLOTS = 2
+LIST_BALLOTS = 4
+
+COUNTS = b"i"
+BALLOTS = b"H"
+WIDE = b"I"
+COUNT_SIZE = array(COUNTS).itemsize
+
+KNOWN_KEYS = frozenset(["title", "options", "people_who_have_voted"])
+
+_BIG_ENDIAN = sys.byteorder == "big"
+
+
+def ballot_choices(ballot):
+    '''The options of a ballot, in the order the voter gave them.'''
+    return ballot if isinstance(ballot, list) else [ballot]
+
+
+def first_choice(ballot):
+    '''The option a ballot is counted for in the option counts.'''
+    return ballot[0] if isinstance(ballot, list) else ballot
+
+
+def encode_choices(choices):
+    return _pack(BALLOTS, choices)
+
+
+def decode_choices(data):
+    return _unpack(BALLOTS, bytes(data)).tolist()
+
+
+def _pack(typecode, values):
+    packed = array(typecode, values)
+    if _BIG_ENDIAN:
+        packed.byteswap()
+
+    return packed.tostring()
+
+
+def _unpack(typecode, data):
+    unpacked = array(typecode)
+    unpacked.fromstring(data)
+    if _BIG_ENDIAN:
+        unpacked.byteswap()
+
+    return unpacked
+
+
+def encode_voting(voting_dict):
+    '''Binary record for voting_dict, whose options are numbered from 0.'''
+    options = voting_dict["options"]
+    numbers = range(len(options))
+    voters = voting_dict.get("people_who_have_voted", {})
+    owner = voting_dict.get("owner_email")
+    has_owner = isinstance(owner, basestring)
+    extra = {key: value for key, value in voting_dict.iteritems()
+             if key not in KNOWN_KEYS and
+             not (key == "owner_email" and has_owner)}
+
+    strings = [voting_dict["title"], owner if has_owner else "",
+               json.dumps(extra) if extra else ""]
+    strings.extend(options[number][0] for number in numbers)
+    strings.extend(voters)
+    strings = "\0".join(strings)
+    if strings.count("\0") != 2 + len(options) + len(voters):
+        raise ValueError("voting strings can't contain NUL characters")
+    strings = strings.encode("utf-8")
+
+    flags = HAS_OWNER if has_owner else 0
+    ballots_type = BALLOTS
+    if len(options) > 0xffff:
+        flags |= WIDE_BALLOTS
+        ballots_type = WIDE
+
+    if any(isinstance(ballot, list) for ballot in voters.itervalues()):
+        flags |= LIST_BALLOTS
+        choices = [ballot_choices(ballot) for ballot in voters.itervalues()]
+        ballots = _pack(BALLOTS, (len(ballot) for ballot in choices)) + \
+            _pack(ballots_type, (option for ballot in choices
+                                 for option in ballot))
+    else:
+        ballots = _pack(ballots_type, voters.itervalues())
+
+    return b"".join([HEADER.pack(FORMAT_VERSION, flags, len(options),
+                                 len(voters), len(strings), len(ballots)),
+                     strings,
+                     _pack(COUNTS, (options[number][1] for number in numbers)),
+                     ballots])
+
+
+def decode_voting(data):
+    '''Voting dictionary from a record made by encode_voting.'''
+    data = bytes(data)
+    version, flags, n_options, n_voters, strings_size, ballots_size = \
+        HEADER.unpack_from(data)
+
+    if version != FORMAT_VERSION:
+        raise ValueError("unknown voting format version: %d" % version)
+
+    start = HEADER.size
+    strings = data[start:start + strings_size].decode("utf-8").split("\0")
+    start += strings_size
+    counts = _unpack(COUNTS, data[start:start + COUNT_SIZE * n_options])
+    start += COUNT_SIZE * n_options
+    ballots_type = WIDE if flags & WIDE_BALLOTS else BALLOTS
+    if flags & LIST_BALLOTS:
+        ballots = _unpack_lists(ballots_type, n_voters,
+                                data[start:start + ballots_size])
+    else:
+        ballots = _unpack(ballots_type, data[start:start + ballots_size])
+
+    title, owner, extra = strings[:3]
+    descriptions = strings[3:3 + n_options]
+    voters = strings[3 + n_options:]
+
+    voting_dict = json.loads(extra) if extra else {}
+    voting_dict["title"] = title
+    if flags & HAS_OWNER:
+        voting_dict["owner_email"] = owner
+    voting_dict["options"] = {number: [description, count] for
+                              number, (description, count) in
+                              enumerate(izip(descriptions, counts))}
+    voting_dict["people_who_have_voted"] = dict(izip(voters, ballots))
+
+    return voting_dict
+
+
+def _unpack_lists(typecode, n_voters, data):
+    split = array(BALLOTS).itemsize * n_voters
+    options = _unpack(typecode, data[split:])
+    ballots = []
+    start = 0
+    for length in _unpack(BALLOTS, data[:split]):
+        ballots.append(options[start:start + length].tolist())
+        start += length
+
+    return ballots
@@ -0,0 +1,235 @@
+from __future__ import unicode_literals
+import re
+
+"""
+Linear time parsing of public messages.
+
+parse_command classifies a message (what follows the bot's key word) as help,
+a vote, a results request or a new option. It splits the title from the
+command once, on the first new line or colon, and otherwise looks at the
+words at the end of a one liner, so words like "add" or "results" inside a
+title are left alone. Anything else, topic creation included, returns None.
+
+parse_topic reads those: to_one_liner joins the lines into "title: command"
+the way the one liner grammar always has, and the command is split off at
+the first colon. Both only make a fixed number of passes over the message
+with string methods and regular expressions that can't backtrack more than a
+character, so parse time is linear in the message length. VotingBot's
+parsley grammar is the reference they are tested against; it backtracks
+over the whole message and isn't run on messages anymore.
+
+Results are (action, title, arg) tuples like the grammar's. A vote's arg is
+its ballot: an option number, or a list of them for approval ("0,2") and
+ranked ("2>0>1") polls, as parse_ballot reads it.
+"""
+
+DIGITS = "0123456789"
+
+# "add" as a word after at least one title word, in a one liner
+ADD_WORD = re.compile(r"\S\s+(add\s)", re.UNICODE)
+
+# option numbers separated by commas or ">"
+LIST_BALLOT = re.compile(r"^[0-9]+(?:\s*[,>]\s*[0-9]+)+$", re.UNICODE)
+OPTION_NUMBER = re.compile(r"[0-9]+")
+
+ERROR = (None, None, None)
+
+
+def parse_ballot(text):
+    '''Option number of "2", list of option numbers of "0,2" or "2 > 0 > 1",
+        or None if text isn't a vote.
+    '''
+    text = text.strip()
+    if text and not text.strip(DIGITS):
+        return int(text)
+
+    if LIST_BALLOT.match(text):
+        return [int(number) for number in OPTION_NUMBER.findall(text)]
+
+    return None
+
+
+def ballot_start(text):
+    '''Where the list ballot ("0,2" or "2 > 0 > 1") ending text starts,
+        right after whitespace, or -1. One backwards pass over the ballot.
+    '''
+    start = -1
+    numbers = 0
+    i = len(text.rstrip())
+
+    while True:
+        j = i
+        while j > 0 and text[j - 1] in DIGITS:
+            j -= 1
+        if j == i:
+            return start
+
+        numbers += 1
+        if numbers > 1 and j > 0 and text[j - 1].isspace():
+            start = j
+
+        # the separator before this number, if there is one
+        while j > 0 and text[j - 1].isspace():
+            j -= 1
+        if j == 0 or text[j - 1] not in ",>":
+            return start
+
+        j -= 1
+        while j > 0 and text[j - 1].isspace():
+            j -= 1
+        i = j
+
+
+def parse_command(user_content):
+    '''(action, title, arg) for help, vote, results and add messages, or
+        None when the message is for parse_topic.
+    '''
+    text = user_content.lower()
+
+    rest = text.strip()
+    if rest.startswith(":"):
+        rest = rest[1:].lstrip()
+    if rest == "help":
+        return ("help", None, None)
+
+    newline = text.find("\n")
+    colon = text.find(":")
+
+    if newline != -1:
+        # more lines are a list of options, a colon before the new line would
+        # make the grammar split the title there
+        if text.find("\n", newline + 1) != -1 or -1 < colon < newline:
+            return None
+        title, command = text[:newline], text[newline + 1:]
+
+    elif colon != -1:
+        title, command = text[:colon], text[colon + 1:]
+
+    else:
+        title, command = _split_one_liner(text)
+        if command is None:
+            return None
+
+    title = title.strip()
+    if not title:
+        return None
+
+    return _command(title, command.lstrip())
+
+
+def _split_one_liner(text):
+    match = ADD_WORD.search(text)
+    if match:
+        return text[:match.start(1)], text[match.start(1):]
+
+    start = ballot_start(text)
+    if start != -1:
+        return text[:start], text[start:]
+
+    words = text.rsplit(None, 1)
+    if len(words) == 2 and (words[1] == "results" or
+                            not words[1].strip(DIGITS)):
+        return words
+
+    return text, None
+
+
+def _command(title, command):
+    word = command.rstrip()
+
+    if word == "results":
+        return ("results", title, None)
+
+    ballot = parse_ballot(word)
+    if ballot is not None:
+        return ("vote", title, ballot)
+
+    if command.startswith("add") and command[3:4] in (":", " ", "\t", "\n"):
+        option = command[3:]
+        if option.startswith(":"):
+            option = option[1:]
+        option = option.lstrip()
+
+        if option:
+            return ("option", title, option.capitalize())
+
+    return None
+
+
+def to_one_liner(user_content):
+    '''"title: command" for a message of several lines or a one liner
+        without a colon, or None when there's nowhere to put the colon.
+    '''
+    user_cont_lines = user_content.split("\n")
+
+    # convert multiple lines conttent into one liner
+    if len(user_cont_lines) == 2:
+        user_content = user_content.replace("\n", ": ")
+
+    elif len(user_cont_lines) > 2:
+        options = ",".join(user_cont_lines[1:])
+        user_content = user_cont_lines[0] + ": " + options
+
+    # fix colon ":" omission in the message
+    elif ":" not in user_content:
+        lowered = user_content.lower()
+        ballot = ballot_start(user_content)
+
+        if not user_content.strip():
+            return None
+
+        elif "add" in lowered:
+            i = lowered.index("add")
+            user_content = user_content[:i - 1] + ":" + user_content[i - 1:]
+
+        elif "results" in lowered:
+            i = lowered.index("results")
+            user_content = user_content[:i - 1] + ":" + user_content[i - 1:]
+
+        elif ballot != -1:
+            user_content = user_content[:ballot - 1] + ":" + \
+                user_content[ballot - 1:]
+
+        elif user_content.split()[-1].isdigit():
+            words = user_content.split()
+            if len(words) < 2:
+                # a number without a title
+                return None
+            words[-2] += ":"
+            user_content = " ".join(words)
+
+        elif "help" in lowered:
+            pass
+
+        elif "," in user_content:
+            index = user_content.index(",")
+            i = user_content.rfind(" ", 0, index)
+            user_content = user_content[:i] + ":" + user_content[i:]
+
+        elif len(user_content.split()) > 1:
+            i = user_content.rfind(" ")
+            user_content = user_content[:i] + ":" + user_content[i:]
+
+        else:
+            return None
+
+    return user_content
+
+
+def parse_topic(user_content):
+    '''(action, title, arg) of a message parse_command returned None for:
+        a new topic's title and options, mostly, or ERROR.
+    '''
+    text = to_one_liner(user_content)
+    if text is None:
+        return ERROR
+
+    title, colon, command = text.lower().partition(":")
+    command = command.lstrip()
+    if not colon or not command:
+        return ERROR
+
+    title = title.strip()
+
+    return (title and _command(title, command)) or \
+        ("topic", title, [option.strip() for option in command.split(",")])
@@ -1,6 +1,18 @@
-import dataset
+import itertools
 import os
+import random
+import sys
+import time
 import json
+import logging
+import threading
+import urllib
+import zlib
+from contextlib import contextmanager
+from cache import LRUCache
+from codec import encode_voting, decode_voting, encode_choices, \
+    decode_choices, first_choice
+import metrics
 
 """
 This module handles the connection with a postgres database in a way that only
@@ -30,57 +42,707 @@ voting_topics_db = {
     }
 }
 
+A voting with a "mode" of "approval" or "ranked" has lists of option numbers
+as ballots, e.g. "claire@hi.com": [2, 0], and its option counts are the votes
+for each ballot's first option, which is all the storages count.
+
 Database model
 --------------
 
-One table: "voting_topics"
-Fields: "voting_title", "voting_dict"
+Table: "voting_topics"
+Fields: "voting_title", "voting_dict", "voting_data", "version", "deadline"
 
 "voting_title" is a string.
 "voting_dict" values are string representations of a dictionary.
+"voting_data" values are the same dictionary in codec's binary encoding.
+"version" counts the writes to a voting (NULL in rows older than the column).
+"deadline" is the voting's "deadline" key, a unix time, copied to an indexed
+column so expired votings can be found and deleted without decoding them.
+
+A row has one of "voting_dict" or "voting_data". Votings are written in the
+binary encoding unless DB_ENCODING=json; rows written as JSON, like the ones
+from before the binary column existed, are still read.
+
+Tables: "voting_ballots_0" ... "voting_ballots_<DB_BALLOT_SHARDS - 1>"
+Fields: "voting_title", "voter", "option_number", "choices"
+
+The "voting_topics" row only holds a voting's header: title, owner and
+options with their counts. Ballots are rows of their own, in the shard picked
+by a hash of the voter, keyed by (voting_title, voter). Checking or changing
+one ballot reads and writes one ballot row and the header, so a vote costs
+the same on a poll with ten voters and on one with a hundred thousand. Rows
+from before the ballot tables keep their voters inline until the next vote
+moves them out. A list ballot's options are packed in "choices", and its
+"option_number" is the first of them.
+
+Concurrent writers
+------------------
+
+add_option reads a voting and writes it back with a compare and swap on its
+version, so several bot processes can share the database: a write that lost
+the race to another one is retried on the fresh voting, up to DB_CAS_RETRIES
+times, before VersionConflict is raised. cast_vote bumps the version first,
+which locks the voting's row for the rest of its transaction, so votes on a
+poll are serialized without retries and still fail add_option's swap. The relational
+schema doesn't need versions, its writes are single statements, but
+add_option retries when a concurrent insert took the option number it picked.
+
+Caching
+-------
+
+Decoded votings are kept in a write-through LRU cache keyed by title, so
+reads (membership tests included) only reach the database on a cache miss.
+Writes and deletes go to the database and update the cache in the same call.
+Headers, votings without their ballots, have an LRU cache of their own, which
+votes update in place; a vote only drops the whole voting from the cache.
+Entries expire after DB_CACHE_TTL seconds so several bot instances sharing one
+database converge; DB_CACHE_SIZE=0 disables the cache.
+
+Iteration streams rows through a server-side cursor DB_FETCH_SIZE rows at a
+time, selecting only the columns it needs and decoding votings lazily.
+
+Membership tests are answered from a cached set of all titles, loaded with a
+single query over the unique "voting_title" index, kept up to date by writes
+and reloaded after DB_CACHE_TTL. Without a cache they fall back to an indexed
+existence query.
+
+Relational schema
+-----------------
+
+RelationalVotingTopics exposes the same dictionary but stores it normalized:
+
+"topics": "title" (lower case key), "display_title", "owner_email",
+          "deadline", "stream", "subject", "mode"
+"options": "topic", "number", "description"
+"ballots": "topic", "voter", "option_number", "choices"
+
+A vote is a single upsert of the (topic, voter) ballot row and option counts
+are computed with an aggregate over the ballots index, so concurrent votes
+can't overwrite each other. Select it with DB_SCHEMA=relational after running
+"python database.py migrate" to copy the existing JSON rows over.
+
+Connections
+-----------
+
+The database is a postgres URL built from DB_USER, DB_PASSWORD, DB_HOST,
+DB_PORT and DB_NAME, or DATABASE_URL where none of them is set (Heroku always
+sets DATABASE_URL, so deployments configured with DB_* keep their database).
+The password goes after a plain ':'; URLs used to be built with ':-', which
+prefixed DB_PASSWORD with '-', so see the README before upgrading. Every operation checks a connection
+out of a pool for the length of one transaction, so handler threads can use
+the same VotingTopics concurrently. The pool keeps DB_POOL_MIN connections
+open, grows to DB_POOL_MAX, pings connections before handing them out so a
+Postgres restart only costs a reconnect, and reports pool wait time and
+utilization to the metrics registry.
+
+Deadlines
+---------
+
+A voting may have a "deadline". deadlines() lists them for the bot's
+scheduler and delete_expired(now, titles) deletes those of titles whose
+deadline has passed, with one statement per table over the deadline index.
+Without titles it deletes every expired voting, including polls another bot
+instance is about to publish the results of.
+
+Checkpoints
+-----------
+
+Every backend also keeps the bot's event queue checkpoints: the Zulip queue
+id and the last event id handled from it, by queue name. SQL backends keep
+them in a "bot_checkpoints" table next to the votings. They also keep the
+names of the streams the bot subscribed to, in "bot_subscriptions", so a
+restarted bot only subscribes to streams it hasn't yet. clear() leaves both
+alone.
+
+dataset and SQLAlchemy are imported when the first SQL backend is opened; the
+memory backend never loads them.
+
+Backends
+--------
+
+Every storage implements the VotingStorage interface. DB_BACKEND selects one:
+
+"postgres": the default, either schema on the database above.
+"sqlite": either schema on the DB_SQLITE_PATH file, in WAL journal mode so
+          readers don't block the writer.
+"memory": MemoryVotingTopics, a dictionary local to the process.
+
+InstrumentedStorage wraps any of them and times every call into the metrics
+registry as "db.<method>", e.g. "db.cast_vote" or "db.getitem".
 """
 
+log = logging.getLogger(__name__)
+
+DB_BACKEND = os.environ.get("DB_BACKEND", "postgres")
+DB_SCHEMA = os.environ.get("DB_SCHEMA", "blob")
+DB_SQLITE_PATH = os.environ.get("DB_SQLITE_PATH", "votings.db")
+
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", 512))
+DB_CACHE_TTL = float(os.environ.get("DB_CACHE_TTL", 30))
+DB_FETCH_SIZE = int(os.environ.get("DB_FETCH_SIZE", 100))
+DB_ENCODING = os.environ.get("DB_ENCODING", "binary")
+DB_CAS_RETRIES = int(os.environ.get("DB_CAS_RETRIES", 10))
+DB_CAS_BACKOFF = 0.002
+DB_BALLOT_SHARDS = int(os.environ.get("DB_BALLOT_SHARDS", 4))
+
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+
+
+class VersionConflict(Exception):
+
+    """A compare and swap write kept losing to concurrent writers."""
+
+
+DB_VARIABLES = ["DB_USER", "DB_PASSWORD", "DB_HOST", "DB_PORT", "DB_NAME"]
+
+
+def database_url():
+    """A postgres URL built from the DB_* variables when they are set, or
+        DATABASE_URL.
+    """
+
+    if "DATABASE_URL" in os.environ and \
+            not any(name in os.environ for name in DB_VARIABLES):
+        return os.environ["DATABASE_URL"]
+
+    user = urllib.quote(os.environ["DB_USER"], safe="")
+    password = urllib.quote(os.environ["DB_PASSWORD"], safe="")
+
+    return "postgres://%s:%s@%s:%s/%s" % (user, password,
+                                          os.environ["DB_HOST"],
+                                          os.environ["DB_PORT"],
+                                          os.environ["DB_NAME"])
+
+
+def sqlite_url(path=DB_SQLITE_PATH):
+    return "sqlite:///" + path
+
+
+def _sqlite_wal(dbapi_connection, connection_record):
+    # readers don't block the writer and commits skip most fsyncs
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def pool_options(url, pool_min=DB_POOL_MIN, pool_max=DB_POOL_MAX):
+    """SQLAlchemy engine arguments for a connection pool on url."""
+
+    if url in ["sqlite://", "sqlite:///:memory:"]:
+        # dataset shares a single connection for in memory sqlite
+        return {}
+
+    options = {"pool_size": pool_min,
+               "max_overflow": max(0, pool_max - pool_min),
+               "pool_timeout": DB_POOL_TIMEOUT,
+               "pool_recycle": DB_POOL_RECYCLE,
+               "pool_pre_ping": True}
+
+    if url.startswith("sqlite"):
+        from sqlalchemy.pool import QueuePool
+
+        # pooled sqlite connections move between handler threads
+        options.update({"poolclass": QueuePool,
+                        "connect_args": {"check_same_thread": False}})
+
+    return options
+
 
-class VotingTopics(object):
+class VotingStorage(object):
+
+    """Dictionary of votings, the interface every storage backend implements.
+
+    Backends provide item access, membership, cast_vote, add_option, clear
+    and the iter* methods; the rest of the dictionary interface is built on
+    those here.
+    """
+
+    def __getitem__(self, voting_title):
+        raise NotImplementedError
+
+    def __setitem__(self, voting_title, voting_dict):
+        raise NotImplementedError
+
+    def __delitem__(self, voting_title):
+        raise NotImplementedError
+
+    def __contains__(self, voting_title):
+        raise NotImplementedError
+
+    def cast_vote(self, voting_title, voter, option_number):
+        """Record voter's ballot and return the option it replaced, if any."""
+        raise NotImplementedError
+
+    def add_option(self, voting_title, description):
+        """Append an option and return its number, or None if it's repeated."""
+        raise NotImplementedError
+
+    def cast_votes(self, voting_title, ballots):
+        """Record (voter, option_number) ballots in order, in a single
+            transaction where the backend has them. Returns the options they
+            replaced.
+        """
+        return [self.cast_vote(voting_title, voter, option_number)
+                for voter, option_number in ballots]
+
+    def header(self, voting_title):
+        """The voting without "people_who_have_voted": title, owner and
+            options with their counts.
+        """
+        voting_dict = self[voting_title]
+        voting_dict.pop("people_who_have_voted", None)
+
+        return voting_dict
+
+    def reload(self, voting_title):
+        """The voting as the database has it now, past any cache, e.g. with
+            the votes other bot instances cast.
+        """
+        return self[voting_title]
+
+    def clear(self):
+        raise NotImplementedError
+
+    def deadlines(self):
+        """(title, deadline) of every voting that has one."""
+        return [(key, voting["deadline"]) for key, voting in self.iteritems()
+                if voting.get("deadline") is not None]
+
+    def delete_expired(self, now, titles=None):
+        """Delete the votings of titles, every voting by default, whose
+            deadline is now or past. Return their titles.
+        """
+        expired = [key for key, deadline in self.deadlines()
+                   if deadline <= now and (titles is None or key in titles)]
+        for key in expired:
+            del self[key]
+
+        return expired
+
+    def iterkeys(self):
+        raise NotImplementedError
+
+    def get_checkpoint(self, name):
+        """(queue_id, last_event_id) saved for event queue name, or None."""
+        raise NotImplementedError
+
+    def set_checkpoint(self, name, queue_id, last_event_id):
+        raise NotImplementedError
+
+    def get_subscriptions(self):
+        """Set of the stream names saved by set_subscriptions."""
+        raise NotImplementedError
+
+    def set_subscriptions(self, streams):
+        raise NotImplementedError
+
+    def itervalues(self):
+        return (self[key] for key in self.iterkeys())
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.iterkeys())
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def has_key(self, voting_title):
+        return voting_title in self
+
+    @staticmethod
+    def _copy_voting(voting_dict):
+        """Copy deep enough that callers can mutate options and voters."""
+
+        voting_copy = dict(voting_dict)
+        voting_copy["options"] = {num: list(opt) for num, opt in
+                                  voting_dict["options"].iteritems()}
+        if "people_who_have_voted" in voting_dict:
+            voting_copy["people_who_have_voted"] = dict(
+                voting_dict["people_who_have_voted"])
+
+        return voting_copy
+
+    @staticmethod
+    def _copy_header(voting_dict):
+        """Copy of a voting's header, which leaves its voters behind."""
+
+        header = {key: value for key, value in voting_dict.iteritems()
+                  if key != "people_who_have_voted"}
+        header["options"] = {num: list(opt) for num, opt in
+                             voting_dict["options"].iteritems()}
+
+        return header
+
+    def summary(self, limit=10):
+        """Short description of the stored votings, for diagnostics."""
+
+        titles = self.keys()
+        more = ", ..." if len(titles) > limit else ""
+
+        return "%d votings: %s%s" % (len(titles), ", ".join(titles[:limit]),
+                                     more)
+
+    # PUBLIC methods
+    def drop_all_votings(self):
+        self.clear()
+
+    def get(self, voting_title):
+
+        if voting_title not in self:
+            return None
+
+        else:
+            return self[voting_title]
+
+    def pop(self, voting_title):
+        item = self[voting_title]
+        del self[voting_title]
+
+        return item
+
+    # list methods
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class MemoryVotingTopics(VotingStorage):
+
+    """Votings kept in a dictionary, for tests, benchmarks and single box
+        deployments that can afford to lose polls on restart.
+    """
+
+    def __init__(self):
+        self.votings = {}
+        self.checkpoints = {}
+        self.subscriptions = set()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, voting_title):
+        with self._lock:
+            return self._copy_voting(self.votings[voting_title])
+
+    def __setitem__(self, voting_title, voting_dict):
+        with self._lock:
+            self.votings[voting_title] = self._copy_voting(voting_dict)
+
+    def __delitem__(self, voting_title):
+        with self._lock:
+            del self.votings[voting_title]
+
+    def header(self, voting_title):
+        with self._lock:
+            return self._copy_header(self.votings[voting_title])
+
+    def __contains__(self, voting_title):
+        return voting_title in self.votings
+
+    def cast_vote(self, voting_title, voter, option_number):
+        with self._lock:
+            vote = self.votings[voting_title]
+            old_option = vote["people_who_have_voted"].get(voter)
+
+            if old_option is not None:
+                vote["options"][first_choice(old_option)][1] -= 1
+            vote["options"][first_choice(option_number)][1] += 1
+            vote["people_who_have_voted"][voter] = option_number
+
+        return old_option
+
+    def add_option(self, voting_title, description):
+        with self._lock:
+            options = self.votings[voting_title]["options"]
+
+            if description in [opt[0] for opt in options.values()]:
+                return None
+
+            new_option_num = len(options)
+            options[new_option_num] = [description, 0]
+
+        return new_option_num
+
+    def clear(self):
+        with self._lock:
+            self.votings.clear()
+
+    def iterkeys(self):
+        with self._lock:
+            return iter(list(self.votings))
+
+    def get_checkpoint(self, name):
+        return self.checkpoints.get(name)
+
+    def set_checkpoint(self, name, queue_id, last_event_id):
+        self.checkpoints[name] = (queue_id, last_event_id)
+
+    def get_subscriptions(self):
+        return set(self.subscriptions)
+
+    def set_subscriptions(self, streams):
+        self.subscriptions = set(streams)
+
+
+class VotingTopics(VotingStorage):
 
     """Voting topics database connection."""
 
     TABLE = "voting_topics"
     KEY_FIELD = "voting_title"
     VALUE_FIELD = "voting_dict"
+    DATA_FIELD = "voting_data"
+    VERSION_FIELD = "version"
+    DEADLINE_FIELD = "deadline"
+    TABLES = [TABLE]
+    BALLOT_SHARD_TABLE = "voting_ballots_%d"
+    CHOICES_FIELD = "choices"
+    CHECKPOINTS_TABLE = "bot_checkpoints"
+    SUBSCRIPTIONS_TABLE = "bot_subscriptions"
 
-    def __init__(self):
-        self.db = self._connect_to_database()
+    def __init__(self, url=None, cache_size=DB_CACHE_SIZE,
+                 cache_ttl=DB_CACHE_TTL, fetch_size=DB_FETCH_SIZE,
+                 encoding=DB_ENCODING, ballot_shards=DB_BALLOT_SHARDS,
+                 registry=metrics.registry):
+        self.db = self._connect_to_database(url or database_url())
+        self.fetch_size = fetch_size
+        self.binary = encoding == "binary"
+        self.ballot_tables = [self.BALLOT_SHARD_TABLE % shard
+                              for shard in range(max(1, ballot_shards))]
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.headers = LRUCache(cache_size, cache_ttl)
+        self.metrics = registry
+        self._titles = None
+        self._titles_loaded_at = 0
+        self._create_schema()
+        self._create_checkpoints()
+        self._release_dataset_connection()
+        self._report_pool()
 
-    def _connect_to_database(self):
+    def _connect_to_database(self, url):
+        import dataset
+        from sqlalchemy import event
 
-        database_name = str(os.environ["DB_NAME"])
-        user = str(os.environ["DB_USER"])
-        password = str(os.environ["DB_PASSWORD"])
-        host = str(os.environ["DB_HOST"])
-        port = str(os.environ["DB_PORT"])
+        db = dataset.connect(url, engine_kwargs=pool_options(url))
 
-        conn_str = "".join(["postgres://", user, ":-", password, "@",
-                            host, ":", port, "/", database_name])
+        if url.startswith("sqlite:///") and len(url) > len("sqlite:///"):
+            event.listen(db.engine, "connect", _sqlite_wal)
 
-        db = dataset.connect(conn_str)
+        # open the minimum number of connections up front
+        if hasattr(db.engine.pool, "checkedout"):
+            connections = [db.engine.connect() for _ in range(DB_POOL_MIN)]
+            for conn in connections:
+                conn.close()
 
         return db
 
-    def __iter__(self):
-        return self.iterkeys()
+    def _create_schema(self):
+        from sqlalchemy import LargeBinary
+
+        table = self.db.get_table(self.TABLE)
+        table.create_column(self.KEY_FIELD, self.db.types.text)
+        table.create_column(self.VALUE_FIELD, self.db.types.text)
+        table.create_column(self.DATA_FIELD, LargeBinary)
+        table.create_column(self.VERSION_FIELD, self.db.types.integer)
+        table.create_column(self.DEADLINE_FIELD, self.db.types.float)
+        table.create_index([self.KEY_FIELD], "voting_topics_title_idx",
+                           unique=True)
+        table.create_index([self.DEADLINE_FIELD],
+                           "voting_topics_deadline_idx")
+
+        with self.transaction() as conn:
+            for ballots in self.ballot_tables:
+                self._execute(conn, """CREATE TABLE IF NOT EXISTS %s (
+                                       voting_title TEXT NOT NULL,
+                                       voter TEXT NOT NULL,
+                                       option_number INTEGER NOT NULL,
+                                       PRIMARY KEY (voting_title, voter))""" %
+                              ballots)
+
+        for ballots in self.ballot_tables:
+            self.db.get_table(ballots).create_column(self.CHOICES_FIELD,
+                                                     LargeBinary)
+
+    def _data_tables(self):
+        return self.TABLES + self.ballot_tables
+
+    def _create_checkpoints(self):
+        with self.transaction() as conn:
+            self._execute(conn, """CREATE TABLE IF NOT EXISTS %s (
+                                   name TEXT PRIMARY KEY,
+                                   queue_id TEXT,
+                                   last_event_id INTEGER NOT NULL)""" %
+                          self.CHECKPOINTS_TABLE)
+            self._execute(conn, """CREATE TABLE IF NOT EXISTS %s (
+                                   stream TEXT PRIMARY KEY)""" %
+                          self.SUBSCRIPTIONS_TABLE)
+
+    def _release_dataset_connection(self):
+        # dataset keeps a connection per thread; schema creation was its only
+        # use, so give this one back to the pool
+        if hasattr(self.db.local, "conn"):
+            self.db.local.conn.close()
+            del self.db.local.conn
+
+    def _report_pool(self):
+        pool = self.db.engine.pool
+        if not hasattr(pool, "checkedout"):
+            return
+
+        capacity = pool.size() + max(0, pool._max_overflow)
+        self.metrics.gauge("db.pool_checked_out", pool.checkedout)
+        self.metrics.gauge("db.pool_utilization",
+                           lambda: float(pool.checkedout()) / capacity)
+
+    @contextmanager
+    def transaction(self):
+        """Check a pooled connection out for the length of one transaction."""
+
+        start = time.time()
+        conn = self.db.engine.connect()
+        self.metrics.observe("db.pool_wait", time.time() - start)
+
+        try:
+            with conn.begin():
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _execute(conn, statement, *multiparams, **params):
+        from sqlalchemy import text
+
+        return conn.execute(text(statement), *multiparams, **params)
 
     def __getitem__(self, voting_title):
-        dict_params = {self.KEY_FIELD: voting_title}
+        voting_dict = self.cache.get(voting_title)
 
-        with self.db as db:
-            row = db[self.TABLE].find_one(**dict_params)
-            if not row:
-                raise KeyError(voting_title)
+        if voting_dict is None:
+            with self.transaction() as conn:
+                voting_dict, _ = self._read_header(conn, voting_title)
+                voting_dict["people_who_have_voted"].update(
+                    self._load_ballots(conn, voting_title))
+
+            self.cache.set(voting_title, voting_dict)
+
+        return self._copy_voting(voting_dict)
+
+    def reload(self, voting_title):
+        self.cache.delete(voting_title)
+        self.headers.delete(voting_title)
+
+        return self[voting_title]
+
+    def header(self, voting_title):
+        header = self.headers.get(voting_title)
 
-        return self._load_json_voting(row[self.VALUE_FIELD])
+        if header is None:
+            with self.transaction() as conn:
+                header, _ = self._read_header(conn, voting_title)
 
-    def _load_json_voting(self, json_voting):
+            del header["people_who_have_voted"]
+            self.headers.set(voting_title, header)
+
+        return self._copy_header(header)
+
+    def _read_header(self, conn, voting_title):
+        """(voting, version) of the stored row. The voting's voters are the
+            ones still kept inline, by rows from before the ballot tables.
+        """
+
+        row = self._execute(
+            conn, "SELECT %s, %s, COALESCE(%s, 0) FROM %s WHERE %s = :title" %
+            (self.VALUE_FIELD, self.DATA_FIELD, self.VERSION_FIELD,
+             self.TABLE, self.KEY_FIELD), title=voting_title).first()
+        if not row:
+            raise KeyError(voting_title)
+
+        voting_dict = self._load_voting_row(row[0], row[1])
+        voting_dict.setdefault("people_who_have_voted", {})
+
+        return voting_dict, row[2]
+
+    def _ballot_table(self, voter):
+        if isinstance(voter, unicode):
+            voter = voter.encode("utf-8")
+        shard = (zlib.crc32(voter) & 0xffffffff) % len(self.ballot_tables)
+
+        return self.ballot_tables[shard]
+
+    def _load_ballots(self, conn, voting_title):
+        ballots = {}
+        for table in self.ballot_tables:
+            rows = self._execute(conn, "SELECT voter, option_number, choices "
+                                 "FROM %s WHERE voting_title = :title" % table,
+                                 title=voting_title)
+            ballots.update((row[0], self._ballot(row[1], row[2]))
+                           for row in rows)
+
+        return ballots
+
+    @staticmethod
+    def _ballot(option_number, choices):
+        """A ballot from its option_number and choices columns."""
+
+        if choices is None:
+            return option_number
+
+        return decode_choices(choices)
+
+    @staticmethod
+    def _ballot_row(voting_title, voter, ballot):
+        return {"title": voting_title, "voter": voter,
+                "option_number": first_choice(ballot),
+                "choices": buffer(encode_choices(ballot))
+                if isinstance(ballot, list) else None}
+
+    def _insert_ballots(self, conn, voting_title, voters):
+        """Insert ballots a shard at a time, leaving any the voter already
+            has in place.
+        """
+
+        shards = {}
+        for voter, ballot in voters.iteritems():
+            shards.setdefault(self._ballot_table(voter), []).append(
+                self._ballot_row(voting_title, voter, ballot))
+
+        for table, ballots in shards.iteritems():
+            self._execute(conn, """INSERT INTO %s
+                                   (voting_title, voter, option_number,
+                                    choices)
+                                   VALUES (:title, :voter, :option_number,
+                                           :choices)
+                                   ON CONFLICT (voting_title, voter)
+                                   DO NOTHING""" % table, ballots)
+
+    def _delete_ballots(self, conn, voting_title):
+        for table in self.ballot_tables:
+            self._execute(conn, "DELETE FROM %s WHERE voting_title = :title" %
+                          table, title=voting_title)
+
+    def _load_voting_row(self, json_voting, voting_data):
+        if voting_data is not None:
+            return decode_voting(voting_data)
+
+        return self._load_json_voting(json_voting)
+
+    def _dump_voting(self, voting_dict):
+        """(voting_dict, voting_data) column values for a voting."""
+
+        if self.binary:
+            return None, buffer(encode_voting(voting_dict))
+
+        return json.dumps(voting_dict), None
+
+    @staticmethod
+    def _load_json_voting(json_voting):
 
         voting_dict = json.loads(json_voting)
         # print voting_dict
@@ -101,98 +763,853 @@ class VotingTopics(object):
         return eval_voting_dict
 
     def __setitem__(self, voting_title, voting_dict):
-        dict_params = {self.KEY_FIELD: voting_title,
-                       self.VALUE_FIELD: json.dumps(voting_dict)}
+        header = self._copy_header(voting_dict)
+        json_voting, voting_data = self._dump_voting(header)
+
+        with self.transaction() as conn:
+            self._execute(conn, """INSERT INTO %(table)s
+                                   (%(key)s, %(value)s, %(data)s, %(version)s,
+                                    %(deadline)s)
+                                   VALUES (:title, :voting, :data, 1, :deadline)
+                                   ON CONFLICT (%(key)s) DO UPDATE
+                                   SET %(value)s = excluded.%(value)s,
+                                       %(data)s = excluded.%(data)s,
+                                       %(deadline)s = excluded.%(deadline)s,
+                                       %(version)s =
+                                       COALESCE(%(table)s.%(version)s, 0) + 1""" %
+                          {"table": self.TABLE, "key": self.KEY_FIELD,
+                           "value": self.VALUE_FIELD, "data": self.DATA_FIELD,
+                           "version": self.VERSION_FIELD,
+                           "deadline": self.DEADLINE_FIELD},
+                          title=voting_title, voting=json_voting,
+                          data=voting_data,
+                          deadline=voting_dict.get("deadline"))
+            self._delete_ballots(conn, voting_title)
+            self._insert_ballots(conn, voting_title,
+                                 voting_dict.get("people_who_have_voted", {}))
 
-        with self.db as db:
-            db[self.TABLE].upsert(dict_params, [self.KEY_FIELD])
+        self.cache.set(voting_title, self._copy_voting(voting_dict))
+        self.headers.set(voting_title, header)
+        self._title_added(voting_title)
 
     def __delitem__(self, voting_title):
         # print "actually deleting", voting_title
-        dict_params = {self.KEY_FIELD: voting_title}
 
-        with self.db as db:
-            db[self.TABLE].delete(**dict_params)
+        with self.transaction() as conn:
+            self._execute(conn, "DELETE FROM %s WHERE %s = :title" %
+                          (self.TABLE, self.KEY_FIELD), title=voting_title)
+            self._delete_ballots(conn, voting_title)
 
-        print voting_title, "deleted!"
+        self.cache.delete(voting_title)
+        self.headers.delete(voting_title)
+        self._title_removed(voting_title)
+
+        log.info("voting %s deleted", voting_title)
 
     def __contains__(self, voting_title):
 
-        try:
-            self[voting_title]
+        if voting_title in self.cache:
             return True
 
-        except KeyError:
-            return False
+        titles = self._title_set()
+        if titles is not None:
+            return voting_title in titles
 
-    has_key = __contains__
+        return self.exists(voting_title)
 
-    # PUBLIC methods
-    def drop_all_votings(self):
+    def exists(self, voting_title):
+        """Indexed existence check that doesn't fetch the voting itself."""
 
-        for key in self.keys():
-            del self[key]
+        with self.transaction() as conn:
+            row = self._execute(conn, "SELECT 1 FROM %s WHERE %s = :title" %
+                                (self.TABLE, self.KEY_FIELD),
+                                title=voting_title).first()
 
-    def get(self, voting_title):
+        return row is not None
 
-        if voting_title not in self:
+    def _load_titles(self):
+        with self.transaction() as conn:
+            return [row[0] for row in
+                    self._execute(conn, "SELECT %s FROM %s" %
+                                  (self.KEY_FIELD, self.TABLE))]
+
+    def _title_set(self):
+        """Cached set of every title, or None when caching is disabled."""
+
+        if self.cache.maxsize <= 0:
             return None
 
-        else:
-            return self[voting_title]
+        expired = self.cache.ttl and \
+            self._titles_loaded_at + self.cache.ttl < time.time()
 
-    def pop(self, voting_title):
-        item = self[voting_title]
-        del self[voting_title]
+        if self._titles is None or expired:
+            self._titles_loaded_at = time.time()
+            self._titles = set(self._load_titles())
 
-        return item
+        return self._titles
+
+    def _title_added(self, voting_title):
+        if self._titles is not None:
+            self._titles.add(voting_title)
+
+    def _title_removed(self, voting_title):
+        if self._titles is not None:
+            self._titles.discard(voting_title)
+
+    def summary(self, limit=10):
+        """Short description of the stored votings, for diagnostics."""
+
+        titles = self._title_set()
+        if titles is None:
+            titles = self._load_titles()
+
+        shown = list(itertools.islice(titles, limit))
+        more = ", ..." if len(titles) > limit else ""
+
+        return "%d votings: %s%s" % (len(titles), ", ".join(shown), more)
+
+    def _update(self, voting_title, change):
+        """Apply change to the stored voting with a compare and swap on its
+            version, retrying on a fresh copy when another writer got there
+            first. change edits the voting in place and returns (result,
+            changed); nothing is written unless changed.
+        """
+
+        for attempt in range(DB_CAS_RETRIES + 1):
+            with self.transaction() as conn:
+                vote, version = self._read_header(conn, voting_title)
+
+            result, changed = change(vote)
+            if not changed:
+                return result
+
+            # a statement of its own, so it only waits for other writers
+            json_voting, voting_data = self._dump_voting(vote)
+            with self.transaction() as conn:
+                swapped = self._execute(
+                    conn, "UPDATE %(table)s SET %(value)s = :voting, "
+                    "%(data)s = :data, %(version)s = :version + 1 "
+                    "WHERE %(key)s = :title "
+                    "AND COALESCE(%(version)s, 0) = :version" %
+                    {"table": self.TABLE, "key": self.KEY_FIELD,
+                     "value": self.VALUE_FIELD, "data": self.DATA_FIELD,
+                     "version": self.VERSION_FIELD},
+                    title=voting_title, voting=json_voting, data=voting_data,
+                    version=version).rowcount
+
+            if swapped:
+                # the row may not have every ballot, the header is complete
+                self.cache.delete(voting_title)
+                del vote["people_who_have_voted"]
+                self.headers.set(voting_title, vote)
+                return result
+
+            self.metrics.incr("db.cas_conflicts")
+            time.sleep(random.uniform(0, DB_CAS_BACKOFF * 2 ** attempt))
+
+        raise VersionConflict(voting_title)
+
+    # PUBLIC methods
+    def cast_vote(self, voting_title, voter, option_number):
+        """Record voter's ballot and return the option it replaced, if any.
+            Only the voter's ballot and the voting's header are read and
+            written, whatever the number of voters.
+        """
+
+        return self.cast_votes(voting_title, [(voter, option_number)])[0]
+
+    def cast_votes(self, voting_title, ballots):
+        with self.transaction() as conn:
+            # bumping the version locks the row until the commit
+            locked = self._execute(
+                conn, "UPDATE %(table)s SET %(version)s = "
+                "COALESCE(%(version)s, 0) + 1 WHERE %(key)s = :title" %
+                {"table": self.TABLE, "key": self.KEY_FIELD,
+                 "version": self.VERSION_FIELD},
+                title=voting_title).rowcount
+            if not locked:
+                raise KeyError(voting_title)
+
+            vote, _ = self._read_header(conn, voting_title)
+            inline_voters = vote.pop("people_who_have_voted")
+            if inline_voters:
+                self._insert_ballots(conn, voting_title, inline_voters)
+
+            old_options = []
+            for voter, option_number in ballots:
+                old_option = self._upsert_ballot(conn, voting_title, voter,
+                                                 option_number)
+                if old_option is not None:
+                    vote["options"][first_choice(old_option)][1] -= 1
+                vote["options"][first_choice(option_number)][1] += 1
+                old_options.append(old_option)
+
+            json_voting, voting_data = self._dump_voting(vote)
+            self._execute(conn, "UPDATE %s SET %s = :voting, %s = :data "
+                          "WHERE %s = :title" % (self.TABLE, self.VALUE_FIELD,
+                                                 self.DATA_FIELD,
+                                                 self.KEY_FIELD),
+                          title=voting_title, voting=json_voting,
+                          data=voting_data)
+
+        self.cache.delete(voting_title)
+        self.headers.set(voting_title, vote)
+
+        return old_options
+
+    def _upsert_ballot(self, conn, voting_title, voter, option_number):
+        """Set voter's ballot, return the option it replaced, if any."""
+
+        ballots = self._ballot_table(voter)
+        ballot = self._execute(conn, "SELECT option_number, choices FROM %s "
+                               "WHERE voting_title = :title "
+                               "AND voter = :voter" % ballots,
+                               title=voting_title, voter=voter).first()
+
+        self._execute(conn, """INSERT INTO %s
+                               (voting_title, voter, option_number, choices)
+                               VALUES (:title, :voter, :option_number,
+                                       :choices)
+                               ON CONFLICT (voting_title, voter) DO UPDATE
+                               SET option_number = excluded.option_number,
+                                   choices = excluded.choices"""
+                      % ballots, **self._ballot_row(voting_title, voter,
+                                                    option_number))
+
+        return self._ballot(ballot[0], ballot[1]) if ballot else None
+
+    def add_option(self, voting_title, description):
+        """Append an option and return its number, or None if it's repeated."""
+
+        def append_option(vote):
+            options = vote["options"]
+
+            if description in [opt[0] for opt in options.values()]:
+                return None, False
+
+            new_option_num = len(options)
+            options[new_option_num] = [description, 0]
+
+            return new_option_num, True
+
+        return self._update(voting_title, append_option)
 
     def clear(self):
-        for voting_title in self:
-            del self[voting_title]
+        """Delete every voting with a single statement."""
 
-    # list methods
-    def keys(self):
-        with self.db as db:
-            keys = [row[self.KEY_FIELD] for row in db[self.TABLE].all()]
+        with self.transaction() as conn:
+            for table in self._data_tables():
+                self._execute(conn, "DELETE FROM %s" % table)
 
-        return keys
+        self.cache.clear()
+        self.headers.clear()
+        self._titles = set()
+        self._titles_loaded_at = time.time()
 
-    def values(self):
+    def deadlines(self):
+        with self.transaction() as conn:
+            return [(row[0], row[1]) for row in self._execute(
+                conn, "SELECT %s, %s FROM %s WHERE %s IS NOT NULL" %
+                (self.KEY_FIELD, self.DEADLINE_FIELD, self.TABLE,
+                 self.DEADLINE_FIELD))]
 
-        with self.db as db:
-            values = [self._load_json_voting(row[self.VALUE_FIELD]) for
-                      row in db[self.TABLE].all()]
+    def delete_expired(self, now, titles=None):
+        if titles is not None and not titles:
+            return []
 
-        return values
+        expired, params = self._expired_query(self.TABLE, self.KEY_FIELD,
+                                              self.DEADLINE_FIELD, now, titles)
 
-    def items(self):
+        with self.transaction() as conn:
+            titles = [row[0] for row in self._execute(conn, expired, **params)]
+            if titles:
+                for table in self.ballot_tables:
+                    self._execute(conn, "DELETE FROM %s WHERE voting_title "
+                                  "IN (%s)" % (table, expired), **params)
+                self._execute(conn, "DELETE FROM %s WHERE %s IN (%s)" %
+                              (self.TABLE, self.KEY_FIELD, expired), **params)
+
+        self._forget(titles)
+
+        return titles
+
+    @staticmethod
+    def _expired_query(table, key, deadline, now, titles):
+        """Query for the keys of table's expired votings, only those of
+            titles unless it's None, and its parameters.
+        """
+        query = "SELECT %s FROM %s WHERE %s <= :now" % (key, table, deadline)
+        params = {"now": now}
+
+        if titles is not None:
+            names = ["title%d" % i for i in range(len(titles))]
+            query += " AND %s IN (%s)" % (key, ", ".join(":" + name
+                                                         for name in names))
+            params.update(zip(names, titles))
+
+        return query, params
 
-        with self.db as db:
-            items = [(row[self.KEY_FIELD], self._load_json_voting(row[self.VALUE_FIELD]))
-                     for row in db[self.TABLE].all()]
+    def _forget(self, voting_titles):
+        for voting_title in voting_titles:
+            self.cache.delete(voting_title)
+            self.headers.delete(voting_title)
+            self._title_removed(voting_title)
 
-        return items
+    def get_checkpoint(self, name):
+        with self.transaction() as conn:
+            row = self._execute(conn, "SELECT queue_id, last_event_id "
+                                "FROM %s WHERE name = :name" %
+                                self.CHECKPOINTS_TABLE, name=name).first()
+
+        return (row[0], row[1]) if row else None
+
+    def set_checkpoint(self, name, queue_id, last_event_id):
+        with self.transaction() as conn:
+            self._execute(conn, """INSERT INTO %s (name, queue_id, last_event_id)
+                                   VALUES (:name, :queue_id, :last_event_id)
+                                   ON CONFLICT (name) DO UPDATE
+                                   SET queue_id = excluded.queue_id,
+                                       last_event_id = excluded.last_event_id""" %
+                          self.CHECKPOINTS_TABLE, name=name,
+                          queue_id=queue_id, last_event_id=last_event_id)
+
+    def get_subscriptions(self):
+        with self.transaction() as conn:
+            return {row[0] for row in self._execute(
+                conn, "SELECT stream FROM %s" % self.SUBSCRIPTIONS_TABLE)}
+
+    def set_subscriptions(self, streams):
+        with self.transaction() as conn:
+            self._execute(conn, "DELETE FROM %s" % self.SUBSCRIPTIONS_TABLE)
+            if streams:
+                self._execute(conn, "INSERT INTO %s (stream) VALUES (:stream)"
+                              % self.SUBSCRIPTIONS_TABLE,
+                              [{"stream": stream} for stream in streams])
+
+    def _stream(self, query, **params):
+        """Yield the rows of query through a server-side cursor, fetch_size
+            rows at a time. The cursor lives on its own connection, which is
+            held only while the iteration is running.
+        """
+
+        conn = self.db.engine.connect().execution_options(stream_results=True)
+        try:
+            result = self._execute(conn, query, **params)
+            while True:
+                rows = result.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row
+
+        finally:
+            conn.close()
 
     # iter methods
     def iterkeys(self):
+        return (row[0] for row in
+                self._stream("SELECT %s FROM %s" % (self.KEY_FIELD,
+                                                    self.TABLE)))
+
+    def itervalues(self):
+        return (voting_dict for _, voting_dict in self.iteritems())
+
+    def iteritems(self):
+        """Stream the votings and their ballots in a single query, each
+            voting's row followed by its ballots.
+        """
+
+        ballots = " UNION ALL ".join(
+            "SELECT voting_title, 1, NULL, NULL, voter, option_number, "
+            "choices FROM %s" % table for table in self.ballot_tables)
+        rows = self._stream("SELECT %s, 0, %s, %s, NULL, NULL, NULL FROM %s "
+                            "UNION ALL %s ORDER BY 1, 2" %
+                            (self.KEY_FIELD, self.VALUE_FIELD,
+                             self.DATA_FIELD, self.TABLE, ballots))
+
+        return self._with_ballots(rows)
+
+    def _with_ballots(self, rows):
+        voting_title = voting_dict = None
+
+        for row in rows:
+            if row[1] == 0:
+                if voting_dict is not None:
+                    yield voting_title, voting_dict
+
+                voting_title = row[0]
+                voting_dict = self._load_voting_row(row[2], row[3])
+                voting_dict.setdefault("people_who_have_voted", {})
+
+            elif row[0] == voting_title:
+                voting_dict["people_who_have_voted"][row[4]] = \
+                    self._ballot(row[5], row[6])
+
+        if voting_dict is not None:
+            yield voting_title, voting_dict
+
+
+class RelationalVotingTopics(VotingTopics):
+
+    """Voting topics stored in normalized topics/options/ballots tables."""
+
+    TOPICS_TABLE = "topics"
+    OPTIONS_TABLE = "options"
+    BALLOTS_TABLE = "ballots"
+    TABLES = [BALLOTS_TABLE, OPTIONS_TABLE, TOPICS_TABLE]
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS topics (
+            title TEXT PRIMARY KEY,
+            display_title TEXT NOT NULL,
+            owner_email TEXT,
+            deadline REAL,
+            stream TEXT,
+            subject TEXT,
+            mode TEXT)""",
+        """CREATE TABLE IF NOT EXISTS options (
+            topic TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            PRIMARY KEY (topic, number))""",
+        """CREATE TABLE IF NOT EXISTS ballots (
+            topic TEXT NOT NULL,
+            voter TEXT NOT NULL,
+            option_number INTEGER NOT NULL,
+            PRIMARY KEY (topic, voter))""",
+        """CREATE INDEX IF NOT EXISTS ballots_topic_option_idx
+            ON ballots (topic, option_number)""",
+    ]
+
+    # topics columns added after the first schema, with their dataset types
+    TOPICS_COLUMNS = [("deadline", "float"), ("stream", "text"),
+                      ("subject", "text"), ("mode", "text")]
+
+    def __init__(self, *args, **kwargs):
+        self._headers_lock = threading.Lock()
+        super(RelationalVotingTopics, self).__init__(*args, **kwargs)
+
+    def _create_schema(self):
+        from sqlalchemy import LargeBinary
+
+        with self.transaction() as conn:
+            for statement in self.SCHEMA:
+                self._execute(conn, statement)
+
+        topics = self.db.get_table(self.TOPICS_TABLE)
+        for column, column_type in self.TOPICS_COLUMNS:
+            topics.create_column(column, getattr(self.db.types, column_type))
+        self.db.get_table(self.BALLOTS_TABLE).create_column(
+            self.CHOICES_FIELD, LargeBinary)
+
+        with self.transaction() as conn:
+            self._execute(conn, """CREATE INDEX IF NOT EXISTS
+                                   topics_deadline_idx ON topics (deadline)""")
+
+    def _data_tables(self):
+        return self.TABLES
+
+    def __getitem__(self, voting_title):
+        voting_dict = self.cache.get(voting_title)
+
+        if voting_dict is None:
+            voting_dict = self._load_voting(voting_title)
+            self.cache.set(voting_title, voting_dict)
+
+        return self._copy_voting(voting_dict)
+
+    def header(self, voting_title):
+        header = self.headers.get(voting_title)
+
+        if header is None:
+            header = self._load_voting(voting_title, with_voters=False)
+            self.headers.set(voting_title, header)
+
+        with self._headers_lock:
+            return self._copy_header(header)
+
+    def _load_voting(self, voting_title, with_voters=True):
+
+        with self.transaction() as conn:
+            topic = self._execute(conn, """
+                SELECT display_title, owner_email, deadline, stream, subject,
+                       mode
+                FROM topics WHERE title = :title""",
+                                  title=voting_title).first()
+            if not topic:
+                raise KeyError(voting_title)
 
-        with self.db as db:
-            keys_iterator = (row[self.KEY_FIELD] for
-                             row in db[self.TABLE].all())
+            tallies = self._execute(conn, """
+                SELECT o.number, o.description, COUNT(b.voter) AS votes
+                FROM options o LEFT JOIN ballots b
+                  ON b.topic = o.topic AND b.option_number = o.number
+                WHERE o.topic = :title
+                GROUP BY o.number, o.description""", title=voting_title)
+            options = {row["number"]: [row["description"], int(row["votes"])]
+                       for row in tallies}
+            voting_dict = {"title": topic["display_title"],
+                           "owner_email": topic["owner_email"],
+                           "options": options}
+            for column, _ in self.TOPICS_COLUMNS:
+                if topic[column] is not None:
+                    voting_dict[column] = topic[column]
 
-        return keys_iterator
+            if with_voters:
+                ballots = self._execute(conn, """
+                    SELECT voter, option_number, choices FROM ballots
+                    WHERE topic = :title""", title=voting_title)
+                voting_dict["people_who_have_voted"] = {
+                    row["voter"]: self._ballot(row["option_number"],
+                                               row["choices"])
+                    for row in ballots}
+
+        return voting_dict
+
+    def __setitem__(self, voting_title, voting_dict):
+        """Replace a whole voting. Counts are derived from the voters."""
+
+        options = [{"topic": voting_title, "number": num,
+                    "description": opt[0]}
+                   for num, opt in voting_dict["options"].iteritems()]
+        ballots = [self._ballot_row(voting_title, voter, ballot)
+                   for voter, ballot in
+                   voting_dict.get("people_who_have_voted", {}).iteritems()]
+
+        with self.transaction() as conn:
+            self._delete_voting(conn, voting_title)
+            self._execute(conn, """
+                INSERT INTO topics (title, display_title, owner_email,
+                                    deadline, stream, subject, mode)
+                VALUES (:title, :display_title, :owner_email,
+                        :deadline, :stream, :subject, :mode)""",
+                          title=voting_title,
+                          display_title=voting_dict["title"],
+                          owner_email=voting_dict.get("owner_email"),
+                          deadline=voting_dict.get("deadline"),
+                          stream=voting_dict.get("stream"),
+                          subject=voting_dict.get("subject"),
+                          mode=voting_dict.get("mode"))
+            if options:
+                self._execute(conn, """
+                    INSERT INTO options (topic, number, description)
+                    VALUES (:topic, :number, :description)""", options)
+            if ballots:
+                self._execute(conn, """
+                    INSERT INTO ballots (topic, voter, option_number, choices)
+                    VALUES (:title, :voter, :option_number, :choices)""",
+                              ballots)
+
+        self.cache.delete(voting_title)
+        self.headers.delete(voting_title)
+        self._title_added(voting_title)
+
+    def _delete_voting(self, conn, voting_title):
+        for table in self.TABLES:
+            column = "title" if table == self.TOPICS_TABLE else "topic"
+            self._execute(conn, "DELETE FROM %s WHERE %s = :title" %
+                          (table, column), title=voting_title)
+
+    def __delitem__(self, voting_title):
+
+        with self.transaction() as conn:
+            self._delete_voting(conn, voting_title)
+
+        self.cache.delete(voting_title)
+        self.headers.delete(voting_title)
+        self._title_removed(voting_title)
+
+    def exists(self, voting_title):
+
+        with self.transaction() as conn:
+            row = self._execute(conn,
+                                "SELECT 1 FROM topics WHERE title = :title",
+                                title=voting_title).first()
+
+        return row is not None
+
+    def _load_titles(self):
+        with self.transaction() as conn:
+            return [row[0] for row in
+                    self._execute(conn, "SELECT title FROM topics")]
+
+    def deadlines(self):
+        with self.transaction() as conn:
+            return [(row[0], row[1]) for row in self._execute(
+                conn, "SELECT title, deadline FROM topics "
+                "WHERE deadline IS NOT NULL")]
+
+    def delete_expired(self, now, titles=None):
+        if titles is not None and not titles:
+            return []
+
+        expired, params = self._expired_query(self.TOPICS_TABLE, "title",
+                                              "deadline", now, titles)
+
+        with self.transaction() as conn:
+            titles = [row[0] for row in self._execute(conn, expired, **params)]
+            if titles:
+                for table in self.TABLES:
+                    column = "title" if table == self.TOPICS_TABLE else "topic"
+                    self._execute(conn, "DELETE FROM %s WHERE %s IN (%s)" %
+                                  (table, column, expired), **params)
+
+        self._forget(titles)
+
+        return titles
+
+    def cast_vote(self, voting_title, voter, option_number):
+        """Upsert voter's ballot and return the option it replaced, if any."""
+
+        return self.cast_votes(voting_title, [(voter, option_number)])[0]
+
+    def cast_votes(self, voting_title, ballots):
+        old_options = []
+
+        with self.transaction() as conn:
+            for voter, option_number in ballots:
+                ballot = self._ballot_row(voting_title, voter, option_number)
+
+                # a voter's first ballot is inserted; holding the topic's row
+                # keeps it from being deleted until the commit
+                inserted = self._execute(conn, self._locking("""
+                    INSERT INTO ballots (topic, voter, option_number, choices)
+                    SELECT title, :voter, :option_number, :choices
+                    FROM topics WHERE title = :title""", "SHARE") + """
+                    ON CONFLICT (topic, voter) DO NOTHING""",
+                                         **ballot).rowcount
+                if inserted:
+                    old_options.append(None)
+                    continue
+
+                # any other is locked before it's read, so concurrent votes
+                # by the same voter each replace the one before
+                old_ballot = self._execute(conn, self._locking("""
+                    SELECT option_number, choices FROM ballots
+                    WHERE topic = :title AND voter = :voter"""),
+                                           **ballot).first()
+                if old_ballot is None:
+                    raise KeyError(voting_title)
+
+                self._execute(conn, """
+                    UPDATE ballots
+                    SET option_number = :option_number, choices = :choices
+                    WHERE topic = :title AND voter = :voter""", **ballot)
+
+                old_options.append(self._ballot(old_ballot["option_number"],
+                                                old_ballot["choices"]))
+
+        self.cache.delete(voting_title)
+        for (_, option_number), old_option in zip(ballots, old_options):
+            self._count_vote(voting_title, option_number, old_option)
+
+        return old_options
+
+    def _locking(self, query, mode="UPDATE"):
+        """query locking the rows it reads FOR mode. sqlite has no row locks:
+            its writers hold the whole database from their first write.
+        """
+        if self.db.engine.dialect.name == "sqlite":
+            return query
+
+        return "%s FOR %s" % (query, mode)
+
+    def _count_vote(self, voting_title, option_number, old_option):
+        # counts are aggregates over every ballot, so a cached header is
+        # kept up to date rather than dropped
+        header = self.headers.get(voting_title)
+        if header is None:
+            return
+
+        option_number = first_choice(option_number)
+        if old_option is not None:
+            old_option = first_choice(old_option)
+
+        options = header["options"]
+        if option_number not in options or \
+                (old_option is not None and old_option not in options):
+            self.headers.delete(voting_title)
+            return
+
+        with self._headers_lock:
+            if old_option is not None:
+                header["options"][old_option][1] -= 1
+            header["options"][option_number][1] += 1
+
+    def add_option(self, voting_title, description):
+        """Append an option and return its number, or None if it's repeated."""
+
+        for attempt in range(DB_CAS_RETRIES + 1):
+            with self.transaction() as conn:
+                # polls may repeat an option, so repeats are looked for
+                # here rather than kept out by a constraint
+                added = self._execute(conn, """
+                    INSERT INTO options (topic, number, description)
+                    SELECT :topic, COALESCE(MAX(number), -1) + 1, :description
+                    FROM options WHERE topic = :topic
+                    HAVING NOT EXISTS (SELECT 1 FROM options
+                                       WHERE topic = :topic
+                                       AND description = :description)
+                    AND EXISTS (SELECT 1 FROM topics WHERE title = :topic)
+                    ON CONFLICT DO NOTHING""",
+                                      topic=voting_title,
+                                      description=description).rowcount
+
+                option = self._execute(conn, """
+                    SELECT number FROM options
+                    WHERE topic = :topic AND description = :description""",
+                                       topic=voting_title,
+                                       description=description).first()
+
+                if not (added or option) and not self._execute(
+                        conn, "SELECT 1 FROM topics WHERE title = :topic",
+                        topic=voting_title).first():
+                    raise KeyError(voting_title)
+
+            if added or option:
+                break
+
+            # a concurrent insert took the number, not the description
+            self.metrics.incr("db.cas_conflicts")
+            time.sleep(random.uniform(0, DB_CAS_BACKOFF * 2 ** attempt))
+
+        else:
+            raise VersionConflict(voting_title)
+
+        self.cache.delete(voting_title)
+        self.headers.delete(voting_title)
+
+        return option["number"] if added else None
+
+    # iter methods
+    def iterkeys(self):
+        return (row[0] for row in self._stream("SELECT title FROM topics"))
 
     def itervalues(self):
-        with self.db as db:
-            values_iterator = (self._load_json_voting(row[self.VALUE_FIELD]) for
-                               row in db[self.TABLE].all())
+        return (self[key] for key in self.iterkeys())
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.iterkeys())
+
+
+class InstrumentedStorage(VotingStorage):
+
+    """Wraps a storage and times every call to it in a metrics registry, as
+        "db.<method>" timers, underscores stripped. Anything outside the
+        VotingStorage interface is passed through untimed.
+    """
+
+    def __init__(self, storage, registry=metrics.registry):
+        self.storage = storage
+        self.metrics = registry
+
+    def _call(self, method, *args):
+        with self.metrics.timer("db." + method.strip("_")):
+            return getattr(self.storage, method)(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def __getitem__(self, voting_title):
+        return self._call("__getitem__", voting_title)
+
+    def __setitem__(self, voting_title, voting_dict):
+        return self._call("__setitem__", voting_title, voting_dict)
+
+    def __delitem__(self, voting_title):
+        return self._call("__delitem__", voting_title)
+
+    def __contains__(self, voting_title):
+        return self._call("__contains__", voting_title)
+
+    def header(self, voting_title):
+        return self._call("header", voting_title)
+
+    def reload(self, voting_title):
+        return self._call("reload", voting_title)
+
+    def cast_vote(self, voting_title, voter, option_number):
+        return self._call("cast_vote", voting_title, voter, option_number)
+
+    def cast_votes(self, voting_title, ballots):
+        return self._call("cast_votes", voting_title, ballots)
+
+    def add_option(self, voting_title, description):
+        return self._call("add_option", voting_title, description)
+
+    def clear(self):
+        return self._call("clear")
+
+    def deadlines(self):
+        return self._call("deadlines")
 
-        return values_iterator
+    def delete_expired(self, now, titles=None):
+        return self._call("delete_expired", now, titles)
+
+    def summary(self, limit=10):
+        return self._call("summary", limit)
+
+    def iterkeys(self):
+        return self._call("iterkeys")
+
+    def itervalues(self):
+        return self._call("itervalues")
 
     def iteritems(self):
-        with self.db as db:
-            items = ((row[self.KEY_FIELD], self._load_json_voting(row[self.VALUE_FIELD]))
-                     for row in db[self.TABLE].all())
+        return self._call("iteritems")
+
+    def get_checkpoint(self, name):
+        return self._call("get_checkpoint", name)
+
+    def set_checkpoint(self, name, queue_id, last_event_id):
+        return self._call("set_checkpoint", name, queue_id, last_event_id)
+
+    def get_subscriptions(self):
+        return self._call("get_subscriptions")
+
+    def set_subscriptions(self, streams):
+        return self._call("set_subscriptions", streams)
+
+
+BACKENDS = ["postgres", "sqlite", "memory"]
+
+
+def get_voting_topics(backend=DB_BACKEND, schema=DB_SCHEMA):
+    """Return the voting topics storage selected by DB_BACKEND and, for the
+        SQL backends, DB_SCHEMA.
+    """
+
+    if backend == "memory":
+        return MemoryVotingTopics()
+
+    elif backend not in BACKENDS:
+        raise ValueError("unknown DB_BACKEND: %s" % backend)
+
+    url = sqlite_url() if backend == "sqlite" else database_url()
+
+    if schema == "relational":
+        return RelationalVotingTopics(url)
+
+    return VotingTopics(url)
+
+
+def migrate_blob_votings(source, target):
+    """Copy every JSON voting in source that target doesn't have yet."""
+
+    migrated = 0
+    for voting_title, voting_dict in source.items():
+        if voting_title not in target:
+            target[voting_title] = voting_dict
+            migrated += 1
+
+    return migrated
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["migrate"]:
+        migrated = migrate_blob_votings(VotingTopics(),
+                                        RelationalVotingTopics())
+        print migrated, "votings migrated to the relational schema"
 
-        return items
+    else:
+        print "usage: python database.py migrate"
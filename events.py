@@ -0,0 +1,145 @@
+import os
+import threading
+import logging
+from cache import LRUCache
+import metrics
+
+"""
+Zulip event queue listener with durable checkpoints.
+
+EventListener long polls one event queue, like the zulip client's
+call_on_each_event, but saves the queue id and the last handled event id in
+the storage's checkpoints after every batch. A restarted bot resumes the same
+queue from there, so messages sent while it was down are delivered instead of
+lost with a freshly registered queue. Only when the server has dropped the
+queue (it expires after some minutes without polling) does it register a new
+one.
+
+Checkpoints are saved after the batch's after_batch callback returns, e.g. once
+the pipeline has handled the batch, so a crash replays at most the last batch.
+Messages are deduplicated by message id, which covers those replays within a
+process, server retries and a message arriving on two narrowed queues.
+
+A listener registered for other event_types, e.g. ["stream"], passes those
+events to the callback as they are. on_register is called with the result of
+every new registration, which holds the initial state of those event types,
+so a listener can catch up on what it missed before its queue existed.
+"""
+
+log = logging.getLogger(__name__)
+
+SEEN_MESSAGES = int(os.environ.get("SEEN_MESSAGES", 10000))
+RETRY_DELAY = 1.0
+
+
+class EventListener(object):
+
+    """Long polls one event queue, resuming from a saved checkpoint."""
+
+    def __init__(self, client, checkpoints=None, name="messages", narrow=None,
+                 seen=None, event_types=None, on_register=None,
+                 registry=metrics.registry):
+        self.client = client
+        self.checkpoints = checkpoints
+        self.name = name
+        self.narrow = narrow or []
+        self.event_types = event_types or ["message"]
+        self.on_register = on_register
+        self.seen = seen if seen is not None else LRUCache(SEEN_MESSAGES)
+        self.metrics = registry
+        self.stopped = threading.Event()
+        self.queue_id = None
+        self.last_event_id = -1
+
+    def stop(self):
+        self.stopped.set()
+
+    def resume(self):
+        '''Pick the saved queue back up. Returns whether there was one.'''
+        checkpoint = self.checkpoints and \
+            self.checkpoints.get_checkpoint(self.name)
+
+        if checkpoint:
+            self.queue_id, self.last_event_id = checkpoint
+            self.metrics.incr("events.resumed")
+
+        return bool(checkpoint)
+
+    def _register(self):
+        result = self.client.register(event_types=self.event_types,
+                                      narrow=self.narrow)
+
+        if result.get("result") != "success":
+            return False
+
+        self.queue_id = result["queue_id"]
+        self.last_event_id = result["last_event_id"]
+        self.metrics.incr("events.registered")
+        if self.on_register:
+            try:
+                self.on_register(result)
+            except Exception:
+                log.exception("on_register failed for queue %s", self.name)
+        self._save()
+
+        return True
+
+    def _save(self):
+        if self.checkpoints:
+            self.checkpoints.set_checkpoint(self.name, self.queue_id,
+                                            self.last_event_id)
+
+    def run(self, callback, after_batch=None):
+        '''Call callback on every new message until stop() is called.'''
+        self.resume()
+
+        while not self.stopped.is_set():
+            if self.queue_id is None and not self._register():
+                self.stopped.wait(RETRY_DELAY)
+                continue
+
+            result = self.client.get_events(queue_id=self.queue_id,
+                                            last_event_id=self.last_event_id)
+
+            if result.get("result") != "success":
+                if result.get("code") == "BAD_EVENT_QUEUE_ID":
+                    # the server dropped the queue, events since are lost
+                    self.metrics.incr("events.queue_expired")
+                    self.queue_id = None
+                else:
+                    self.stopped.wait(RETRY_DELAY)
+                continue
+
+            events = result.get("events", [])
+            for event in events:
+                self.last_event_id = max(self.last_event_id, event["id"])
+                if event["type"] == "message":
+                    self._deliver(event["message"], callback)
+                elif event["type"] in self.event_types:
+                    self._handle(event, callback)
+
+            if events:
+                if after_batch:
+                    after_batch()
+                self._save()
+
+    def _deliver(self, msg, callback):
+        if not self.seen.add(msg["id"]):
+            self.metrics.incr("events.duplicates")
+            return
+
+        self.metrics.incr("events.messages")
+        try:
+            callback(msg)
+        except Exception:
+            self.metrics.incr("events.errors")
+            log.exception("callback failed on message %s", msg.get("id"))
+
+    def _handle(self, event, callback):
+        self.metrics.incr("events.other")
+        try:
+            callback(event)
+        except Exception:
+            self.metrics.incr("events.errors")
+            log.exception("callback failed on %s event %s", event["type"],
+                          event["id"])
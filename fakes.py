@@ -0,0 +1,189 @@
+import collections
+import itertools
+import threading
+from database import InstrumentedStorage
+
+"""
+In-process stand-ins for the Zulip API, used by the tests and benchmarks.
+"""
+
+
+class FakeEventServer(object):
+
+    """Zulip's event queues: each registered queue gets the messages posted
+        after it was registered (and the backlog) that match its narrow, and
+        keeps them until a get_events call acknowledges them. Queues outlive
+        their clients until expire() is called. Queues registered for "stream"
+        events get the realm's streams on registration and an event for every
+        stream created after.
+    """
+
+    def __init__(self, backlog=None, poll_timeout=0.01, streams=None):
+        self.queues = {}
+        self.narrows = []
+        self.streams = list(streams or [])
+        self.poll_timeout = poll_timeout
+        self._message_ids = itertools.count(1)
+        self._queue_ids = itertools.count(1)
+        self._changed = threading.Condition()
+        self.backlog = [self._with_id(msg) for msg in backlog or []]
+
+    def _with_id(self, msg):
+        msg = dict(msg)
+        msg.setdefault("id", next(self._message_ids))
+        return msg
+
+    def register(self, event_types=None, narrow=None):
+        with self._changed:
+            queue_id = "queue-%d" % next(self._queue_ids)
+            event_types = event_types or ["message", "stream"]
+            queue = {"narrow": narrow or [], "event_types": event_types,
+                     "events": [], "next_id": 0}
+            self.queues[queue_id] = queue
+            self.narrows.append(narrow or [])
+
+            for msg in self.backlog:
+                self._append(queue, msg)
+
+            result = {"result": "success", "queue_id": queue_id,
+                      "last_event_id": -1}
+            if "stream" in event_types:
+                result["streams"] = [{"name": name} for name in self.streams]
+
+        return result
+
+    def post(self, msg):
+        '''Deliver msg to every matching queue, returns its message id.'''
+        msg = self._with_id(msg)
+
+        with self._changed:
+            for queue in self.queues.values():
+                self._append(queue, msg)
+            self._changed.notify_all()
+
+        return msg["id"]
+
+    def create_stream(self, name):
+        with self._changed:
+            self.streams.append(name)
+            for queue in self.queues.values():
+                if "stream" in queue["event_types"]:
+                    self._add_event(queue, {"type": "stream", "op": "create",
+                                            "streams": [{"name": name}]})
+            self._changed.notify_all()
+
+    def _append(self, queue, msg):
+        if "message" in queue["event_types"] and \
+                all(self._matches(msg, operator, operand)
+                    for operator, operand in queue["narrow"]):
+            self._add_event(queue, {"type": "message", "message": dict(msg)})
+
+    @staticmethod
+    def _add_event(queue, event):
+        event["id"] = queue["next_id"]
+        queue["events"].append(event)
+        queue["next_id"] += 1
+
+    @staticmethod
+    def _matches(msg, operator, operand):
+        if operator == "is" and operand == "private":
+            return msg["type"] == "private"
+
+        elif operator == "search":
+            return operand.lower() in msg["content"].lower()
+
+        raise ValueError("unsupported narrow: %s %s" % (operator, operand))
+
+    def get_events(self, queue_id, last_event_id):
+        with self._changed:
+            if queue_id not in self.queues:
+                return {"result": "error", "code": "BAD_EVENT_QUEUE_ID",
+                        "msg": "Bad event queue id: %s" % queue_id}
+
+            queue = self.queues[queue_id]
+            queue["events"] = [event for event in queue["events"]
+                               if event["id"] > last_event_id]
+
+            if not queue["events"]:
+                self._changed.wait(self.poll_timeout)
+
+            return {"result": "success", "events": list(queue["events"])}
+
+    def expire(self, queue_id):
+        with self._changed:
+            self.queues.pop(queue_id, None)
+
+
+class CountingStorage(InstrumentedStorage):
+
+    """Wraps a storage and counts the calls made to it, by method. The
+        dictionary methods VotingStorage builds on the others count as the
+        calls they make.
+    """
+
+    def __init__(self, storage):
+        super(CountingStorage, self).__init__(storage)
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, method, *args):
+        with self._lock:
+            self.calls[method] += 1
+        return getattr(self.storage, method)(*args)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class FakeZulipClient(object):
+
+    """Records outgoing messages and replays a list of incoming events, either
+        directly or through the event queues of server.
+    """
+
+    def __init__(self, events=None, server=None):
+        self.events = events or []
+        self.server = server or FakeEventServer(self.events)
+        self.sent = []
+        self.updated = []
+        self.subscriptions = []
+        self._lock = threading.Lock()
+
+    def add_subscriptions(self, streams):
+        self.subscriptions.extend(streams)
+        return {"result": "success"}
+
+    def get_streams(self):
+        return {"result": "success",
+                "streams": [{"name": name} for name in self.server.streams]}
+
+    def send_message(self, msg):
+        with self._lock:
+            self.sent.append(dict(msg))
+            return {"result": "success", "id": len(self.sent)}
+
+    def update_message(self, msg):
+        with self._lock:
+            self.updated.append(dict(msg))
+        return {"result": "success"}
+
+    def call_on_each_message(self, callback):
+        for event in self.events:
+            callback(event)
+
+    def register(self, event_types=None, narrow=None):
+        return self.server.register(event_types, narrow)
+
+    def get_events(self, queue_id, last_event_id):
+        return self.server.get_events(queue_id, last_event_id)
+
+
+def stream_message(content, sender_email, stream="voting", subject="polls"):
+    return {"type": "stream", "content": content,
+            "sender_email": sender_email, "display_recipient": stream,
+            "subject": subject}
+
+
+def private_message(content, sender_email):
+    return {"type": "private", "content": content,
+            "sender_email": sender_email}
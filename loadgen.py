@@ -0,0 +1,164 @@
+from __future__ import unicode_literals
+import random
+import time
+from database import MemoryVotingTopics
+from fakes import CountingStorage, FakeZulipClient, private_message, \
+    stream_message
+from voting_bot import VotingBot
+
+"""
+Load generator for end to end VotingBot benchmarks.
+
+A workload is a function of the number of messages returning (setup, load):
+messages that get the storage into shape, which aren't measured, and the
+messages under test. run_workload feeds both to VotingBot.respond on a bot
+with a FakeZulipClient and a storage wrapped in CountingStorage, and returns
+a dictionary of results: throughput, handler latency percentiles and storage
+calls per message, in total and by method.
+
+Workloads:
+
+"create_storm": every message creates a new poll.
+"hot_poll": every message is a public vote on the same poll, a fifth of them
+            changing an earlier vote.
+"cold_polls": public votes spread over one poll per ten messages.
+"private_votes": private message votes on one poll.
+
+adversarial_messages is a corpus of message contents, without the key word,
+shaped to make a backtracking parser work as hard as it can, plus random
+ones made of the parser's own tokens.
+"""
+
+KEY_WORD = "VotingBot"
+OPTIONS = ["Pizza", "Tacos", "Sushi", "Curry"]
+
+
+def _voter(i):
+    return "voter%d@hi.com" % i
+
+
+def _new_poll(title, owner="owner@hi.com"):
+    return stream_message("%s %s: %s" % (KEY_WORD, title, ", ".join(OPTIONS)),
+                          owner)
+
+
+def create_storm(messages):
+    return [], [_new_poll("poll %d" % i, _voter(i)) for i in xrange(messages)]
+
+
+def hot_poll(messages):
+    # voters come back to change their vote every fifth message
+    voters = max(1, messages * 4 // 5)
+    return [_new_poll("hot")], [
+        stream_message("%s hot: %d" % (KEY_WORD, i % len(OPTIONS)),
+                       _voter(i % voters)) for i in xrange(messages)]
+
+
+def cold_polls(messages):
+    polls = max(1, messages // 10)
+    # stride over the polls so consecutive votes hit different ones
+    return [_new_poll("cold %d" % i) for i in xrange(polls)], [
+        stream_message("%s cold %d: %d" % (KEY_WORD, i * 7 % polls,
+                                           i % len(OPTIONS)), _voter(i))
+        for i in xrange(messages)]
+
+
+def private_votes(messages):
+    return [_new_poll("lunch")], [
+        private_message("lunch\n%d" % (i % len(OPTIONS)), _voter(i))
+        for i in xrange(messages)]
+
+
+WORKLOADS = {
+    "create_storm": create_storm,
+    "hot_poll": hot_poll,
+    "cold_polls": cold_polls,
+    "private_votes": private_votes,
+}
+
+
+# shapes that repeat a piece up to the wanted length
+ADVERSARIAL = {
+    "long_title": lambda n: " " + "a" * n + ": x, y",
+    "many_lines": lambda n: " t" + "\noption" * (n // 7),
+    "many_options": lambda n: " t: " + "o," * (n // 2),
+    "words_without_colon": lambda n: " " + "ab " * (n // 3) + "cd",
+    "long_number": lambda n: " t: " + "1" * n,
+    "number": lambda n: " 5",
+    "spaced_number": lambda n: "  5",
+    "long_ballot": lambda n: " t: " + "1," * (n // 2) + "1",
+    "spaced_ballot": lambda n: " t" + " 1," * (n // 3) + " 1",
+    "broken_ballot": lambda n: " t" + " 1," * (n // 3) + "x",
+    "colons": lambda n: " " + ":" * n,
+    "spaces": lambda n: " t" + " " * n + "x",
+    "spaced_title": lambda n: " t" + " " * n + "[ranked]: a, b",
+    "adds": lambda n: " t" + " add" * (n // 4),
+    "results": lambda n: " t" + " results" * (n // 8),
+    "durations": lambda n: " t" + " for 2" * (n // 6) + "h: a",
+    "unicode": lambda n: " caf\u00e9 \u2713" * (n // 7) + ": \u00fc, \u00f1",
+}
+
+TOKENS = [" ", ":", ",", ">", "\n", "0", "12", "add", "results", "help",
+          "[ranked]", "[approval]", " for 2h", "lunch", "\u00e9"]
+
+
+def adversarial_messages(length, fuzz=100, seed=0):
+    '''(name, content) pairs of about length characters each.'''
+    messages = [(name, make(length)[:length + 20])
+                for name, make in sorted(ADVERSARIAL.iteritems())]
+
+    rng = random.Random(seed)
+    for i in xrange(fuzz):
+        content = []
+        size = 0
+        while size < length:
+            token = rng.choice(TOKENS)
+            content.append(token)
+            size += len(token)
+        messages.append(("fuzz_%d" % i, "".join(content)))
+
+    return messages
+
+
+def percentile(ordered, fraction):
+    '''Nearest rank percentile of an already sorted list.'''
+    if not ordered:
+        return 0.0
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_workload(name, messages=1000, storage=None):
+    '''Replay workload name through VotingBot.respond and measure it.'''
+    storage = CountingStorage(storage or MemoryVotingTopics())
+    client = FakeZulipClient()
+    bot = VotingBot("voting-bot@hi.com", "key", KEY_WORD, ["voting"],
+                    client=client, voting_topics=storage)
+
+    setup, load = WORKLOADS[name](messages)
+    for msg in setup:
+        bot.respond(msg)
+
+    storage.calls.clear()
+    replies = len(client.sent)
+    latencies = []
+
+    start = time.time()
+    for msg in load:
+        handled = time.time()
+        bot.respond(msg)
+        latencies.append(time.time() - handled)
+    elapsed = time.time() - start
+
+    latencies.sort()
+    db_calls = storage.total_calls()
+    return {"workload": name,
+            "messages": len(load),
+            "replies": len(client.sent) - replies,
+            "seconds": elapsed,
+            "messages_per_second": len(load) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "db_calls_per_message": float(db_calls) / max(1, len(load)),
+            "db_calls": dict(storage.calls)}
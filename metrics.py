@@ -0,0 +1,217 @@
+import json
+import logging
+import re
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+"""
+Process wide counters, gauges and timers for the bot.
+
+Everything is registered by name on a Metrics object; the module level
+`registry` is the one the bot and its helpers report to unless they are handed
+another one (tests do that to get a clean slate).
+
+A registry can be read in the Prometheus text format, served over HTTP by
+MetricsServer (METRICS_PORT), or logged as JSON every few seconds by
+StatsReporter (STATS_INTERVAL).
+"""
+
+log = logging.getLogger(__name__)
+
+
+class Timer(object):
+
+    """Count, total and max of observed durations, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        return {"count": self.count, "total": self.total,
+                "mean": self.mean, "max": self.max}
+
+
+class _Timing(object):
+
+    # a plain class, generator based context managers cost several times more
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.time() - self.start)
+
+
+class Metrics(object):
+
+    """Thread safe registry of named counters, gauges and timers."""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        '''Set a gauge to a value, or to a callable evaluated on snapshot.
+        '''
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self.timers:
+                self.timers[name] = Timer()
+            self.timers[name].observe(seconds)
+
+    def timer(self, name):
+        '''Context manager observing the time spent in its block.'''
+        return _Timing(self, name)
+
+    def snapshot(self):
+        with self._lock:
+            gauges = dict(self.gauges)
+            snapshot = {"counters": dict(self.counters),
+                        "timers": {name: timer.snapshot() for name, timer
+                                   in self.timers.iteritems()}}
+
+        snapshot["gauges"] = {name: value() if callable(value) else value
+                              for name, value in gauges.iteritems()}
+
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+
+    def prometheus(self, prefix="votingbot"):
+        return prometheus_text(self.snapshot(), prefix)
+
+
+registry = Metrics()
+
+
+def _metric_name(prefix, name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "%s_%s" % (prefix, name))
+
+
+def prometheus_text(snapshot, prefix="votingbot"):
+    '''Prometheus text exposition of a snapshot. Timers become the _count
+        and _sum of a summary in seconds plus a _max gauge.
+    '''
+    lines = []
+
+    for name, value in sorted(snapshot["counters"].iteritems()):
+        name = _metric_name(prefix, name) + "_total"
+        lines.extend(["# TYPE %s counter" % name, "%s %s" % (name, value)])
+
+    for name, value in sorted(snapshot["gauges"].iteritems()):
+        name = _metric_name(prefix, name)
+        lines.extend(["# TYPE %s gauge" % name, "%s %s" % (name, value)])
+
+    for name, timer in sorted(snapshot["timers"].iteritems()):
+        name = _metric_name(prefix, name) + "_seconds"
+        lines.extend(["# TYPE %s summary" % name,
+                      "%s_count %d" % (name, timer["count"]),
+                      "%s_sum %r" % (name, timer["total"]),
+                      "# TYPE %s_max gauge" % name,
+                      "%s_max %r" % (name, timer["max"])])
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.server.registry.prometheus()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/profile" and self.server.profiler:
+            body = self.server.profiler.collapsed()
+            content_type = "text/plain"
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+
+    """Serves /metrics in the Prometheus text format, and /profile with the
+        sampling profiler's stacks when there is one, from a daemon thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, registry=registry, profiler=None, host=""):
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.registry = registry
+        self.profiler = profiler
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StatsReporter(object):
+
+    """Logs a JSON snapshot of a registry every interval seconds."""
+
+    def __init__(self, interval, registry=registry, logger=log):
+        self.interval = interval
+        self.registry = registry
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.logger.info("stats %s", json.dumps(self.registry.snapshot(),
+                                                    sort_keys=True))
@@ -0,0 +1,188 @@
+import Queue
+import threading
+import time
+import logging
+import metrics
+
+"""
+Outbound message dispatch for VotingBot.
+
+OutboundDispatcher sends messages from a single background thread so handlers
+never wait on Zulip. Sends are paced by a token bucket sized to Zulip's per
+user rate limit, and a send that still hits the limit is retried after the
+server's retry-after delay.
+
+Messages sent with a coalesce key replace any pending message with the same
+key for coalesce_window seconds, so a burst of "new option" reposts for one
+topic goes out as a single message carrying the latest option list.
+"""
+
+log = logging.getLogger(__name__)
+
+# Zulip allows 200 requests per minute per user by default
+ZULIP_SEND_RATE = 200 / 60.0
+ZULIP_SEND_BURST = 20
+RATE_LIMIT_RETRIES = 3
+
+_STOP = object()
+
+
+class TokenBucket(object):
+
+    """Blocking token bucket: rate tokens per second, up to capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+
+    def acquire(self):
+        '''Take one token, sleeping until one is available.
+            Returns the time spent waiting.
+        '''
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+
+        wait = (1 - self.tokens) / self.rate
+        time.sleep(wait)
+        self.tokens = 0
+        self.last = time.time()
+
+        return wait
+
+
+class OutboundDispatcher(object):
+
+    """Rate limited, coalescing sender in front of a zulip client."""
+
+    def __init__(self, client, rate=ZULIP_SEND_RATE, burst=ZULIP_SEND_BURST,
+                 coalesce_window=0.5, queue_size=1000,
+                 registry=metrics.registry):
+        self.client = client
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.coalesce_window = coalesce_window
+        self.metrics = registry
+        self.queue = Queue.Queue(queue_size)
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.metrics.gauge("outbound.queue_depth", self.queue.qsize)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def send(self, msg, coalesce_key=None):
+        '''Queue a copy of msg. With a coalesce_key, a later message with the
+            same key sent within coalesce_window replaces this one.
+        '''
+        msg = dict(msg)
+        self.metrics.incr("outbound.requested")
+
+        if coalesce_key is None:
+            self.queue.put(msg)
+            return
+
+        with self._lock:
+            if coalesce_key in self.pending:
+                self.pending[coalesce_key][1] = msg
+                self.metrics.incr("outbound.coalesced")
+                return
+
+            deadline = time.time() + self.coalesce_window
+            self.pending[coalesce_key] = [deadline, msg]
+
+        # wake the sender so it knows about the new deadline
+        self.queue.put(None)
+
+    def _due(self, force=False):
+        now = time.time()
+        with self._lock:
+            due = [key for key, (deadline, _) in self.pending.iteritems()
+                   if force or deadline <= now]
+            msgs = [self.pending.pop(key)[1] for key in due]
+            next_deadline = min([deadline for deadline, _
+                                 in self.pending.itervalues()] or [None])
+
+        return msgs, next_deadline
+
+    def _run(self):
+        timeout = None
+
+        while True:
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                item, got_item = None, False
+            else:
+                got_item = True
+
+            try:
+                if item is _STOP:
+                    return
+
+                if item is not None:
+                    self._deliver(item)
+
+                msgs, next_deadline = self._due()
+                for msg in msgs:
+                    self._deliver(msg)
+
+            finally:
+                if got_item:
+                    self.queue.task_done()
+
+            timeout = (max(0, next_deadline - time.time())
+                       if next_deadline is not None else None)
+
+    def _deliver(self, msg):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            if self.bucket:
+                self.metrics.observe("outbound.rate_limit_wait",
+                                     self.bucket.acquire())
+
+            try:
+                with self.metrics.timer("outbound.send"):
+                    result = self.client.send_message(msg)
+            except Exception:
+                self.metrics.incr("outbound.errors")
+                log.exception("send failed to %s", msg.get("to"))
+                return
+
+            if not self._rate_limited(result):
+                self.metrics.incr("outbound.sent")
+                return
+
+            self.metrics.incr("outbound.rate_limited")
+            time.sleep(float(result.get("retry-after", 1)))
+
+        self.metrics.incr("outbound.errors")
+
+    @staticmethod
+    def _rate_limited(result):
+        return isinstance(result, dict) and result.get("result") == "error" \
+            and result.get("code") == "RATE_LIMIT_HIT"
+
+    def flush(self):
+        '''Send everything pending now and wait until it's been delivered.'''
+        msgs, _ = self._due(force=True)
+        for msg in msgs:
+            self.queue.put(msg)
+
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(_STOP)
+        self._thread.join()
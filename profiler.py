@@ -0,0 +1,70 @@
+import collections
+import os
+import sys
+import threading
+import metrics
+
+"""
+Sampling profiler for a running bot.
+
+SamplingProfiler wakes up every interval seconds and records the stack of
+every other thread, as "file:function" frames joined outermost first. The
+counts are kept in the collapsed format flame graph tools read, one
+"frame;frame;frame count" line per stack. It costs nothing until it's
+started; PROFILE_INTERVAL turns it on for the bot, whose metrics server then
+serves the stacks at /profile.
+"""
+
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0))
+
+
+class SamplingProfiler(object):
+
+    """Counts the stacks of every thread, sampled on a timer thread."""
+
+    def __init__(self, interval=0.01, max_depth=40, registry=metrics.registry):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.metrics = registry
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        own_thread = threading.current_thread().ident
+        stacks = [self._stack(frame) for thread_id, frame
+                  in sys._current_frames().items() if thread_id != own_thread]
+
+        with self._lock:
+            self.stacks.update(stacks)
+        self.metrics.incr("profiler.samples")
+
+    def _stack(self, frame):
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            code = frame.f_code
+            frames.append("%s:%s" % (os.path.basename(code.co_filename),
+                                     code.co_name))
+            frame = frame.f_back
+
+        return ";".join(reversed(frames))
+
+    def collapsed(self):
+        '''Sampled stacks in the collapsed format, most frequent first.'''
+        with self._lock:
+            stacks = self.stacks.most_common()
+
+        return "".join("%s %d\n" % (stack, count) for stack, count in stacks)
@@ -0,0 +1,122 @@
+import heapq
+import logging
+import threading
+import time
+import metrics
+
+"""
+Poll deadlines.
+
+PollScheduler keeps every poll's deadline in a heap and runs one thread that
+sleeps until the earliest of them. When deadlines pass it calls its callback
+once with all the titles that are due, and the time it checked them at, so
+the callback can publish their results and reap the rows in one go.
+Rescheduling a poll or cancelling it leaves its old heap entry behind to be
+skipped when it comes up, so both are O(log n) and never scan the heap.
+
+The scheduler only lives in memory; the bot rebuilds it from the storage's
+deadlines when it starts, and deadlines that passed while it was down fire
+right away.
+"""
+
+log = logging.getLogger(__name__)
+
+
+class PollScheduler(object):
+
+    """Calls callback(titles, now) from its thread as poll deadlines pass."""
+
+    def __init__(self, callback, clock=time.time, registry=metrics.registry):
+        self.callback = callback
+        self.clock = clock
+        self.metrics = registry
+        self.deadlines = {}
+        self.heap = []
+        self.stopped = False
+        self._changed = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, title, deadline):
+        with self._changed:
+            self.deadlines[title] = deadline
+            heapq.heappush(self.heap, (deadline, title))
+
+            if self.heap[0] == (deadline, title):
+                self._changed.notify()
+
+    def cancel(self, title):
+        with self._changed:
+            self.deadlines.pop(title, None)
+
+    def rebuild(self, deadlines):
+        '''Schedule every (title, deadline) pair, e.g. from the storage.'''
+        with self._changed:
+            for title, deadline in deadlines:
+                self.deadlines[title] = deadline
+            self.heap = [(deadline, title) for title, deadline
+                         in self.deadlines.iteritems()]
+            heapq.heapify(self.heap)
+            self._changed.notify()
+
+    def next_deadline(self):
+        with self._changed:
+            self._drop_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def _drop_stale(self):
+        heap = self.heap
+        while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def due(self, now):
+        '''Unschedule and return the titles whose deadline is now or past.'''
+        titles = []
+
+        with self._changed:
+            heap = self.heap
+            while heap and heap[0][0] <= now:
+                deadline, title = heapq.heappop(heap)
+                if self.deadlines.get(title) == deadline:
+                    del self.deadlines[title]
+                    titles.append(title)
+
+        return titles
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self._changed:
+            self.stopped = True
+            self._changed.notify()
+
+    def run(self):
+        while True:
+            with self._changed:
+                while not self.stopped:
+                    self._drop_stale()
+                    if not self.heap:
+                        self._changed.wait()
+                    elif self.heap[0][0] > self.clock():
+                        self._changed.wait(self.heap[0][0] - self.clock())
+                    else:
+                        break
+
+                if self.stopped:
+                    return
+
+            now = self.clock()
+            titles = self.due(now)
+            if not titles:
+                continue
+
+            self.metrics.incr("scheduler.fired", len(titles))
+            try:
+                self.callback(titles, now)
+            except Exception:
+                log.exception("deadline callback failed for %s", titles)
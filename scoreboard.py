@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+import metrics
+
+"""
+Live scoreboards.
+
+Scoreboard keeps one message per poll showing its current results. update()
+marks a poll as changed; the poll's message is rendered and edited once its
+interval is up, so however many votes come in, a poll gets at most one edit
+per interval and the results are only rendered for that edit. The first
+update of a poll posts its message, and every edit after changes it in place.
+
+Edits are made from the scoreboard's own thread, straight through the zulip
+client: they need the posted message's id back, and are already limited to
+one per poll per interval. A rate limited or failed edit is tried again an
+interval later, and a message that can't be edited any more (e.g. it was
+deleted) is posted again. Message ids only live in memory, so after a
+restart each poll's next update posts a new message.
+"""
+
+log = logging.getLogger(__name__)
+
+SCOREBOARD_INTERVAL = float(os.environ.get("SCOREBOARD_INTERVAL", 2.0))
+
+
+class Scoreboard(object):
+
+    """Posts render(title), a message dict, for every updated poll and edits
+        it in place, at most once per poll per interval. render raises
+        KeyError for polls that are gone.
+    """
+
+    def __init__(self, client, render, interval=SCOREBOARD_INTERVAL,
+                 clock=time.time, registry=metrics.registry):
+        self.client = client
+        self.render = render
+        self.interval = interval
+        self.clock = clock
+        self.metrics = registry
+        # title -> (message id, content it shows)
+        self.messages = {}
+        # title -> when its pending edit is due
+        self.dirty = {}
+        self.stopped = False
+        self._changed = threading.Condition()
+        self._publish_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def update(self, title, delay=None):
+        '''Have the poll's message show its results in delay seconds, the
+            interval by default. Updates before then are coalesced into it.
+        '''
+        with self._changed:
+            if title in self.dirty:
+                self.metrics.incr("scoreboard.coalesced")
+                return
+
+            due = self.clock() + (self.interval if delay is None else delay)
+            self.dirty[title] = due
+            if due <= min(self.dirty.itervalues()):
+                self._changed.notify()
+
+    def forget(self, title):
+        '''Stop updating a closed poll's message.'''
+        with self._publish_lock, self._changed:
+            self.dirty.pop(title, None)
+            self.messages.pop(title, None)
+
+    def due(self, now):
+        '''Unmark and return the polls whose edit is due at now.'''
+        with self._changed:
+            titles = [title for title, due in self.dirty.iteritems()
+                      if due <= now]
+            for title in titles:
+                del self.dirty[title]
+
+        return titles
+
+    def flush(self):
+        '''Publish every pending update now.'''
+        for title in self.due(float("inf")):
+            self.publish(title)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self._changed:
+            self.stopped = True
+            self._changed.notify()
+
+    def run(self):
+        while True:
+            with self._changed:
+                while not self.stopped:
+                    if not self.dirty:
+                        self._changed.wait()
+                        continue
+
+                    wait = min(self.dirty.itervalues()) - self.clock()
+                    if wait <= 0:
+                        break
+                    self._changed.wait(wait)
+
+                if self.stopped:
+                    return
+
+            for title in self.due(self.clock()):
+                try:
+                    self.publish(title)
+                except Exception:
+                    log.exception("scoreboard update failed for %s", title)
+                    self.update(title)
+
+    def publish(self, title):
+        with self._publish_lock:
+            try:
+                msg = self.render(title)
+            except KeyError:
+                # closed in the meantime
+                self.messages.pop(title, None)
+                return
+
+            message_id, content = self.messages.get(title, (None, None))
+            if msg["content"] == content:
+                self.metrics.incr("scoreboard.unchanged")
+                return
+
+            with self.metrics.timer("scoreboard.send"):
+                if message_id is None:
+                    result = self.client.send_message(msg)
+                else:
+                    result = self.client.update_message(
+                        {"message_id": message_id,
+                         "content": msg["content"]})
+
+            if result.get("result") != "success":
+                self._failed(title, result)
+                return
+
+            if message_id is None:
+                message_id = result["id"]
+                self.metrics.incr("scoreboard.posted")
+            else:
+                self.metrics.incr("scoreboard.edited")
+            self.messages[title] = (message_id, msg["content"])
+
+    def _failed(self, title, result):
+        self.metrics.incr("scoreboard.errors")
+        log.warning("scoreboard update failed for %s: %s", title,
+                    result.get("msg"))
+
+        if result.get("code") != "RATE_LIMIT_HIT":
+            # post it again rather than keep failing to edit it
+            self.messages.pop(title, None)
+        self.update(title)
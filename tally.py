@@ -0,0 +1,330 @@
+from __future__ import unicode_literals
+from array import array
+from codec import ballot_choices
+
+"""
+Incrementally maintained vote counts for one poll.
+
+A Tally keeps the option counts in an array, the total number of votes and
+the options ranked by count (most votes first, lower option number first on a
+tie). Votes change counts by one, so keeping the ranking sorted only ever
+swaps an option past the neighbours it ties with: rendering results or
+finding the leader never re-aggregates ballots or sorts.
+
+ApprovalTally is the same for approval polls, where a ballot is a list of
+options that each get a vote. RunoffTally runs instant runoff rounds over
+ranked ballots. new_tally and tally_from_voting pick the class for a poll's
+"mode".
+"""
+
+# array typecodes have to be byte strings on python 2
+COUNTS = b"l"
+CHOICES = b"H"
+
+PLURALITY = "plurality"
+APPROVAL = "approval"
+RANKED = "ranked"
+
+RESULTS_HEADING = "The results are in!!!! "
+
+
+class Tally(object):
+
+    """Counts, total and ranking of a poll's options."""
+
+    __slots__ = ("title", "names", "counts", "total", "ranking", "positions")
+
+    def __init__(self, title, names, counts=None):
+        self.title = title
+        self.names = list(names)
+        self.counts = array(COUNTS, counts or [0] * len(self.names))
+        self.total = sum(self.counts)
+        self.ranking = array(COUNTS, sorted(range(len(self.names)),
+                                         key=lambda i: (-self.counts[i], i)))
+        self.positions = array(COUNTS, [0] * len(self.names))
+        for position, option in enumerate(self.ranking):
+            self.positions[option] = position
+
+    @classmethod
+    def from_voting(cls, voting):
+        '''Build a tally from a stored voting dictionary.'''
+        options = voting["options"]
+        numbers = sorted(options)
+
+        return cls(voting["title"], [options[num][0] for num in numbers],
+                   [options[num][1] for num in numbers])
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_option(self, name):
+        option = len(self.names)
+        self.names.append(name)
+        self.counts.append(0)
+        self.positions.append(len(self.ranking))
+        self.ranking.append(option)
+
+        # a new option has no votes, it belongs after every option with some
+        self._move_down(option)
+
+        return option
+
+    def vote(self, option, old_option=None):
+        '''Count a vote for option, taking it from old_option if the voter
+            is changing their vote.
+        '''
+        if old_option is not None:
+            self.counts[old_option] -= 1
+            self._move_down(old_option)
+        else:
+            self.total += 1
+
+        self.counts[option] += 1
+        self._move_up(option)
+
+    def _before(self, a, b):
+        return (self.counts[a], -a) > (self.counts[b], -b)
+
+    def _swap(self, i, j):
+        ranking = self.ranking
+        ranking[i], ranking[j] = ranking[j], ranking[i]
+        self.positions[ranking[i]] = i
+        self.positions[ranking[j]] = j
+
+    def _move_up(self, option):
+        i = self.positions[option]
+        while i > 0 and self._before(option, self.ranking[i - 1]):
+            self._swap(i, i - 1)
+            i -= 1
+
+    def _move_down(self, option):
+        i = self.positions[option]
+        last = len(self.ranking) - 1
+        while i < last and self._before(self.ranking[i + 1], option):
+            self._swap(i, i + 1)
+            i += 1
+
+    def leader(self):
+        '''(option number, name, votes) of the leading option, or None.'''
+        if not self.names:
+            return None
+
+        option = self.ranking[0]
+        return option, self.names[option], self.counts[option]
+
+    def ranked(self):
+        '''(option number, name, votes) for every option, most votes first.'''
+        return [(option, self.names[option], self.counts[option])
+                for option in self.ranking]
+
+    def render_results(self, heading=RESULTS_HEADING):
+        lines = [heading + "\nTopic: " + self.title]
+        lines.extend("{0} has {1} votes.".format(name, votes)
+                     for _, name, votes in self.ranked())
+
+        return "\n".join(lines)
+
+
+class ApprovalTally(Tally):
+
+    """Tally of an approval poll. total counts ballots, not votes."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_voting(cls, voting):
+        options = voting["options"]
+        ballots = voting.get("people_who_have_voted", {})
+        counts = array(COUNTS, [0] * len(options))
+        for ballot in ballots.itervalues():
+            for option in ballot_choices(ballot):
+                counts[option] += 1
+
+        tally = cls(voting["title"],
+                    [options[num][0] for num in sorted(options)], counts)
+        tally.total = len(ballots)
+
+        return tally
+
+    def vote(self, options, old_options=None):
+        '''Count a ballot approving options, in place of old_options if the
+            voter is changing their vote.
+        '''
+        if old_options is not None:
+            for option in ballot_choices(old_options):
+                self.counts[option] -= 1
+                self._move_down(option)
+        else:
+            self.total += 1
+
+        for option in ballot_choices(options):
+            self.counts[option] += 1
+            self._move_up(option)
+
+
+class RunoffTally(object):
+
+    """Instant runoff tally of a ranked poll.
+
+    A ballot ranks options, most preferred first. Identical rankings are kept
+    once, with a weight, and the distinct ones are packed end to end in one
+    array of option numbers. rounds() puts each ranking in the pile of its
+    highest option still running; eliminating an option only moves the
+    rankings in its pile, so every round together reads each packed option
+    at most once. The option with the fewest votes is eliminated, the higher
+    numbered one on a tie, until one has a majority of the ballots that still
+    rank a running option.
+    """
+
+    __slots__ = ("title", "names", "rankings", "choices", "starts", "weights",
+                 "total", "_rounds")
+
+    def __init__(self, title, names, ballots=()):
+        self.title = title
+        self.names = list(names)
+        # ranking tuple -> its index in starts and weights
+        self.rankings = {}
+        self.choices = array(CHOICES)
+        # ranking i is choices[starts[i]:starts[i + 1]]
+        self.starts = array(COUNTS, [0])
+        self.weights = array(COUNTS)
+        self.total = 0
+        self._rounds = None
+        for ballot in ballots:
+            self.vote(ballot)
+
+    @classmethod
+    def from_voting(cls, voting):
+        '''Build a tally from a stored voting dictionary.'''
+        options = voting["options"]
+
+        return cls(voting["title"],
+                   [options[num][0] for num in sorted(options)],
+                   voting.get("people_who_have_voted", {}).itervalues())
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_option(self, name):
+        self.names.append(name)
+        self._rounds = None
+
+        return len(self.names) - 1
+
+    def _ranking(self, ballot):
+        ranking = tuple(ballot_choices(ballot))
+        index = self.rankings.get(ranking)
+
+        if index is None:
+            index = self.rankings[ranking] = len(self.weights)
+            self.choices.extend(ranking)
+            self.starts.append(len(self.choices))
+            self.weights.append(0)
+
+        return index
+
+    def vote(self, ballot, old_ballot=None):
+        '''Count a ranked ballot, in place of old_ballot if the voter is
+            changing their vote.
+        '''
+        if old_ballot is not None:
+            self.weights[self._ranking(old_ballot)] -= 1
+        else:
+            self.total += 1
+
+        self.weights[self._ranking(ballot)] += 1
+        self._rounds = None
+
+    def rounds(self):
+        '''[(standings, eliminated)] for every round, standings being
+            (option number, name, votes) of the running options, most votes
+            first. The last round eliminates None and its first standing is
+            the winner.
+        '''
+        if self._rounds is None:
+            self._rounds = self._run_rounds()
+
+        return self._rounds
+
+    def _run_rounds(self):
+        choices, starts, weights = self.choices, self.starts, self.weights
+        running = bytearray(b"\x01" * len(self.names))
+        counts = array(COUNTS, [0] * len(self.names))
+        piles = [[] for _ in self.names]
+        # where in its ranking each ranking's current option is
+        positions = array(COUNTS, starts[:-1])
+
+        def place(ranking):
+            i, end = positions[ranking], starts[ranking + 1]
+            while i < end and not running[choices[i]]:
+                i += 1
+            positions[ranking] = i
+
+            if i < end:
+                piles[choices[i]].append(ranking)
+                counts[choices[i]] += weights[ranking]
+
+        for ranking in xrange(len(weights)):
+            if weights[ranking]:
+                place(ranking)
+
+        rounds = []
+        while True:
+            standings = sorted(((option, self.names[option], counts[option])
+                                for option in xrange(len(self.names))
+                                if running[option]),
+                               key=lambda standing: (-standing[2],
+                                                     standing[0]))
+            if not standings:
+                return rounds
+
+            votes = sum(standing[2] for standing in standings)
+            if len(standings) == 1 or standings[0][2] * 2 > votes:
+                rounds.append((standings, None))
+                return rounds
+
+            eliminated = standings[-1][0]
+            rounds.append((standings, eliminated))
+
+            running[eliminated] = 0
+            counts[eliminated] = 0
+            pile, piles[eliminated] = piles[eliminated], []
+            for ranking in pile:
+                place(ranking)
+
+    def leader(self):
+        '''(option number, name, votes) of the runoff winner, or None.'''
+        rounds = self.rounds()
+        if not rounds:
+            return None
+
+        return rounds[-1][0][0]
+
+    def render_results(self, heading=RESULTS_HEADING):
+        lines = [heading + "\nTopic: " + self.title]
+        rounds = self.rounds()
+
+        for number, (standings, eliminated) in enumerate(rounds, 1):
+            line = "Round {0}: {1}.".format(number, ", ".join(
+                "{0} {1}".format(name, votes) for _, name, votes in standings))
+            if eliminated is not None:
+                line += " {0} is eliminated.".format(self.names[eliminated])
+            lines.append(line)
+
+        if rounds:
+            _, name, votes = rounds[-1][0][0]
+            lines.append("Winner: {0} with {1} votes.".format(name, votes))
+
+        return "\n".join(lines)
+
+
+TALLIES = {PLURALITY: Tally, APPROVAL: ApprovalTally, RANKED: RunoffTally}
+
+
+def new_tally(mode, title, names):
+    '''Empty tally of a new poll in mode (None for plurality).'''
+    return TALLIES[mode or PLURALITY](title, names)
+
+
+def tally_from_voting(voting):
+    return TALLIES[voting.get("mode") or PLURALITY].from_voting(voting)
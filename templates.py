@@ -0,0 +1,143 @@
+from __future__ import unicode_literals
+import glob
+import io
+import os
+import threading
+import time
+from string import Formatter
+
+"""
+Reply templates for VotingBot.
+
+Templates loads every messages/*.md file once, keyed by file name without the
+extension, so help replies never touch the disk. With reload on, it checks the
+files' mtimes at most once every check_interval seconds and rereads the ones
+that changed, which lets the help text be edited on a running bot.
+
+Template is a str.format style string split into literal and field parts when
+it's built, so rendering one of the REPLIES is a single join.
+"""
+
+MESSAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "messages")
+TEMPLATE_RELOAD = os.environ.get("TEMPLATE_RELOAD", "") not in ("", "0")
+
+
+class Template(object):
+
+    """Precompiled template with {name} fields."""
+
+    __slots__ = ("text", "parts")
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = [(literal, field) for literal, field, _, _
+                      in Formatter().parse(text)]
+
+    def render(self, **fields):
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(unicode(fields[field]))
+
+        return "".join(out)
+
+
+OPTION_LINE = Template("\n {number}. {name}")
+RANGE_OPTION_LINE = Template("{number}. {name}")
+
+REPLIES = {
+    "new_topic": Template("{title}{options}"),
+    "new_option": Template("There is a new option in topic: {title}{options}"),
+    "repeated_option": Template("{option} is already an option in topic: "
+                                "{title}\nDo not attempt to repeat options!"),
+    "repeated_topic": Template("This topic already exists! "
+                               "Choose another name."),
+    "changed_vote": Template("You have changed your vote. \n"),
+    "private_vote": Template("One vote in this topic: {title} "
+                             "for this option: {option}"),
+    "public_vote": Template("You just voted for '{option}' in {title}"),
+    "deadline": Template("\nResults will be published in {duration}."),
+    "live_results": Template("Live results, updated as votes come in:"),
+    "out_of_range": Template("That option is not in the range of the voting "
+                             "options. Here are your options:  \n{options}"),
+    "single_choice": Template("This poll takes a single option. Here are "
+                              "your options:  \n{options}"),
+    "too_long": Template("That message is too long for me, please keep it "
+                         "under {limit} characters."),
+    "too_many_options": Template("A poll can have at most {limit} options."),
+    "approval_poll": Template("\nVote for every option you like, e.g. 0,2."),
+    "ranked_poll": Template("\nRank the options, favourite first, "
+                            "e.g. 2>0>1."),
+}
+
+
+def format_duration(seconds):
+    '''"2 days", "3 hours" or "90 minutes", rounded down.'''
+    for unit, size in [("day", 24 * 60 * 60), ("hour", 60 * 60),
+                       ("minute", 60)]:
+        count = int(seconds // size)
+        if count and (seconds % size == 0 or unit == "minute"):
+            return "%d %s%s" % (count, unit, "s" if count != 1 else "")
+
+    return "%d seconds" % seconds
+
+
+def render_options(names, line=OPTION_LINE, sep=""):
+    '''Numbered option list, names in option number order.'''
+    return sep.join(line.render(number=number, name=name)
+                    for number, name in enumerate(names))
+
+
+class Templates(object):
+
+    """messages/*.md contents, loaded once and optionally hot reloaded."""
+
+    def __init__(self, directory=MESSAGES_DIR, reload=TEMPLATE_RELOAD,
+                 check_interval=1.0):
+        self.directory = directory
+        self.reload = reload
+        self.check_interval = check_interval
+        self._files = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+
+        self.load()
+
+    def load(self):
+        '''(Re)read every template file whose mtime changed.'''
+        files = {}
+        for path in glob.glob(os.path.join(self.directory, "*.md")):
+            name = os.path.splitext(os.path.basename(path))[0]
+            mtime = os.path.getmtime(path)
+            cached = self._files.get(name)
+
+            if cached and cached[0] == mtime:
+                files[name] = cached
+            else:
+                with io.open(path, encoding="utf-8") as f:
+                    files[name] = (mtime, f.read())
+
+        self._files = files
+        self._checked = time.time()
+
+    def _maybe_reload(self):
+        if time.time() - self._checked < self.check_interval:
+            return
+
+        with self._lock:
+            if time.time() - self._checked >= self.check_interval:
+                self.load()
+
+    def __getitem__(self, name):
+        if self.reload:
+            self._maybe_reload()
+
+        return self._files[name][1]
+
+    def __contains__(self, name):
+        return name in self._files
+
+    def render(self, name, **fields):
+        return REPLIES[name].render(**fields)
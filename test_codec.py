@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import json
+import unittest
+import nose
+from codec import decode_voting, encode_voting
+
+
+def voting(voters=0, options=2):
+    return {"title": "Café",
+            "owner_email": "owner@hi.com",
+            "options": {i: ["option ✓ %d" % i, voters // options + (
+                i < voters % options)] for i in range(options)},
+            "people_who_have_voted": {"voter%d@hi.com" % i: i % options
+                                      for i in range(voters)}}
+
+
+class CodecTest(unittest.TestCase):
+
+    def assertRoundTrip(self, voting_dict):
+        self.assertEqual(decode_voting(encode_voting(voting_dict)),
+                         voting_dict)
+
+    def test_round_trip(self):
+        self.assertRoundTrip(voting())
+        self.assertRoundTrip(voting(voters=1000, options=7))
+        self.assertRoundTrip(voting(options=0))
+
+    def test_wide_ballots(self):
+        self.assertRoundTrip(voting(voters=3, options=70000))
+
+    def test_owner_and_other_keys(self):
+        vote = voting(voters=3)
+        vote["owner_email"] = None
+        vote["deadline"] = 1500000000
+        self.assertRoundTrip(vote)
+
+        del vote["owner_email"]
+        self.assertRoundTrip(vote)
+
+    def test_list_ballots(self):
+        vote = voting(options=4)
+        vote["mode"] = "ranked"
+        vote["people_who_have_voted"] = {"a@hi.com": [2, 0, 1],
+                                         "b@hi.com": [3], "c@hi.com": []}
+        self.assertRoundTrip(vote)
+
+        vote = voting(options=70000)
+        vote["people_who_have_voted"] = {"d@hi.com": [69999, 1]}
+        self.assertRoundTrip(vote)
+
+    def test_smaller_than_json(self):
+        vote = voting(voters=1000)
+
+        self.assertLess(len(encode_voting(vote)), len(json.dumps(vote)))
+
+    def test_rejects_nul(self):
+        vote = voting()
+        vote["title"] = "bad\0title"
+
+        self.assertRaises(ValueError, encode_voting, vote)
+
+    def test_unknown_version(self):
+        data = b"\x09" + encode_voting(voting())[1:]
+
+        self.assertRaises(ValueError, decode_voting, data)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import time
+import unittest
+import nose
+from commands import parse_command, parse_topic
+from loadgen import adversarial_messages
+from voting_bot import VotingBot, MAX_MESSAGE_LENGTH
+
+TITLES = ["karaoke", "movie night", "Lunch Friday", "where to go 2morrow"]
+
+# (command, separators it's written with) shapes the fast path handles
+COMMANDS = ["1", "12", "results", "RESULTS", "add four", "add: Four",
+            "ADD another option", "add  spaced  out ", "0,2", "1, 2",
+            "2>0>1", "2 > 0 > 1"]
+SEPARATORS = [":", ": ", "\n", " "]
+
+# messages the fast path leaves to parse_topic
+GRAMMAR_ONLY = [" lunch: pizza, tacos", " lunch pizza, tacos", " lunch pizza",
+                " movie\nhackers\nthe matrix", " lunch:", " : 1", " lunch: add",
+                " lunch: addition", " lunch\nadd"]
+
+# new topics, for parse_topic
+TOPICS = [" lunch: pizza, tacos", " lunch pizza, tacos", " lunch pizza",
+          " movie\nhackers\nthe matrix", " movie night\nhackers",
+          " Lunch [ranked] for 2h: Pizza, Tacos", " lunch: pizza,, tacos ",
+          " a: b: c", " lunch\nadd", " lunch: add",
+          " lunch:", " lunch", "", " 5", "  5"]
+
+# options the grammar stopped reading at, failing the whole message, and a
+# vote without a title, which is a topic without a title (answered with help)
+GRAMMAR_MISREADS = [
+    (" : 1", ("topic", "", ["1"])),
+    (" lunch: 1, pizza", ("topic", "lunch", ["1", "pizza"])),
+    (" race: results, heats", ("topic", "race", ["results", "heats"])),
+    (" lunch: addition", ("topic", "lunch", ["addition"]))]
+
+# seconds a message may take to parse, per character
+PARSE_BUDGET = 5e-6
+
+# titles the grammar's preprocessing used to cut in the wrong place
+FIXED = [(" paddle night 1", ("vote", "paddle night", 1)),
+         (" results of the race 2", ("vote", "results of the race", 2)),
+         (" help desk 3", ("vote", "help desk", 3)),
+         (" the address results", ("results", "the address", None)),
+         (" lunch: 1 ", ("vote", "lunch", 1))]
+
+
+class ParseCommandTest(unittest.TestCase):
+
+    def corpus(self):
+        for title in TITLES:
+            for command in COMMANDS:
+                for sep in SEPARATORS:
+                    # without a separator, the colon would end the title
+                    if sep != " " or ":" not in command:
+                        yield " " + title + sep + command
+
+        for content in [" help", "\nhelp", ": help", " HELP", ":help"]:
+            yield content
+
+    def test_agrees_with_grammar(self):
+        for content in self.corpus():
+            fast = parse_command(content)
+
+            self.assertIsNotNone(fast, content)
+            self.assertEqual(fast, VotingBot._parse_user_content(content),
+                             content)
+
+    def test_falls_back_to_grammar(self):
+        for content in GRAMMAR_ONLY:
+            self.assertIsNone(parse_command(content), content)
+
+    def test_topics_agree_with_grammar(self):
+        for content in TOPICS:
+            self.assertEqual(parse_topic(content),
+                             VotingBot._parse_user_content(content), content)
+
+        for content, expected in GRAMMAR_MISREADS:
+            self.assertEqual(parse_topic(content), expected, content)
+
+    def test_titles_with_command_words(self):
+        for content, expected in FIXED:
+            self.assertEqual(parse_command(content), expected, content)
+            self.assertEqual(VotingBot._parse_uncached(content), expected,
+                             content)
+
+
+class ParseTimeTest(unittest.TestCase):
+
+    def assertWithinBudget(self, length):
+        for name, content in adversarial_messages(length):
+            budget = max(1e-3, len(content) * PARSE_BUDGET)
+            # a slow run gets two more tries, to rule out a busy machine
+            best = self.parse_time(content)
+            if best > budget:
+                best = min(best, self.parse_time(content),
+                           self.parse_time(content))
+
+            self.assertLess(best, budget, "%s: %.1fms" % (name, best * 1000))
+
+    @staticmethod
+    def parse_time(content):
+        start = time.time()
+        VotingBot._parse_uncached(content)
+        return time.time() - start
+
+    def test_adversarial_messages(self):
+        self.assertWithinBudget(MAX_MESSAGE_LENGTH)
+
+    def test_parse_time_is_linear(self):
+        self.assertWithinBudget(MAX_MESSAGE_LENGTH * 16)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import unittest
+import nose
+from cache import LRUCache
+from database import MemoryVotingTopics
+from events import EventListener
+from fakes import FakeEventServer, private_message
+from metrics import Metrics
+
+
+class EventListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.server = FakeEventServer([private_message("lunch\n%d" % i,
+                                                       "a@hi.com")
+                                       for i in range(3)])
+        self.checkpoints = MemoryVotingTopics()
+        self.handled = []
+
+    def tearDown(self):
+        del self.metrics
+
+    def listener(self, **options):
+        return EventListener(self.server, self.checkpoints,
+                             registry=self.metrics, **options)
+
+    def run_listener(self, listener):
+        # the backlog comes in one batch
+        listener.run(lambda msg: self.handled.append(msg["id"]),
+                     listener.stop)
+
+    def test_checkpoint_saved_after_batch(self):
+        batches = []
+        listener = self.listener()
+
+        def after_batch():
+            batches.append(self.checkpoints.get_checkpoint("messages"))
+            listener.stop()
+
+        listener.run(self.handled.append, after_batch)
+
+        self.assertEqual(len(self.handled), 3)
+        # the checkpoint only moves once the batch was handled
+        self.assertEqual(batches, [("queue-1", -1)])
+        self.assertEqual(self.checkpoints.get_checkpoint("messages"),
+                         ("queue-1", 2))
+
+    def test_duplicate_messages_handled_once(self):
+        seen = LRUCache()
+        self.run_listener(self.listener(name="private", seen=seen))
+        self.run_listener(self.listener(name="mentions", seen=seen))
+
+        self.assertEqual(self.handled, [1, 2, 3])
+        self.assertEqual(self.metrics.snapshot()["counters"][
+            "events.duplicates"], 3)
+
+    def test_other_event_types(self):
+        self.server.streams.append("voting")
+        queue = self.server.register(event_types=["stream"])
+        self.checkpoints.set_checkpoint("streams", queue["queue_id"], -1)
+        self.server.create_stream("lunch")
+
+        listener = self.listener(name="streams", event_types=["stream"])
+        listener.run(self.handled.append, listener.stop)
+
+        # the backlog's messages only go to message queues
+        self.assertEqual([(event["type"], event["op"], event["streams"])
+                          for event in self.handled],
+                         [("stream", "create", [{"name": "lunch"}])])
+
+    def test_on_register_gets_initial_state(self):
+        registered = []
+        self.server.streams.append("voting")
+
+        def on_register(result):
+            registered.append(result["streams"])
+            listener.stop()
+
+        listener = self.listener(name="streams", event_types=["stream"],
+                                 on_register=on_register)
+        listener.run(self.handled.append)
+
+        self.assertEqual(registered, [[{"name": "voting"}]])
+        self.assertEqual(self.checkpoints.get_checkpoint("streams"),
+                         ("queue-1", -1))
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
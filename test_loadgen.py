@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import unittest
+import nose
+from database import MemoryVotingTopics
+from loadgen import WORKLOADS, percentile, run_workload
+
+
+class LoadGeneratorTest(unittest.TestCase):
+
+    def test_every_workload_gets_a_reply_per_message(self):
+        for name in WORKLOADS:
+            result = run_workload(name, messages=40)
+
+            self.assertEqual(result["messages"], 40, name)
+            self.assertEqual(result["replies"], 40, name)
+            self.assertGreater(result["db_calls_per_message"], 0, name)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"], name)
+
+    def test_hot_poll_votes_are_counted(self):
+        storage = MemoryVotingTopics()
+        result = run_workload("hot_poll", messages=50, storage=storage)
+
+        self.assertEqual(result["db_calls"]["cast_vote"], 50)
+        options = storage["hot"]["options"]
+        self.assertEqual(sum(count for _, count in options.values()), 40)
+
+    def test_percentile(self):
+        ordered = range(1, 101)
+
+        self.assertEqual(percentile(ordered, 0.5), 51)
+        self.assertEqual(percentile(ordered, 0.99), 100)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import threading
+import unittest
+import nose
+import requests
+from metrics import Metrics, MetricsServer
+from profiler import SamplingProfiler
+
+
+class PrometheusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Metrics()
+        self.registry.incr("bot.actions.vote", 3)
+        self.registry.gauge("pipeline.queue_depth", lambda: 2)
+        self.registry.observe("db.cast_vote", 0.5)
+        self.registry.observe("db.cast_vote", 1.5)
+
+    def test_text_format(self):
+        self.assertEqual(self.registry.prometheus().splitlines(), [
+            "# TYPE votingbot_bot_actions_vote_total counter",
+            "votingbot_bot_actions_vote_total 3",
+            "# TYPE votingbot_pipeline_queue_depth gauge",
+            "votingbot_pipeline_queue_depth 2",
+            "# TYPE votingbot_db_cast_vote_seconds summary",
+            "votingbot_db_cast_vote_seconds_count 2",
+            "votingbot_db_cast_vote_seconds_sum 2.0",
+            "# TYPE votingbot_db_cast_vote_seconds_max gauge",
+            "votingbot_db_cast_vote_seconds_max 1.5"])
+
+    def test_metrics_server(self):
+        profiler = SamplingProfiler(registry=self.registry)
+        server = MetricsServer(0, self.registry, profiler,
+                               host="127.0.0.1").start()
+        profiler.sample()
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+
+        try:
+            metrics = requests.get(url + "/metrics")
+            profile = requests.get(url + "/profile")
+            missing = requests.get(url + "/nothing")
+        finally:
+            server.stop()
+
+        self.assertIn("votingbot_bot_actions_vote_total 3", metrics.text)
+        self.assertIn("votingbot_profiler_samples_total 1", metrics.text)
+        self.assertIn("threading.py:", profile.text)
+        self.assertEqual(missing.status_code, 404)
+
+
+class SamplingProfilerTest(unittest.TestCase):
+
+    def test_samples_other_threads(self):
+        registry = Metrics()
+        profiler = SamplingProfiler(interval=0.001, registry=registry)
+        done = threading.Event()
+        worker = threading.Thread(target=done.wait)
+        worker.start()
+
+        profiler.start()
+        while registry.snapshot()["counters"].get("profiler.samples", 0) < 3:
+            done.wait(0.001)
+        profiler.stop()
+        done.set()
+        worker.join()
+
+        stacks = profiler.collapsed().splitlines()
+        self.assertTrue(any("threading.py:wait" in stack for stack in stacks))
+        self.assertFalse(any("profiler.py:sample" in stack
+                             for stack in stacks))
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
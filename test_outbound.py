@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import unittest
+import nose
+import outbound
+from fakes import FakeZulipClient
+from metrics import Metrics
+from outbound import OutboundDispatcher
+
+
+class RateLimitedClient(FakeZulipClient):
+
+    """Fails the first send with Zulip's rate limit error."""
+
+    def send_message(self, msg):
+        if not self.sent and not getattr(self, "limited", False):
+            self.limited = True
+            return {"result": "error", "code": "RATE_LIMIT_HIT",
+                    "retry-after": 0.01}
+
+        return super(RateLimitedClient, self).send_message(msg)
+
+
+class OutboundDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        del self.metrics
+
+    def test_coalesces_bursts_with_same_key(self):
+        client = FakeZulipClient()
+        dispatcher = OutboundDispatcher(client, rate=None, coalesce_window=10,
+                                        registry=self.metrics).start()
+
+        for i in range(50):
+            dispatcher.send({"content": "options %d" % i}, ("options", "lunch"))
+            dispatcher.send({"content": "vote %d" % i})
+        dispatcher.send({"content": "movie options"}, ("options", "movie"))
+        dispatcher.close()
+
+        contents = [msg["content"] for msg in client.sent]
+        self.assertEqual(len(contents), 52)
+        self.assertIn("options 49", contents)
+        self.assertIn("movie options", contents)
+        self.assertNotIn("options 48", contents)
+        self.assertEqual(self.metrics.snapshot()["counters"][
+            "outbound.coalesced"], 49)
+
+    def test_coalesced_message_sent_after_window(self):
+        client = FakeZulipClient()
+        dispatcher = OutboundDispatcher(client, rate=None, coalesce_window=0.01,
+                                        registry=self.metrics).start()
+
+        dispatcher.send({"content": "options"}, ("options", "lunch"))
+        dispatcher.queue.join()
+        for _ in range(100):
+            if client.sent:
+                break
+            outbound.time.sleep(0.01)
+        dispatcher.close()
+
+        self.assertEqual(client.sent, [{"content": "options"}])
+
+    def test_retries_when_rate_limited(self):
+        client = RateLimitedClient()
+        dispatcher = OutboundDispatcher(client, rate=1000, burst=1,
+                                        registry=self.metrics).start()
+
+        dispatcher.send({"content": "hi"})
+        dispatcher.close()
+
+        self.assertEqual(client.sent, [{"content": "hi"}])
+        self.assertEqual(self.metrics.snapshot()["counters"][
+            "outbound.rate_limited"], 1)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import threading
+import unittest
+import nose
+from metrics import Metrics
+from scheduler import PollScheduler
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fired = []
+        self.scheduler = PollScheduler(
+            lambda titles, now: self.fired.append((sorted(titles), now)),
+            registry=Metrics())
+
+    def test_due_in_deadline_order(self):
+        self.scheduler.schedule("dinner", 30)
+        self.scheduler.schedule("lunch", 10)
+        self.scheduler.schedule("karaoke", 20)
+
+        self.assertEqual(self.scheduler.next_deadline(), 10)
+        self.assertEqual(self.scheduler.due(5), [])
+        self.assertEqual(self.scheduler.due(20), ["lunch", "karaoke"])
+        self.assertEqual(self.scheduler.next_deadline(), 30)
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_cancel_and_reschedule(self):
+        self.scheduler.schedule("lunch", 10)
+        self.scheduler.schedule("dinner", 20)
+        self.scheduler.schedule("dinner", 40)
+        self.scheduler.cancel("lunch")
+
+        self.assertEqual(self.scheduler.next_deadline(), 40)
+        self.assertEqual(self.scheduler.due(30), [])
+        self.assertEqual(self.scheduler.due(40), ["dinner"])
+        self.assertIsNone(self.scheduler.next_deadline())
+
+    def test_rebuild(self):
+        self.scheduler.schedule("lunch", 10)
+        self.scheduler.rebuild([("dinner", 5), ("karaoke", 15)])
+
+        self.assertEqual(self.scheduler.due(100), ["dinner", "lunch",
+                                                   "karaoke"])
+
+    def test_thread_fires_past_deadlines(self):
+        fired = threading.Event()
+        clock = [100.0]
+        scheduler = PollScheduler(lambda titles, now: fired.set() or
+                                  self.fired.append((sorted(titles), now)),
+                                  clock=lambda: clock[0], registry=Metrics())
+        scheduler.rebuild([("lunch", 50.0), ("dinner", 90.0),
+                           ("karaoke", 1000.0)])
+
+        scheduler.start()
+        fired.wait(5)
+        scheduler.stop()
+        scheduler.thread.join(5)
+
+        self.assertEqual(self.fired, [(["dinner", "lunch"], 100.0)])
+        self.assertFalse(scheduler.thread.is_alive())
+        self.assertEqual(len(scheduler), 1)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import time
+import unittest
+import nose
+from fakes import FakeZulipClient
+from metrics import Metrics
+from scoreboard import Scoreboard
+
+
+class ScoreboardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeZulipClient()
+        self.results = {"lunch": 0}
+        self.clock = [100.0]
+        self.metrics = Metrics()
+        self.scoreboard = Scoreboard(self.client, self.render, interval=2.0,
+                                     clock=lambda: self.clock[0],
+                                     registry=self.metrics)
+
+    def render(self, title):
+        return {"type": "stream", "to": "voting", "subject": title,
+                "content": "%s: %d votes" % (title, self.results[title])}
+
+    def vote(self, title, votes=1):
+        for _ in range(votes):
+            self.results[title] += 1
+            self.scoreboard.update(title)
+
+    def test_updates_are_coalesced(self):
+        self.vote("lunch", 50)
+
+        self.assertEqual(self.scoreboard.due(101.0), [])
+        self.assertEqual(self.scoreboard.due(102.0), ["lunch"])
+        self.scoreboard.publish("lunch")
+        self.vote("lunch", 20)
+        self.scoreboard.flush()
+
+        self.assertEqual([msg["content"] for msg in self.client.sent],
+                         ["lunch: 50 votes"])
+        self.assertEqual(self.client.updated,
+                         [{"message_id": 1, "content": "lunch: 70 votes"}])
+        self.assertEqual(self.metrics.snapshot()["counters"], {
+            "scoreboard.coalesced": 68, "scoreboard.posted": 1,
+            "scoreboard.edited": 1})
+
+    def test_unchanged_results_are_not_edited(self):
+        self.vote("lunch")
+        self.scoreboard.flush()
+        self.scoreboard.update("lunch")
+        self.scoreboard.flush()
+
+        self.assertEqual(len(self.client.sent), 1)
+        self.assertEqual(self.client.updated, [])
+
+    def test_closed_polls(self):
+        self.vote("lunch")
+        self.scoreboard.flush()
+        self.scoreboard.update("lunch")
+        self.scoreboard.forget("lunch")
+        self.scoreboard.flush()
+
+        self.vote("lunch")
+        del self.results["lunch"]
+        self.scoreboard.flush()
+
+        self.assertEqual(len(self.client.sent), 1)
+        self.assertEqual(self.client.updated, [])
+        self.assertEqual(self.scoreboard.messages, {})
+
+    def test_failed_edit_posts_again(self):
+        self.vote("lunch")
+        self.scoreboard.flush()
+        self.client.update_message = lambda msg: {"result": "error",
+                                                  "msg": "Invalid message(s)"}
+        self.vote("lunch")
+        self.scoreboard.flush()
+
+        # tried again an interval later, as a new message
+        self.assertEqual(self.scoreboard.dirty, {"lunch": 102.0})
+        self.scoreboard.flush()
+        self.assertEqual([msg["content"] for msg in self.client.sent],
+                         ["lunch: 1 votes", "lunch: 2 votes"])
+
+    def test_thread_edits_once_per_interval(self):
+        scoreboard = Scoreboard(self.client, self.render, interval=0.05,
+                                registry=self.metrics).start()
+        scoreboard.update("lunch", delay=0)
+        deadline = time.time() + 0.3
+        while time.time() < deadline:
+            self.results["lunch"] += 1
+            scoreboard.update("lunch")
+            time.sleep(0.001)
+        scoreboard.stop()
+        scoreboard.thread.join()
+
+        edits = len(self.client.sent) + len(self.client.updated)
+        self.assertEqual(len(self.client.sent), 1)
+        self.assertGreaterEqual(edits, 2)
+        self.assertLessEqual(edits, 0.3 / 0.05 + 2)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import unittest
+import nose
+from tally import Tally, ApprovalTally, RunoffTally, tally_from_voting
+
+
+class TallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tally = Tally("Lunch", ["pizza", "sushi", "tacos"])
+
+    def test_ranking_follows_votes(self):
+        self.tally.vote(2)
+        self.tally.vote(2)
+        self.tally.vote(1)
+
+        self.assertEqual(self.tally.ranked(), [(2, "tacos", 2), (1, "sushi", 1),
+                                               (0, "pizza", 0)])
+        self.assertEqual(self.tally.leader(), (2, "tacos", 2))
+        self.assertEqual(self.tally.total, 3)
+
+    def test_ties_keep_option_order(self):
+        self.tally.vote(2)
+        self.tally.vote(0)
+
+        self.assertEqual([option for option, _, _ in self.tally.ranked()],
+                         [0, 2, 1])
+
+    def test_changed_vote_moves_count(self):
+        self.tally.vote(0)
+        self.tally.vote(1)
+        self.tally.vote(1, old_option=0)
+
+        self.assertEqual(self.tally.ranked(), [(1, "sushi", 2), (0, "pizza", 0),
+                                               (2, "tacos", 0)])
+        self.assertEqual(self.tally.total, 2)
+
+    def test_added_option_ranks_last(self):
+        self.tally.vote(0)
+        self.assertEqual(self.tally.add_option("curry"), 3)
+        self.tally.vote(3)
+        self.tally.vote(3)
+
+        self.assertEqual(self.tally.leader(), (3, "curry", 2))
+        self.assertEqual(len(self.tally), 4)
+
+    def test_from_voting_matches_incremental(self):
+        voting = {"title": "Lunch",
+                  "options": {0: ["pizza", 1], 1: ["sushi", 3],
+                              2: ["tacos", 1]}}
+
+        self.assertEqual(Tally.from_voting(voting).ranked(),
+                         [(1, "sushi", 3), (0, "pizza", 1), (2, "tacos", 1)])
+
+    def test_render_results(self):
+        self.tally.vote(1)
+
+        self.assertEqual(self.tally.render_results(),
+                         "The results are in!!!! \nTopic: Lunch"
+                         "\nsushi has 1 votes.\npizza has 0 votes."
+                         "\ntacos has 0 votes.")
+
+
+class ApprovalTallyTest(unittest.TestCase):
+
+    def test_every_approved_option_counts(self):
+        tally = ApprovalTally("Lunch", ["pizza", "sushi", "tacos"])
+        tally.vote([0, 2])
+        tally.vote([2])
+        tally.vote([1, 2], old_options=[2])
+
+        self.assertEqual(tally.ranked(), [(2, "tacos", 2), (0, "pizza", 1),
+                                          (1, "sushi", 1)])
+        self.assertEqual(tally.total, 2)
+
+    def test_from_voting(self):
+        voting = {"title": "Lunch", "mode": "approval",
+                  "options": {0: ["pizza", 1], 1: ["sushi", 0],
+                              2: ["tacos", 1]},
+                  "people_who_have_voted": {"a@hi.com": [0, 2],
+                                            "b@hi.com": [2]}}
+
+        tally = tally_from_voting(voting)
+        self.assertIsInstance(tally, ApprovalTally)
+        self.assertEqual(tally.leader(), (2, "tacos", 2))
+        self.assertEqual(tally.total, 2)
+
+
+class RunoffTallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tally = RunoffTally("Lunch", ["pizza", "sushi", "tacos"])
+
+    def test_majority_in_first_round(self):
+        for ballot in [[0, 1], [0], [1, 0]]:
+            self.tally.vote(ballot)
+
+        self.assertEqual(self.tally.rounds(),
+                         [([(0, "pizza", 2), (1, "sushi", 1),
+                            (2, "tacos", 0)], None)])
+        self.assertEqual(self.tally.leader(), (0, "pizza", 2))
+
+    def test_eliminated_votes_transfer(self):
+        for ballot in [[0], [0], [1, 2], [1, 2], [2, 1], [2, 1], [2, 1]]:
+            self.tally.vote(ballot)
+
+        # sushi ties with pizza and goes, its ballots move on to tacos
+        self.assertEqual([eliminated for _, eliminated in
+                          self.tally.rounds()], [1, None])
+        self.assertEqual(self.tally.leader(), (2, "tacos", 5))
+
+    def test_exhausted_ballots_leave_the_count(self):
+        for ballot in [[0], [0], [1], [1], [2]]:
+            self.tally.vote(ballot)
+
+        # without tacos' ballot pizza and sushi still tie, so sushi goes
+        rounds = self.tally.rounds()
+        self.assertEqual([eliminated for _, eliminated in rounds],
+                         [2, 1, None])
+        self.assertEqual(self.tally.leader(), (0, "pizza", 2))
+
+    def test_changed_vote_and_new_option(self):
+        self.tally.vote([1])
+        self.tally.vote([2, 0])
+        self.tally.vote([0], old_ballot=[2, 0])
+        self.assertEqual(self.tally.add_option("curry"), 3)
+        self.tally.vote([3])
+
+        self.assertEqual(self.tally.total, 3)
+        self.assertEqual(len(self.tally), 4)
+        self.assertEqual(self.tally.rounds()[0][0],
+                         [(0, "pizza", 1), (1, "sushi", 1), (3, "curry", 1),
+                          (2, "tacos", 0)])
+
+    def test_from_voting_and_render(self):
+        voting = {"title": "Lunch", "mode": "ranked",
+                  "options": {0: ["pizza", 1], 1: ["sushi", 1],
+                              2: ["tacos", 1]},
+                  "people_who_have_voted": {"a@hi.com": [0],
+                                            "b@hi.com": [1, 0],
+                                            "c@hi.com": [2, 1]}}
+
+        self.assertEqual(tally_from_voting(voting).render_results(),
+                         "The results are in!!!! \nTopic: Lunch"
+                         "\nRound 1: pizza 1, sushi 1, tacos 1. "
+                         "tacos is eliminated."
+                         "\nRound 2: sushi 2, pizza 1."
+                         "\nWinner: sushi with 2 votes.")
+
+    def test_no_ballots(self):
+        self.assertEqual(self.tally.leader(), (0, "pizza", 0))
+        self.assertIsNone(RunoffTally("Lunch", []).leader())
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
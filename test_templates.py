@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import nose
+from database import MemoryVotingTopics
+from fakes import FakeZulipClient, stream_message, private_message
+from templates import Template, Templates, render_options
+from voting_bot import VotingBot
+
+
+class TemplateTest(unittest.TestCase):
+
+    def test_render(self):
+        template = Template("{title}: {option} ({title})")
+
+        self.assertEqual(template.render(title="Lunch", option="pizza"),
+                         "Lunch: pizza (Lunch)")
+
+    def test_render_options(self):
+        self.assertEqual(render_options(["pizza", "sushi"]),
+                         "\n 0. pizza\n 1. sushi")
+
+
+class TemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "help.md")
+        self._write("first")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, text, mtime=None):
+        with io.open(self.path, "w", encoding="utf-8") as f:
+            f.write(text)
+        if mtime:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_loads_once(self):
+        templates = Templates(self.tmp_dir)
+        self._write("second", mtime=1)
+
+        self.assertIn("help", templates)
+        self.assertEqual(templates["help"], "first")
+
+    def test_reloads_changed_files(self):
+        templates = Templates(self.tmp_dir, reload=True, check_interval=0)
+        self._write("second ✓", mtime=1)
+
+        self.assertEqual(templates["help"], "second ✓")
+
+    def test_bundled_messages(self):
+        templates = Templates()
+
+        self.assertIn("complete_help", templates)
+        self.assertIn("voting_help", templates)
+
+
+class VotingBotRepliesTest(unittest.TestCase):
+
+    def test_replies(self):
+        events = [stream_message("VotingBot Lunch: pizza, sushi", "a@hi.com"),
+                  stream_message("VotingBot Lunch: add tacos", "a@hi.com"),
+                  stream_message("VotingBot Lunch: add tacos", "a@hi.com"),
+                  stream_message("VotingBot Lunch: pizza", "a@hi.com"),
+                  private_message("lunch\n1", "b@hi.com"),
+                  private_message("lunch\n0", "b@hi.com"),
+                  private_message("lunch\n5", "b@hi.com"),
+                  stream_message("VotingBot Lunch: 2", "c@hi.com")]
+        client = FakeZulipClient(events)
+        bot = VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                        client=client, voting_topics=MemoryVotingTopics())
+        bot.main()
+
+        self.assertEqual([msg["content"] for msg in client.sent], [
+            "lunch\n 0. pizza\n 1. sushi",
+            "There is a new option in topic: lunch"
+            "\n 0. pizza\n 1. sushi\n 2. Tacos",
+            "Tacos is already an option in topic: lunch"
+            "\nDo not attempt to repeat options!",
+            "This topic already exists! Choose another name.",
+            "One vote in this topic: lunch for this option: sushi",
+            "You have changed your vote. \n"
+            "One vote in this topic: lunch for this option: pizza",
+            "That option is not in the range of the voting options. "
+            "Here are your options:  \n0. pizza\n1. sushi\n2. Tacos",
+            "You just voted for 'Tacos' in lunch"])
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
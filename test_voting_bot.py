@@ -2,9 +2,22 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import nose
-from voting_bot import VotingBot
+from database import MemoryVotingTopics, VotingTopics, sqlite_url
+from fakes import CountingStorage, FakeEventServer, FakeZulipClient, \
+    stream_message, private_message
+from metrics import Metrics
+from loadgen import adversarial_messages
+from voting_bot import VotingBot, split_duration, split_mode, \
+    MAX_MESSAGE_LENGTH, MAX_OPTIONS
 
 
 class VotingBotTest(unittest.TestCase):
@@ -146,6 +159,637 @@ class VotingBotTest(unittest.TestCase):
         self.assertEqual((action, title, arg), (e_action, e_title, e_arg),
                          (content, action, title, arg))
 
+    def test_class_docstring(self):
+        self.assertIn("zulip username", self.vb.__doc__)
+
+    def test_parse_public_message_cache(self):
+        self.vb.parse_cache.clear()
+        hits, misses = self.vb.parse_cache.hits, self.vb.parse_cache.misses
+
+        content = "votingbot karaoke: one, two"
+        first = self.vb._parse_public_message(content)
+        first[2].append("mutated by caller")
+        second = self.vb._parse_public_message("VotingBot Karaoke: One, Two")
+
+        self.assertEqual(second, ("topic", "karaoke", ["one", "two"]))
+        self.assertEqual(self.vb.parse_cache.misses, misses + 1)
+        self.assertEqual(self.vb.parse_cache.hits, hits + 1)
+
+
+class VotingBotConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.voting_topics = VotingTopics(
+            sqlite_url(os.path.join(self.tmp_dir, "votings.db")))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_concurrent_votes_on_several_polls(self):
+        polls = ["lunch", "movie", "karaoke"]
+        events = [stream_message("VotingBot %s: one, two" % poll, "owner@hi.com")
+                  for poll in polls]
+        for i in range(300):
+            poll = polls[i % len(polls)]
+            voter = "voter%d@hi.com" % (i // len(polls))
+            events.append(stream_message("VotingBot %s: %d" % (poll, i % 2),
+                                         voter))
+        events.append(private_message("lunch\n1", "voter0@hi.com"))
+
+        client = FakeZulipClient(events)
+        bot = VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                        client=client, voting_topics=self.voting_topics)
+        bot.main(concurrency=4, queue_size=32)
+
+        self.assertEqual(len(client.sent), len(events))
+        for poll in polls:
+            vote = self.voting_topics[poll]
+            self.assertEqual(len(vote["people_who_have_voted"]), 100)
+            self.assertEqual(sum(opt[1] for opt in vote["options"].values()),
+                             100)
+        self.assertEqual(self.voting_topics["lunch"]["people_who_have_voted"][
+            "voter0@hi.com"], 1)
+
+        # incrementally kept tallies agree with what was stored
+        for poll in polls:
+            options = self.voting_topics[poll]["options"]
+            self.assertEqual(sorted(bot._get_tally(poll).ranked()),
+                             [(num, name, votes) for num, (name, votes)
+                              in sorted(options.items())])
+
+    def test_tagged_poll_and_its_votes_in_order(self):
+        events = [stream_message("VotingBot Lunch [ranked] for 2h: a, b, c",
+                                 "owner@hi.com")]
+        events.extend(stream_message("VotingBot lunch: %d>2" % (i % 2),
+                                     "voter%d@hi.com" % i)
+                      for i in range(40))
+        client = FakeZulipClient(events)
+        bot = VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                        client=client, voting_topics=self.voting_topics)
+
+        self.assertEqual(set(bot.message_key(msg) for msg in events),
+                         {"lunch"})
+        bot.main(concurrency=4, queue_size=32)
+
+        self.assertEqual(len(self.voting_topics["lunch"][
+            "people_who_have_voted"]), 40)
+
+
+class VotingBotSharedDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        url = sqlite_url(os.path.join(self.tmp_dir, "votings.db"))
+        self.bots = [VotingBot("voting-bot@hi.com", "key", "VotingBot",
+                               ["voting"], client=FakeZulipClient(),
+                               voting_topics=VotingTopics(url),
+                               registry=Metrics())
+                     for _ in range(2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def say(self, bot, content, sender):
+        bot.respond(stream_message("VotingBot " + content, sender))
+
+    def test_results_count_every_instance_votes(self):
+        first, second = self.bots
+        self.say(first, "lunch: pizza, tacos", "o@hi.com")
+        self.say(first, "lunch: 0", "a@hi.com")
+        first.send_partial_results("lunch", "o@hi.com")
+        for i in range(5):
+            self.say(second, "lunch: 1", "voter%d@hi.com" % i)
+
+        first.send_partial_results("lunch", "o@hi.com")
+        self.assertIn("Current leader: tacos with 5 votes.",
+                      first.client.sent[-1]["content"])
+        self.say(first, "lunch: results", "o@hi.com")
+        self.assertEqual(first.client.sent[-1]["content"],
+                         "The results are in!!!! \nTopic: lunch"
+                         "\ntacos has 5 votes.\npizza has 1 votes.")
+
+
+class VotingBotPrefilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeZulipClient()
+        self.bot = VotingBot("voting-bot@hi.com", "key", "VotingBot",
+                             ["voting"], client=self.client,
+                             voting_topics=MemoryVotingTopics())
+
+    def test_accepts(self):
+        accepts = self.bot.accepts
+
+        self.assertTrue(accepts(stream_message("votingbot lunch: 1", "a@hi")))
+        self.assertTrue(accepts(stream_message("VotingBot\nhelp", "a@hi")))
+        self.assertTrue(accepts(stream_message(b"VotingBot lunch", "a@hi")))
+        self.assertTrue(accepts(private_message("lunch\n1", "a@hi")))
+        self.assertTrue(accepts(stream_message(" \nVotingBot lunch", "a@hi")))
+        self.assertFalse(accepts(stream_message("VotingBotty", "a@hi")))
+        self.assertFalse(accepts(stream_message("hi VotingBot", "a@hi")))
+        self.assertFalse(accepts(stream_message("", "a@hi")))
+        self.assertFalse(accepts(private_message("", "a@hi")))
+        self.assertFalse(accepts(stream_message("VotingBot help",
+                                                "voting-bot@hi.com")))
+
+    def test_leading_whitespace(self):
+        self.bot.respond(stream_message("  VotingBot lunch: pizza, tacos",
+                                        "a@hi.com"))
+        self.bot.respond(stream_message("\nVotingBot lunch: 1", "b@hi.com"))
+
+        self.assertEqual(self.bot.voting_topics["lunch"][
+            "people_who_have_voted"], {"b@hi.com": 1})
+
+    def test_empty_messages_are_ignored(self):
+        self.bot.respond(stream_message("", "a@hi.com"))
+        self.bot.respond(private_message("", "a@hi.com"))
+
+        self.assertEqual(self.client.sent, [])
+
+    def test_narrowed_event_queues(self):
+        # the queues are read concurrently, so don't depend on their order
+        self.bot.voting_topics["lunch"] = new_poll()
+        self.client.server = FakeEventServer([
+            stream_message("VotingBot lunch: add tacos", "a@hi.com"),
+            stream_message("what's for lunch?", "b@hi.com"),
+            stream_message("ask VotingBot", "b@hi.com"),
+            private_message("VotingBot lunch: 1", "b@hi.com"),
+            private_message("lunch\n0", "c@hi.com")])
+        run_until(self.bot, 3, narrow=True)
+
+        self.assertEqual(sorted(self.client.server.narrows),
+                         sorted(self.bot.message_narrows()))
+        self.assertEqual(len(self.client.sent), 3)
+        self.assertEqual(self.bot.voting_topics["lunch"][
+            "people_who_have_voted"], {"b@hi.com": 1, "c@hi.com": 0})
+
+
+class VotingBotInstrumentationTest(unittest.TestCase):
+
+    def test_stages_and_actions_are_recorded(self):
+        registry = Metrics()
+        bot = VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                        client=FakeZulipClient(),
+                        voting_topics=MemoryVotingTopics(), registry=registry)
+
+        bot.respond(stream_message("VotingBot lunch: pizza, tacos", "a@hi"))
+        bot.respond(stream_message("VotingBot lunch: 1", "b@hi"))
+        bot.respond(private_message("lunch\n0", "c@hi"))
+        bot.respond(private_message("dinner\n0", "c@hi"))
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot["counters"], {
+            "bot.actions.topic": 1, "bot.actions.vote": 1,
+            "bot.actions.private_vote": 1, "bot.actions.unknown_topic": 1})
+        timers = snapshot["timers"]
+        self.assertEqual(timers["bot.respond"]["count"], 4)
+        self.assertEqual(timers["bot.parse"]["count"], 2)
+        self.assertEqual(timers["bot.send"]["count"], 4)
+        self.assertEqual(timers["db.cast_vote"]["count"], 2)
+        self.assertEqual(timers["db.setitem"]["count"], 1)
+
+
+class VotingBotDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.voting_topics = MemoryVotingTopics()
+        self.client = FakeZulipClient()
+        self.bot = self.new_bot()
+
+    def new_bot(self):
+        return VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                         client=self.client, voting_topics=self.voting_topics,
+                         registry=Metrics())
+
+    def test_split_duration(self):
+        self.assertEqual(split_duration("lunch for 90m"), ("lunch", 5400))
+        self.assertEqual(split_duration("movie night for 2 h "),
+                         ("movie night", 7200))
+        self.assertEqual(split_duration("lunch for 1d"), ("lunch", 86400))
+        self.assertEqual(split_duration("waiting for godot"),
+                         ("waiting for godot", None))
+        self.assertEqual(split_duration("for 2h"), ("for 2h", None))
+
+    def test_results_published_at_deadline(self):
+        start = time.time()
+        self.bot.respond(stream_message(
+            "VotingBot lunch for 2h: pizza, tacos", "owner@hi.com"))
+        self.bot.respond(private_message("lunch\n1", "claire@hi.com"))
+        self.bot.respond(stream_message("VotingBot dinner: curry, sushi",
+                                        "owner@hi.com"))
+
+        self.assertIn("Results will be published in 2 hours",
+                      self.client.sent[0]["content"])
+        deadline = self.voting_topics["lunch"]["deadline"]
+        self.assertTrue(start + 7200 <= deadline <= time.time() + 7200)
+        self.assertEqual(self.bot.scheduler.due(deadline - 1), [])
+
+        # a restarted bot schedules the deadline again
+        self.bot = self.new_bot()
+        self.bot.scheduler.rebuild(self.voting_topics.deadlines())
+        titles = self.bot.scheduler.due(deadline)
+        self.assertEqual(titles, ["lunch"])
+
+        self.bot.expire_polls(titles, deadline)
+        results = self.client.sent[-1]
+        self.assertEqual((results["type"], results["to"], results["subject"]),
+                         ("stream", "voting", "polls"))
+        self.assertIn("tacos has 1 votes", results["content"])
+        self.assertEqual(self.voting_topics.keys(), ["dinner"])
+
+    def test_polls_of_other_instances_are_left_to_them(self):
+        other = self.new_bot()
+        self.bot.respond(stream_message("VotingBot lunch for 1h: pizza",
+                                        "owner@hi.com"))
+        other.respond(stream_message("VotingBot dinner for 1h: curry",
+                                     "owner@hi.com"))
+        deadline = self.voting_topics["dinner"]["deadline"]
+
+        self.bot.expire_polls(self.bot.scheduler.due(deadline), deadline)
+        self.assertEqual(self.voting_topics.keys(), ["dinner"])
+
+        other.expire_polls(other.scheduler.due(deadline), deadline)
+        self.assertIn("curry has 0 votes", self.client.sent[-1]["content"])
+        self.assertEqual(self.voting_topics.keys(), [])
+
+    def test_results_command_cancels_deadline(self):
+        self.bot.respond(stream_message("VotingBot lunch for 1h: pizza, tacos",
+                                        "owner@hi.com"))
+        self.bot.respond(stream_message("VotingBot lunch results",
+                                        "owner@hi.com"))
+
+        self.assertEqual(len(self.bot.scheduler), 0)
+        self.assertEqual(self.voting_topics.keys(), [])
+
+
+class VotingBotModesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.voting_topics = MemoryVotingTopics()
+        self.client = FakeZulipClient()
+        self.bot = VotingBot("voting-bot@hi.com", "key", "VotingBot",
+                             ["voting"], client=self.client,
+                             voting_topics=self.voting_topics,
+                             registry=Metrics())
+
+    def vote(self, content, voter):
+        self.bot.respond(stream_message("VotingBot " + content, voter))
+        return self.client.sent[-1]["content"]
+
+    def test_split_mode(self):
+        self.assertEqual(split_mode("lunch [ranked] for 2h"),
+                         ("lunch for 2h", "ranked"))
+        self.assertEqual(split_mode("lunch [Approval]"), ("lunch", "approval"))
+        self.assertEqual(split_mode("lunch [maybe]"), ("lunch [maybe]", None))
+
+    def test_approval_poll(self):
+        self.vote("lunch [approval] for 1h: pizza, tacos, sushi", "o@hi.com")
+        self.assertIn("Vote for every option you like",
+                      self.client.sent[-1]["content"])
+        self.assertEqual(self.voting_topics["lunch"]["mode"], "approval")
+
+        self.assertIn("'pizza, sushi'", self.vote("lunch: 2,0", "a@hi.com"))
+        self.vote("lunch: 2", "b@hi.com")
+        self.assertIn("changed your vote", self.vote("lunch 1, 2", "b@hi.com"))
+        self.assertIn("not in the range", self.vote("lunch: 0,7", "c@hi.com"))
+
+        self.assertEqual(self.voting_topics["lunch"]["people_who_have_voted"],
+                         {"a@hi.com": [0, 2], "b@hi.com": [1, 2]})
+        self.vote("lunch results", "o@hi.com")
+        self.assertEqual(self.client.sent[-1]["content"],
+                         "The results are in!!!! \nTopic: lunch"
+                         "\nsushi has 2 votes.\npizza has 1 votes."
+                         "\ntacos has 1 votes.")
+
+    def test_ranked_poll(self):
+        self.vote("lunch [ranked]: pizza, tacos, sushi", "o@hi.com")
+
+        self.assertIn("'sushi > pizza'", self.vote("lunch: 2 > 0 > 2",
+                                                   "a@hi.com"))
+        self.vote("lunch: 2>0>1", "b@hi.com")
+        self.vote("lunch: 1>2", "c@hi.com")
+        self.vote("lunch: 0", "d@hi.com")
+        self.bot.respond(private_message("lunch\n1>0", "e@hi.com"))
+        self.bot.tallies.clear()
+
+        self.vote("lunch results", "o@hi.com")
+        self.assertEqual(self.client.sent[-1]["content"],
+                         "The results are in!!!! \nTopic: lunch"
+                         "\nRound 1: tacos 2, sushi 2, pizza 1. "
+                         "pizza is eliminated."
+                         "\nRound 2: tacos 2, sushi 2. sushi is eliminated."
+                         "\nRound 3: tacos 3."
+                         "\nWinner: tacos with 3 votes.")
+
+    def test_single_choice_polls_take_one_option(self):
+        self.vote("lunch: pizza, tacos", "o@hi.com")
+
+        self.assertIn("takes a single option", self.vote("lunch: 0,1",
+                                                         "a@hi.com"))
+        self.assertEqual(self.voting_topics["lunch"]["people_who_have_voted"],
+                         {})
+
+
+class VotingBotScoreboardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.voting_topics = MemoryVotingTopics()
+        self.client = FakeZulipClient()
+        self.bot = VotingBot("voting-bot@hi.com", "key", "VotingBot",
+                             ["voting"], client=self.client,
+                             voting_topics=self.voting_topics,
+                             registry=Metrics(), live_scoreboard=True)
+
+    def say(self, content, sender):
+        self.bot.respond(stream_message("VotingBot " + content, sender))
+
+    def test_scoreboard_replaces_confirmations(self):
+        self.say("lunch: pizza, tacos", "o@hi.com")
+        self.bot.scoreboard.flush()
+        for i in range(20):
+            self.say("lunch: %d" % (i % 2), "voter%d@hi.com" % i)
+        self.bot.respond(private_message("lunch\n0", "a@hi.com"))
+        self.say("lunch add sushi", "a@hi.com")
+        self.bot.scoreboard.flush()
+
+        self.assertEqual([(msg["type"], msg["to"]) for msg in
+                          self.client.sent],
+                         [("stream", "voting"), ("stream", "voting")])
+        self.assertEqual(self.client.sent[1]["subject"], "polls")
+        # the scoreboard's thread leaves the handlers' tallies alone
+        self.bot.tallies.clear()
+        self.bot.scoreboard.update("lunch")
+        self.bot.scoreboard.flush()
+        self.assertIsNone(self.bot.tallies.get("lunch"))
+        self.assertEqual(self.client.updated, [{
+            "message_id": 2,
+            "content": "Live results, updated as votes come in:\n"
+                       "Topic: lunch\npizza has 11 votes.\n"
+                       "tacos has 10 votes.\nSushi has 0 votes."}])
+
+        # a new poll under the same title gets a new message
+        self.say("lunch: results", "o@hi.com")
+        self.say("lunch: pizza", "o@hi.com")
+        self.bot.scoreboard.flush()
+        self.assertEqual(len(self.client.sent), 5)
+        self.assertEqual(len(self.client.updated), 1)
+        self.assertEqual(self.bot.scoreboard.messages["lunch"][0], 5)
+
+    def test_ballots_are_only_loaded_when_needed(self):
+        storage = CountingStorage(self.voting_topics)
+        bot = VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                        client=self.client, voting_topics=storage,
+                        registry=Metrics(), live_scoreboard=True)
+        bot.respond(stream_message("VotingBot lunch: pizza, tacos", "o@hi"))
+        bot.respond(stream_message("VotingBot dinner [ranked]: curry, sushi",
+                                   "o@hi"))
+        storage.calls.clear()
+
+        bot.render_scoreboard("lunch")
+        self.assertEqual(storage.calls, {"header": 1})
+        bot.render_scoreboard("dinner")
+        self.assertEqual(storage.calls, {"header": 2, "__getitem__": 1})
+
+    def test_private_polls_keep_confirmations(self):
+        self.bot.respond(private_message("VotingBot lunch: pizza, tacos",
+                                         "o@hi.com"))
+        self.bot.respond(private_message("lunch\n1", "a@hi.com"))
+        self.bot.scoreboard.flush()
+
+        self.assertEqual([msg["to"] for msg in self.client.sent],
+                         ["o@hi.com", "a@hi.com", "o@hi.com"])
+        self.assertIn("tacos has 1 votes", self.client.sent[-1]["content"])
+
+
+class VotingBotLimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.voting_topics = MemoryVotingTopics()
+        self.client = FakeZulipClient()
+        self.registry = Metrics()
+        self.bot = VotingBot("voting-bot@hi.com", "key", "VotingBot",
+                             ["voting"], client=self.client,
+                             voting_topics=self.voting_topics,
+                             registry=self.registry)
+
+    def test_long_messages_are_refused(self):
+        content = "VotingBot lunch: " + "pizza, " * MAX_MESSAGE_LENGTH
+        self.bot.respond(stream_message(content, "a@hi.com"))
+        self.bot.respond(private_message("x" * (MAX_MESSAGE_LENGTH + 1),
+                                         "b@hi.com"))
+
+        self.assertEqual([(sent["type"], sent["to"]) for sent in
+                          self.client.sent],
+                         [("private", "a@hi.com"), ("private", "b@hi.com")])
+        self.assertIn("too long", self.client.sent[0]["content"])
+        self.assertEqual(self.voting_topics.keys(), [])
+        self.assertEqual(self.registry.snapshot()["counters"],
+                         {"bot.actions.too_long": 2})
+
+    def test_option_limit(self):
+        options = ", ".join("option %d" % i for i in range(MAX_OPTIONS + 1))
+        self.bot.respond(stream_message("VotingBot lunch: " + options,
+                                        "a@hi.com"))
+        self.assertIn("at most %d options" % MAX_OPTIONS,
+                      self.client.sent[-1]["content"])
+        self.assertNotIn("lunch", self.voting_topics)
+
+        options = options.rsplit(",", 1)[0]
+        self.bot.respond(stream_message("VotingBot lunch: " + options,
+                                        "a@hi.com"))
+        self.bot.respond(stream_message("VotingBot lunch add one more",
+                                        "a@hi.com"))
+        self.assertIn("at most", self.client.sent[-1]["content"])
+        self.assertEqual(len(self.voting_topics["lunch"]["options"]),
+                         MAX_OPTIONS)
+
+    def test_adversarial_messages(self):
+        for name, content in adversarial_messages(MAX_MESSAGE_LENGTH - 20,
+                                                  fuzz=20):
+            start = time.time()
+            self.bot.respond(stream_message("VotingBot" + content,
+                                            "a@hi.com"))
+            self.bot.respond(private_message(content, "a@hi.com"))
+            self.assertLess(time.time() - start, 0.1, name)
+
+
+class VotingBotResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeEventServer()
+        self.voting_topics = MemoryVotingTopics()
+        self.voting_topics["lunch"] = new_poll()
+
+    def new_bot(self):
+        return VotingBot("voting-bot@hi.com", "key", "VotingBot", ["voting"],
+                         client=FakeZulipClient(server=self.server),
+                         voting_topics=self.voting_topics)
+
+    def vote(self, voter, option):
+        self.server.post(private_message("lunch\n%d" % option, voter))
+
+    def test_resumes_queue_after_restart(self):
+        bot = self.new_bot()
+        thread = start(bot, resume=True)
+        wait_for_queues(self.server, 1)
+        self.vote("a@hi.com", 0)
+        self.vote("b@hi.com", 1)
+        wait_for(bot, 2)
+        bot.stop()
+        thread.join()
+
+        # sent while no bot was running
+        self.vote("c@hi.com", 1)
+        self.vote("a@hi.com", 1)
+
+        restarted = self.new_bot()
+        run_until(restarted, 2, resume=True)
+
+        self.assertEqual(len(self.server.narrows), 1)
+        self.assertEqual(self.voting_topics["lunch"]["people_who_have_voted"],
+                         {"a@hi.com": 1, "b@hi.com": 1, "c@hi.com": 1})
+        self.assertEqual(len(restarted.client.sent), 2)
+
+    def test_registers_again_when_queue_expired(self):
+        bot = self.new_bot()
+        thread = start(bot, resume=True)
+        wait_for_queues(self.server, 1)
+        self.vote("a@hi.com", 0)
+        wait_for(bot, 1)
+        bot.stop()
+        thread.join()
+
+        for queue_id in list(self.server.queues):
+            self.server.expire(queue_id)
+
+        restarted = self.new_bot()
+        thread = start(restarted, resume=True)
+        wait_for_queues(self.server, 1)
+        self.vote("b@hi.com", 1)
+        wait_for(restarted, 1)
+        restarted.stop()
+        thread.join()
+
+        self.assertEqual(len(self.server.narrows), 2)
+        self.assertEqual(self.voting_topics["lunch"]["people_who_have_voted"],
+                         {"a@hi.com": 0, "b@hi.com": 1})
+
+
+class VotingBotStartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeEventServer(streams=["voting", "lunch"])
+        self.voting_topics = MemoryVotingTopics()
+
+    def new_bot(self, streams=[]):
+        self.client = FakeZulipClient(server=self.server)
+        return VotingBot("voting-bot@hi.com", "key", "VotingBot", streams,
+                         client=self.client, voting_topics=self.voting_topics)
+
+    def subscribed(self):
+        return sorted(stream["name"] for stream in self.client.subscriptions)
+
+    def test_heavy_modules_load_lazily(self):
+        code = ("import sys, voting_bot; print(' '.join(sorted(set("
+                "sys.modules) & {'zulip', 'requests', 'parsley', 'dataset', "
+                "'sqlalchemy'})))")
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=os.path.dirname(__file__) or ".")
+
+        self.assertEqual(output.strip(), "")
+
+    def test_restart_only_subscribes_new_streams(self):
+        self.new_bot()
+        self.assertEqual(self.subscribed(), ["lunch", "voting"])
+
+        bot = self.new_bot()
+        self.assertEqual(self.subscribed(), [])
+        self.assertEqual(bot.subscriptions, {"lunch", "voting"})
+
+        self.new_bot(["voting", "karaoke"])
+        self.assertEqual(self.subscribed(), ["karaoke"])
+
+    def test_subscribes_to_created_streams(self):
+        bot = self.new_bot()
+        thread = start(bot, resume=True)
+        wait_for_queues(self.server, 2)
+        self.server.create_stream("karaoke")
+        wait_for_subscription(bot, "karaoke")
+        bot.stop()
+        thread.join()
+
+        # created while no bot was running
+        self.server.create_stream("movies")
+
+        restarted = self.new_bot()
+        thread = start(restarted, resume=True)
+        wait_for_subscription(restarted, "movies")
+        restarted.stop()
+        thread.join()
+
+        self.assertEqual(self.subscribed(), ["movies"])
+        self.assertEqual(len(self.server.narrows), 2)
+        self.assertEqual(self.voting_topics.get_subscriptions(),
+                         {"voting", "lunch", "karaoke", "movies"})
+
+    def test_expired_stream_queue_catches_up(self):
+        bot = self.new_bot()
+        thread = start(bot, resume=True)
+        wait_for_queues(self.server, 2)
+        bot.stop()
+        thread.join()
+
+        for queue_id in list(self.server.queues):
+            self.server.expire(queue_id)
+        self.server.create_stream("movies")
+
+        restarted = self.new_bot()
+        thread = start(restarted, resume=True)
+        wait_for_subscription(restarted, "movies")
+        restarted.stop()
+        thread.join()
+
+        self.assertEqual(self.subscribed(), ["movies"])
+
+
+def new_poll():
+    return {"title": "lunch", "options": {0: ["pizza", 0], 1: ["sushi", 0]},
+            "people_who_have_voted": {}, "owner_email": "a@hi.com"}
+
+
+def start(bot, **options):
+    thread = threading.Thread(target=bot.main, kwargs=options)
+    thread.start()
+
+    return thread
+
+
+def wait_for(bot, sent, timeout=5):
+    deadline = time.time() + timeout
+    while len(bot.client.sent) < sent and time.time() < deadline:
+        time.sleep(0.005)
+
+
+def wait_for_subscription(bot, stream, timeout=5):
+    deadline = time.time() + timeout
+    while stream not in bot.subscriptions and time.time() < deadline:
+        time.sleep(0.005)
+
+
+def wait_for_queues(server, queues, timeout=5):
+    deadline = time.time() + timeout
+    while len(server.queues) < queues and time.time() < deadline:
+        time.sleep(0.005)
+
+
+def run_until(bot, sent, **options):
+    '''Run bot.main(**options) until the bot has sent sent messages.'''
+    thread = start(bot, **options)
+    wait_for(bot, sent)
+    bot.stop()
+    thread.join()
+
 
 # @unittest.skip("need a debug_run.py module to run this test")
 # class VotingBotIntegrationTest(unittest.TestCase):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import threading
+import unittest
+import nose
+from fakes import FakeZulipClient
+from metrics import Metrics
+from workers import MessagePipeline
+
+
+class MessagePipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def tearDown(self):
+        del self.metrics
+
+    def test_messages_with_same_key_stay_ordered(self):
+        events = [{"poll": "poll %d" % (i % 7), "seq": i} for i in range(5000)]
+        handled = {}
+        lock = threading.Lock()
+
+        def handler(msg):
+            with lock:
+                handled.setdefault(msg["poll"], []).append(msg["seq"])
+
+        pipeline = MessagePipeline(handler, lambda msg: msg["poll"],
+                                   concurrency=4, queue_size=64,
+                                   registry=self.metrics).start()
+        FakeZulipClient(events).call_on_each_message(pipeline.submit)
+        pipeline.join()
+        pipeline.stop()
+
+        self.assertEqual(sum(len(seqs) for seqs in handled.values()), 5000)
+        for seqs in handled.values():
+            self.assertEqual(seqs, sorted(seqs))
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["counters"]["pipeline.submitted"], 5000)
+        self.assertEqual(snapshot["timers"]["pipeline.handler"]["count"], 5000)
+        self.assertEqual(snapshot["gauges"]["pipeline.queue_depth"], 0)
+
+    def test_slow_poll_does_not_block_others(self):
+        release = threading.Event()
+        handled = []
+
+        def handler(msg):
+            if msg == "slow":
+                release.wait(5)
+            else:
+                handled.append(msg)
+                release.set()
+
+        keys = {"slow": 0, "fast": 1}
+        pipeline = MessagePipeline(handler, keys.get, concurrency=2,
+                                   registry=self.metrics).start()
+        pipeline.submit("slow")
+        pipeline.submit("fast")
+        pipeline.join()
+        pipeline.stop()
+
+        self.assertTrue(release.is_set())
+        self.assertEqual(handled, ["fast"])
+
+    def test_handler_errors_are_counted(self):
+        def handler(msg):
+            raise ValueError(msg)
+
+        pipeline = MessagePipeline(handler, concurrency=2,
+                                   registry=self.metrics).start()
+        pipeline.submit("boom")
+        pipeline.join()
+        pipeline.stop()
+
+        self.assertEqual(self.metrics.snapshot()["counters"]["pipeline.errors"],
+                         1)
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
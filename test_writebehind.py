@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import nose
+from database import MemoryVotingTopics
+from fakes import CountingStorage
+from metrics import Metrics
+from writebehind import VoteLog, WriteBehindStorage
+
+
+def new_voting(title, options):
+    return {"title": title,
+            "options": {i: [option, 0] for i, option in enumerate(options)},
+            "people_who_have_voted": {},
+            "owner_email": "owner@hi.com"}
+
+
+class FailingStorage(MemoryVotingTopics):
+
+    fail = False
+
+    def cast_votes(self, voting_title, ballots):
+        if self.fail:
+            raise IOError("database went away")
+        return super(FailingStorage, self).cast_votes(voting_title, ballots)
+
+
+class BlockingStorage(MemoryVotingTopics):
+
+    """add_option waits until release is set."""
+
+    def __init__(self):
+        super(BlockingStorage, self).__init__()
+        self.adding = threading.Event()
+        self.release = threading.Event()
+
+    def add_option(self, voting_title, description):
+        self.adding.set()
+        self.release.wait()
+        return super(BlockingStorage, self).add_option(voting_title,
+                                                       description)
+
+
+class WriteBehindStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmp_dir, "votes.log")
+        self.storage = CountingStorage(MemoryVotingTopics())
+        self.storage["lunch"] = new_voting("Lunch", ["Pizza", "Tacos"])
+        self.storage["dinner"] = new_voting("Dinner", ["Curry"])
+        self.storage.calls.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def buffered(self, storage=None, **kwargs):
+        kwargs.setdefault("registry", Metrics())
+        return WriteBehindStorage(storage or self.storage, **kwargs)
+
+    def test_votes_are_group_committed(self):
+        buffered = self.buffered()
+        self.assertIsNone(buffered.cast_vote("lunch", "a@hi.com", 0))
+        self.assertIsNone(buffered.cast_vote("lunch", "b@hi.com", 1))
+        self.assertEqual(buffered.cast_vote("lunch", "a@hi.com", 1), 0)
+        buffered.cast_vote("dinner", "a@hi.com", 0)
+
+        self.assertEqual(buffered.header("lunch")["options"],
+                         {0: ["Pizza", 0], 1: ["Tacos", 2]})
+        self.assertEqual(self.storage.header("lunch")["options"][1],
+                         ["Tacos", 0])
+
+        buffered.flush()
+        self.assertEqual(self.storage.calls["cast_votes"], 2)
+        self.assertNotIn("cast_vote", self.storage.calls)
+        vote = self.storage["lunch"]
+        self.assertEqual(vote["options"], {0: ["Pizza", 0], 1: ["Tacos", 2]})
+        self.assertEqual(vote["people_who_have_voted"],
+                         {"a@hi.com": 1, "b@hi.com": 1})
+
+        # polls that weren't voted on since the last flush are let go
+        buffered.flush()
+        self.assertEqual(buffered.polls, {})
+
+    def test_flush_after_enough_votes(self):
+        buffered = self.buffered(flush_votes=3, flush_interval=60).start()
+        for i in range(3):
+            buffered.cast_vote("lunch", "voter%d@hi.com" % i, 0)
+
+        deadline = time.time() + 5
+        while "cast_votes" not in self.storage.calls and \
+                time.time() < deadline:
+            time.sleep(0.001)
+        buffered.close()
+
+        self.assertEqual(self.storage["lunch"]["options"][0], ["Pizza", 3])
+
+    def test_other_writes_flush_first(self):
+        buffered = self.buffered()
+        buffered.cast_vote("lunch", "a@hi.com", 1)
+
+        self.assertEqual(buffered.add_option("lunch", "Sushi"), 2)
+        self.assertEqual(buffered.cast_vote("lunch", "a@hi.com", 2), 1)
+        self.assertEqual(buffered["lunch"]["options"][2], ["Sushi", 1])
+
+        del buffered["lunch"]
+        self.assertNotIn("lunch", buffered)
+        self.assertRaises(KeyError, buffered.cast_vote, "lunch", "a@hi.com", 0)
+
+    def test_writes_only_hold_up_their_poll(self):
+        storage = BlockingStorage()
+        storage["lunch"] = new_voting("Lunch", ["Pizza", "Tacos"])
+        storage["dinner"] = new_voting("Dinner", ["Curry"])
+        buffered = self.buffered(storage)
+        buffered.cast_vote("lunch", "a@hi.com", 1)
+
+        adding = threading.Thread(target=buffered.add_option,
+                                  args=("lunch", "Sushi"))
+        adding.start()
+        storage.adding.wait()
+        voting = threading.Thread(target=buffered.cast_vote,
+                                  args=("lunch", "b@hi.com", 2))
+        voting.start()
+
+        # the storage is busy with lunch, dinner is voted on meanwhile
+        self.assertIsNone(buffered.cast_vote("dinner", "a@hi.com", 0))
+        voting.join(0.05)
+        self.assertTrue(voting.is_alive())
+
+        storage.release.set()
+        adding.join()
+        voting.join()
+        self.assertEqual(buffered["lunch"]["options"],
+                         {0: ["Pizza", 0], 1: ["Tacos", 1], 2: ["Sushi", 1]})
+
+    def test_vote_log_replayed_after_crash(self):
+        # no flushing thread, as if the process died before it ran
+        buffered = self.buffered(vote_log=VoteLog(self.log_path))
+        buffered.vote_log.open()
+        buffered.cast_vote("lunch", "a@hi.com", 0)
+        buffered.cast_vote("lunch", "b@hi.com", 1)
+        buffered.cast_vote("lunch", "a@hi.com", 1)
+
+        restarted = self.buffered(vote_log=VoteLog(self.log_path)).start()
+        restarted.close()
+
+        vote = self.storage["lunch"]
+        self.assertEqual(vote["options"], {0: ["Pizza", 0], 1: ["Tacos", 2]})
+        self.assertEqual(vote["people_who_have_voted"],
+                         {"a@hi.com": 1, "b@hi.com": 1})
+        self.assertEqual(list(VoteLog(self.log_path).ballots()), [])
+
+    def test_failed_flush_keeps_votes(self):
+        storage = FailingStorage()
+        storage["lunch"] = new_voting("Lunch", ["Pizza", "Tacos"])
+        vote_log = VoteLog(self.log_path)
+        buffered = self.buffered(storage, vote_log=vote_log)
+        vote_log.open()
+
+        buffered.cast_vote("lunch", "a@hi.com", 0)
+        storage.fail = True
+        self.assertRaises(IOError, buffered.flush)
+        buffered.cast_vote("lunch", "b@hi.com", 1)
+        self.assertRaises(IOError, buffered.flush)
+
+        self.assertEqual(len(list(vote_log.ballots())), 2)
+        storage.fail = False
+        buffered.flush()
+
+        self.assertEqual(storage["lunch"]["people_who_have_voted"],
+                         {"a@hi.com": 0, "b@hi.com": 1})
+        self.assertEqual(list(vote_log.ballots()), [])
+
+
+if __name__ == '__main__':
+    nose.run(defaultTest=__name__)
@@ -2,13 +2,112 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
-import zulip
-import requests
+import logging
 import re
-import pprint
 import os
-from database import VotingTopics
-import parsley
+import threading
+import time
+from database import get_voting_topics, InstrumentedStorage, DB_CACHE_TTL
+from tally import new_tally, tally_from_voting, PLURALITY, APPROVAL, RANKED
+from codec import ballot_choices
+from commands import parse_command, parse_ballot, parse_topic, \
+    to_one_liner, ERROR
+from templates import Templates, format_duration, render_options, \
+    RANGE_OPTION_LINE
+from cache import LRUCache
+from workers import MessagePipeline
+from events import EventListener, SEEN_MESSAGES
+from outbound import OutboundDispatcher, ZULIP_SEND_RATE
+from scheduler import PollScheduler
+from scoreboard import Scoreboard
+from writebehind import VoteLog, WriteBehindStorage, WRITE_BEHIND, VOTE_LOG
+from metrics import MetricsServer, StatsReporter
+from profiler import SamplingProfiler, PROFILE_INTERVAL
+import metrics
+
+# PEG for one liner
+ONE_LINER_GRAMMAR = """
+    not_colon = anything:x ?(':' not in x)
+    title = <not_colon+>:t ':' -> t.strip()
+
+    results = 'results' -> ("results", None)
+    option = 'add' ':'? ws <anything+>:arg  -> ("option", arg.capitalize())
+    choice = ws <digit+>:arg ws -> int(arg)
+    ballot = choice:c ((',' | '>') choice)+:cs -> ("vote", [c] + cs)
+    vote = <digit+>:arg -> ("vote", int(arg))
+    topic = <anything+>:arg -> ("topic", [i.strip() for i in arg.split(",")])
+    vote_act = results | option | ballot | vote | topic
+
+    help = ':'? ws 'help' -> ("help", None, None)
+    voting_msg = title:t ws vote_act:va -> (va[0], t, va[1])
+
+    expr = voting_msg | help
+    """
+
+PARSE_CACHE_SIZE = int(os.environ.get("PARSE_CACHE_SIZE", 4096))
+
+# longer messages are answered with an error without being parsed
+MAX_MESSAGE_LENGTH = int(os.environ.get("MAX_MESSAGE_LENGTH", 4000))
+MAX_OPTIONS = int(os.environ.get("MAX_OPTIONS", 50))
+TALLY_CACHE_SIZE = int(os.environ.get("TALLY_CACHE_SIZE", 1024))
+
+# seconds a new poll stays open when it doesn't say, 0 for no deadline
+POLL_TTL = float(os.environ.get("POLL_TTL", 0))
+
+# one results message per poll, edited as votes come in, instead of a
+# confirmation per vote and a repost per new option
+LIVE_SCOREBOARD = os.environ.get("LIVE_SCOREBOARD", "") not in ("", "0")
+
+# "<title> for 90m", "<title> for 2h" or "<title> for 1d"
+DURATION = re.compile(r"^(.*\S)\s+for\s+(\d+)\s*([mhd])$", re.UNICODE)
+DURATION_UNITS = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+# "<title> [approval]" or "<title> [ranked]", anywhere in the title
+MODE = re.compile(r"\[(%s|%s)\]" % (APPROVAL, RANKED),
+                  re.UNICODE | re.IGNORECASE)
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", 0))
+
+log = logging.getLogger(__name__)
+
+# compiled one liner grammar, built once per process on first use
+_one_liner_grammar = None
+
+
+def get_one_liner_grammar():
+    global _one_liner_grammar
+
+    if _one_liner_grammar is None:
+        # only the reference parser needs parsley, keep it off the startup
+        import parsley
+        _one_liner_grammar = parsley.makeGrammar(ONE_LINER_GRAMMAR, {})
+
+    return _one_liner_grammar
+
+
+def split_duration(title):
+    '''(title, seconds) for a title ending in "for <n>m|h|d", or the title
+        and None.
+    '''
+    match = DURATION.match(title.strip())
+    if not match:
+        return title, None
+
+    return match.group(1), int(match.group(2)) * DURATION_UNITS[match.group(3)]
+
+
+def split_mode(title):
+    '''(title, mode) for a title tagged "[approval]" or "[ranked]", or the
+        title and None.
+    '''
+    match = MODE.search(title)
+    if not match:
+        return title, None
+
+    return (title[:match.start()].rstrip() + title[match.end():],
+            match.group(1).lower())
 
 
 class VotingBot():
@@ -19,70 +118,199 @@ class VotingBot():
         caption and a randomly selected gif in response to zulip messages.
     """
 
+    # normalized user content -> (action, title, arg)
+    parse_cache = LRUCache(PARSE_CACHE_SIZE)
+
     def __init__(self, zulip_username, zulip_api_key, key_word,
-                 subscribed_streams=[]):
+                 subscribed_streams=[], client=None, voting_topics=None,
+                 outbound=None, templates=None, registry=metrics.registry,
+                 live_scoreboard=LIVE_SCOREBOARD):
         self.username = zulip_username
         self.api_key = zulip_api_key
         self.key_word = key_word.lower().strip()
         self.subscribed_streams = subscribed_streams
-        self.client = zulip.Client(zulip_username, zulip_api_key)
+        self.client = client or zulip_client(zulip_username, zulip_api_key)
+        self.outbound = outbound
+        self.templates = templates or Templates()
+        self.metrics = registry
+        # every storage call is timed as db.<method>
+        self.voting_topics = InstrumentedStorage(
+            voting_topics or get_voting_topics(), registry)
+        # names of the streams the bot is subscribed to
         self.subscriptions = self.subscribe_to_streams()
-        self.voting_topics = VotingTopics()
-
-    @property
-    def streams(self):
-        ''' Standardizes a list of streams in the form [{'name': stream}]
-        '''
-        if not self.subscribed_streams:
-            streams = [{'name': stream['name']}
-                       for stream in self.get_all_zulip_streams()]
-            return streams
-        else:
-            streams = [{'name': stream} for stream in self.subscribed_streams]
-            return streams
+        # poll title -> Tally, rebuilt from storage when missing or expired
+        self.tallies = LRUCache(TALLY_CACHE_SIZE, DB_CACHE_TTL)
+        # message ids already handled, shared by the event queue listeners
+        self.seen_messages = LRUCache(SEEN_MESSAGES)
+        self.listeners = []
+        self.scheduler = PollScheduler(self.expire_polls, registry=registry)
+        self.scoreboard = Scoreboard(self.client, self.render_scoreboard,
+                                     registry=registry) \
+            if live_scoreboard else None
 
     def get_all_zulip_streams(self):
         ''' Call Zulip API to get a list of all streams
         '''
-        response = requests.get('https://api.zulip.com/v1/streams',
-                                auth=(self.username, self.api_key))
+        response = self.client.get_streams()
 
-        if response.status_code == 200:
-            return response.json()['streams']
+        if response.get('result') == 'success':
+            return response['streams']
 
-        elif response.status_code == 401:
+        elif response.get('code') == 'UNAUTHORIZED':
             raise RuntimeError('check yo auth')
 
         else:
-            raise RuntimeError(':( we failed to GET streams.\n(%s)' % response)
+            raise RuntimeError(':( we failed to GET streams.\n(%s)' %
+                               response.get('msg'))
 
     def subscribe_to_streams(self):
-        ''' Subscribes to zulip streams
+        ''' Subscribes to the subscribed_streams, or to every zulip stream
+            when there are none, and returns the names of the streams the bot
+            is subscribed to. Those are saved in the storage, so a restarted
+            bot only subscribes to streams it hasn't yet, and a bot following
+            every stream only lists them on its first run; after that new
+            streams come in as stream events (see main()).
         '''
-        self.client.add_subscriptions(self.streams)
+        subscriptions = self.voting_topics.get_subscriptions()
+
+        if self.subscribed_streams:
+            streams = self.subscribed_streams
+        elif subscriptions:
+            return subscriptions
+        else:
+            streams = [stream['name']
+                       for stream in self.get_all_zulip_streams()]
+
+        return self._subscribe(streams, subscriptions)
+
+    def _subscribe(self, streams, subscriptions):
+        new_streams = sorted(set(streams) - subscriptions)
+        if not new_streams:
+            return subscriptions
+
+        self.client.add_subscriptions([{'name': stream}
+                                       for stream in new_streams])
+        log.info("subscribed to %d new streams", len(new_streams))
+        subscriptions = subscriptions | set(new_streams)
+        self.voting_topics.set_subscriptions(subscriptions)
+
+        return subscriptions
+
+    def on_stream_event(self, event):
+        '''Subscribe to streams as they are created.'''
+        streams = [stream['name'] for stream in event.get('streams', [])]
+
+        if event.get('op') == 'create':
+            self.subscriptions = self._subscribe(streams, self.subscriptions)
+
+        elif event.get('op') == 'delete':
+            # a stream created again under the same name is a new one
+            self.subscriptions = self.subscriptions - set(streams)
+            self.voting_topics.set_subscriptions(self.subscriptions)
+
+    def _streams_registered(self, result):
+        # streams created while no queue was listening for them
+        if 'streams' in result:
+            streams = [stream['name'] for stream in result['streams']]
+        else:
+            streams = [stream['name']
+                       for stream in self.get_all_zulip_streams()]
+
+        self.subscriptions = self._subscribe(streams, self.subscriptions)
 
     def respond(self, msg):
         ''' checks msg against key_word. If key_word is in msg, gets a gif url,
             picks a caption, and calls send_message()
         '''
 
+        # check if it's a relevant message fo the bot
+        if not self.accepts(msg):
+            return
+
+        with self.metrics.timer("bot.respond"):
+            content = self._decode_content(msg)
+
+            if len(content) > MAX_MESSAGE_LENGTH:
+                self.metrics.incr("bot.actions.too_long")
+                self.send_too_long(msg)
+
+            elif self._starts_with_key_word(content):
+                self.parse_public_message(msg, content)
+
+            else:
+                self.parse_private_message(msg, content)
+
+    def accepts(self, msg):
+        '''Cheap check on the raw event: private messages and messages
+            starting with the key word, not sent by the bot and not empty.
+            Only looks at the first few characters of the content.
+        '''
+        content = msg.get("content")
+
+        if not content or msg.get("sender_email") == self.username:
+            return False
+
+        return msg.get("type") == "private" or \
+            self._starts_with_key_word(content)
+
+    def _starts_with_key_word(self, content):
+        n = len(self.key_word)
+        head = content.lstrip()[:n + 1]
+        if not isinstance(head, unicode):
+            head = head.decode("utf-8", "replace")
+
+        return head[:n].lower() == self.key_word and \
+            (len(head) == n or head[n].isspace())
+
+    def message_narrows(self):
+        '''Event queue narrows covering every message the bot answers.
+            Zulip narrows are conjunctive, so private messages and key word
+            mentions each get their own queue.
+        '''
+        return [[["is", "private"]], [["search", self.key_word]]]
+
+    @staticmethod
+    def _decode_content(msg):
         # decode if necessary
         if type(msg["content"]) == unicode:
-            content = msg["content"]
+            return msg["content"]
         else:
-            content = msg["content"].decode("utf-8", "replace")
+            return msg["content"].decode("utf-8", "replace")
+
+    def message_key(self, msg):
+        '''Poll title a message is about, used to keep each poll's messages
+            in order when they are handled concurrently.
+        '''
+        content = self._decode_content(msg)
 
-        first_word = content.split()[0].lower().strip()
+        if len(content) > MAX_MESSAGE_LENGTH:
+            return None
 
-        # check if it's a relevant message fo the bot
-        if self.key_word == first_word and msg["sender_email"] != self.username:
-            self.parse_public_message(msg, content)
+        elif self._starts_with_key_word(content):
+            try:
+                title = self._parse_public_message(content)[1]
+            except Exception:
+                # let the handler deal with (and report) unparseable messages
+                return None
+
+            return self._poll_key(title) if title else None
+
+        elif msg["type"] == "private":
+            return self._poll_key(content.split("\n")[0])
 
-        elif msg["type"] == "private" and msg["sender_email"] != self.username:
-            self.parse_private_message(msg, content)
+        return None
 
-    def send_message(self, msg):
-        ''' Sends a message to zulip stream
+    @staticmethod
+    def _poll_key(title):
+        # "lunch [ranked] for 2h" creates the poll its votes call "lunch"
+        title = split_duration(split_mode(title)[0])[0]
+
+        return title.lower().strip()
+
+    def send_message(self, msg, coalesce_key=None):
+        ''' Sends a message to zulip stream, through the outbound dispatcher
+            when there is one. Messages sharing a coalesce_key may be merged
+            into the last one by the dispatcher.
         '''
         if msg["type"] == "stream":
             msg["to"] = msg['display_recipient']
@@ -90,7 +318,11 @@ class VotingBot():
         elif msg["type"] == "private":
             msg["to"] = msg["sender_email"]
 
-        self.client.send_message(msg)
+        with self.metrics.timer("bot.send"):
+            if self.outbound:
+                self.outbound.send(msg, coalesce_key)
+            else:
+                self.client.send_message(msg)
 
     def parse_public_message(self, msg, content):
         '''Parse public message given to the bot.
@@ -104,7 +336,10 @@ class VotingBot():
             -post_error
         '''
 
-        action, title, arg = self._parse_public_message(content)
+        with self.metrics.timer("bot.parse"):
+            action, title, arg = self._parse_public_message(content)
+
+        self.metrics.incr("bot.actions.%s" % (action or "error"))
 
         if action == "results":
             self.send_results(msg, title)
@@ -117,7 +352,7 @@ class VotingBot():
             self.add_voting_option(msg, title.lower(), arg)
 
         elif action == "vote":
-            self.add_vote(msg, title.lower(), int(arg))
+            self.add_vote(msg, title.lower(), arg)
 
         elif action == "topic":
             self.new_voting_topic(msg, title, arg)
@@ -129,78 +364,44 @@ class VotingBot():
     def _parse_public_message(cls, content):
 
         # remove key word
+        content = content.lstrip()
         len_key_word = len(content.split()[0])
         user_content = content[len_key_word:]
-        user_cont_lines = user_content.split("\n")
-
-        # convert multiple lines conttent into one liner
-        if len(user_cont_lines) == 2:
-            user_content = user_content.replace("\n", ": ")
-
-        elif len(user_cont_lines) > 2:
-            options = ",".join(user_cont_lines[1:])
-            user_content = user_cont_lines[0] + ": " + options
-
-        # fix colon ":" omission in the message
-        elif len(user_cont_lines) == 1 and ":" not in user_content:
-            if "add" in user_content.lower():
-                i = user_content.lower().index("add")
-                user_content = user_content[:i - 1] + ":" + \
-                    user_content[i - 1:]
-
-            elif "results" in user_content.lower():
-                i = user_content.lower().index("results")
-                user_content = user_content[:i - 1] + ":" + \
-                    user_content[i - 1:]
-
-            elif user_content.split()[-1].isdigit():
-                words = user_content.split()
-                words[-2] += ":"
-                user_content = " ".join(words)
-
-            elif "help" in user_content.lower():
-                pass
-
-            elif "," in user_content:
-                index = user_content.index(",")
-                i = user_content.rfind(" ", 0, index)
-                user_content = user_content[:i] + ":" + \
-                    user_content[i:]
-
-            elif len(user_content.split()) > 1:
-                i = user_content.rfind(" ")
-                user_content = user_content[:i] + ":" + \
-                    user_content[i:]
 
-            else:
-                raise Exception("one liner with no colon and no fix!" + user_content)
+        # the grammar only ever sees lowered content
+        cache_key = user_content.lower()
+        RV = cls.parse_cache.get(cache_key)
+        if RV is None:
+            RV = cls._parse_uncached(user_content)
+            cls.parse_cache.set(cache_key, RV)
 
-        # PEG for one liner
-        grammar = parsley.makeGrammar("""
-            not_colon = anything:x ?(':' not in x)
-            title = <not_colon+>:t ':' -> t.strip()
+        # topic options are a list, don't hand out the cached one
+        if isinstance(RV[2], list):
+            RV = (RV[0], RV[1], list(RV[2]))
 
-            results = 'results' -> ("results", None)
-            option = 'add' ':'? ws <anything+>:arg  -> ("option", arg.capitalize())
-            vote = <digit+>:arg -> ("vote", int(arg))
-            topic = <anything+>:arg -> ("topic", [i.strip() for i in arg.split(",")])
-            vote_act = results | option | vote | topic
+        return RV
 
-            help = ':'? ws 'help' -> ("help", None, None)
-            voting_msg = title:t ws vote_act:va -> (va[0], t, va[1])
+    @classmethod
+    def _parse_uncached(cls, user_content):
+        return parse_command(user_content) or parse_topic(user_content)
 
-            expr = voting_msg | help
-            """, {})
+    @classmethod
+    def _parse_user_content(cls, user_content):
+        '''The one liner grammar's reading of a message, the reference that
+            parse_command and parse_topic are tested against. Parsley
+            backtracks over the whole message, so this isn't used on messages.
+        '''
+
+        user_content = to_one_liner(user_content)
+        if user_content is None:
+            return ERROR
+
+        grammar = get_one_liner_grammar()
 
         try:
-            # if "help" in user_content:
-            #     print "help", user_content
-            # print user_content
             RV = grammar(user_content.lower()).expr()
-            # print RV
         except:
-            # print user_content
-            RV = (None, None, None)
+            RV = ERROR
 
         return RV
 
@@ -218,31 +419,38 @@ class VotingBot():
         title = msg_content.split("\n")[0]
 
         if content.lower().strip() == "help":
+            self.metrics.incr("bot.actions.private_help")
             self.send_help(msg)
 
-        elif title.strip() in self.voting_topics.keys():
+        elif title.strip() in self.voting_topics:
             split_msg = msg_content.split("\n")
 
             if len(split_msg) == 2:
-                regex = re.compile("[0-9]+")
-                option_number = split_msg[1].split(" ")[0]
+                ballot = parse_ballot(split_msg[1])
+                if ballot is None:
+                    ballot = parse_ballot(split_msg[1].split(" ")[0])
 
-                if regex.match(option_number):
-                    option_number = int(option_number)
-                    self.add_vote(title.lower(), option_number, msg)
+                if ballot is not None:
+                    self.metrics.incr("bot.actions.private_vote")
+                    self.add_vote(msg, title.strip(), ballot)
 
                 elif split_msg[1].split(" ")[0].strip() == "results":
+                    self.metrics.incr("bot.actions.private_results")
                     self.send_partial_results(
                         title.lower(), msg["sender_email"])
 
                 else:
-                    print "regex did not match"
+                    log.debug("no option number in private vote on %s", title)
+                    self.metrics.incr("bot.actions.private_error")
                     self.send_voting_help(msg)
             else:
+                self.metrics.incr("bot.actions.private_error")
                 self.post_error(msg)
         else:
-            print "title not in keys" + title
-            pprint.pprint(self.voting_topics)
+            self.metrics.incr("bot.actions.unknown_topic")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("title not in keys %s (%s)", title,
+                          self.voting_topics.summary())
             self.send_voting_help(msg)
 
     def send_no_voting_topic(self, msg, title):
@@ -253,10 +461,18 @@ class VotingBot():
 
     def send_partial_results(self, title, owner_email):
 
-        if title in self.voting_topics and \
-                owner_email == self.voting_topics[title]["owner_email"]:
+        try:
+            voting = self.voting_topics.header(title)
+        except KeyError:
+            return
 
-            results = self._get_topic_results(title)
+        if owner_email == voting["owner_email"]:
+
+            tally = self._stored_tally(title)
+            results = tally.render_results()
+            option, name, votes = tally.leader()
+            results += "\nCurrent leader: {0} with {1} votes.".format(name,
+                                                                      votes)
             msg = {"type": "private",
                    "content": results,
                    "sender_email": owner_email}
@@ -264,26 +480,49 @@ class VotingBot():
             self.send_message(msg)
 
     def new_voting_topic(self, msg, title, options):
-        '''Create a new voting topic.'''
+        '''Create a new voting topic, closing at its deadline if it has one
+            or POLL_TTL is set. A title tagged "[approval]" or "[ranked]"
+            makes an approval or a ranked choice poll.
+        '''
 
-        print "Voting topic", title, "already?:", title.lower() in self.voting_topics
+        title, mode = split_mode(title)
+        title, duration = split_duration(title)
+        duration = duration or POLL_TTL
 
         if title.lower() in self.voting_topics:
             self.send_repeated_voting(msg)
 
-        elif title:
-            msg["content"] = title
-            options_dict = {}
-
-            for x in range(len(options)):
-                options_dict[x] = [options[x], 0]
-                msg["content"] += "\n " + unicode(x) + ". " + options[x]
+        elif len(options) > MAX_OPTIONS:
+            self.send_too_many_options(msg)
 
-            self.voting_topics[title.lower()] = {"title": title,
-                                                 "options": options_dict,
-                                                 "people_who_have_voted": {},
-                                                 "owner_email": msg["sender_email"]}
+        elif title:
+            options_dict = {x: [option, 0] for x, option in enumerate(options)}
+            msg["content"] = self.templates.render(
+                "new_topic", title=title, options=render_options(options))
+
+            voting = {"title": title,
+                      "options": options_dict,
+                      "people_who_have_voted": {},
+                      "owner_email": msg["sender_email"]}
+            if mode:
+                voting["mode"] = mode
+                msg["content"] += self.templates.render(mode + "_poll")
+            if duration:
+                voting["deadline"] = time.time() + duration
+                msg["content"] += self.templates.render(
+                    "deadline", duration=format_duration(duration))
+            if msg["type"] == "stream":
+                # where the results go when the deadline comes
+                voting["stream"] = msg["display_recipient"]
+                voting["subject"] = msg["subject"]
+
+            self.voting_topics[title.lower()] = voting
+            self.tallies.set(title.lower(), new_tally(mode, title, options))
+            if duration:
+                self.scheduler.schedule(title.lower(), voting["deadline"])
             self.send_message(msg)
+            if self.scoreboard:
+                self.scoreboard.update(title.lower(), delay=0)
 
         else:
             self.send_help(msg)
@@ -291,109 +530,162 @@ class VotingBot():
     def add_voting_option(self, msg, title, new_voting_option):
         '''Add a new voting option to an existing voting topic.'''
 
-        if title.lower().strip() in self.voting_topics:
-            vote = self.voting_topics[title.lower().strip()]
-            options = vote["options"]
+        title = title.lower().strip()
 
-            if self._not_already_there(options, new_voting_option):
-                options_num = options.keys()
-                new_option_num = len(options_num)
+        if title in self.voting_topics and len(
+                self.voting_topics.header(title)["options"]) >= MAX_OPTIONS:
+            self.send_too_many_options(msg)
 
-                options[new_option_num] = [new_voting_option, 0]
+        elif title in self.voting_topics:
+            new_option_num = self.voting_topics.add_option(title,
+                                                           new_voting_option)
 
-                msg["content"] = "There is a new option in topic: " + title
-                for x in range(len(options)):
-                    msg["content"] += "\n " + unicode(x) + ". " + options[x][0]
+            if new_option_num is not None:
+                tally = self.tallies.get(title)
+                if tally and len(tally) == new_option_num:
+                    tally.add_option(new_voting_option)
+                else:
+                    self.tallies.delete(title)
 
-                self.send_message(msg)
+                voting = self.voting_topics.header(title)
+                if self._live(voting):
+                    # the poll's live message shows the new option
+                    self.scoreboard.update(title)
+                    return
+
+                options = voting["options"]
+                names = [options[x][0] for x in range(len(options))]
+
+                msg["content"] = self.templates.render(
+                    "new_option", title=title, options=render_options(names))
+
+                self.send_message(msg, coalesce_key=self._options_key(msg,
+                                                                      title))
 
             else:
-                msg["content"] = new_voting_option + \
-                    " is already an option in topic: " + title + \
-                    "\nDo not attempt to repeat options!"
+                msg["content"] = self.templates.render(
+                    "repeated_option", option=new_voting_option, title=title)
                 self.send_message(msg)
 
-        self.voting_topics[title.lower().strip()] = vote
+    @staticmethod
+    def _options_key(msg, title):
+        # option list reposts for one topic in one thread replace each other
+        return ("options", title, msg["type"], msg.get("display_recipient"),
+                msg.get("subject"))
 
-    def _not_already_there(self, vote_options, new_voting_option):
-        options = [opt[0] for opt in vote_options.values()]
-        return new_voting_option not in options
+    def add_vote(self, msg, title, ballot):
+        '''Add a vote to an existing voting topic. The ballot is an option
+            number, or a list of them on approval and ranked polls.
+        '''
 
-    def add_vote(self, msg, title, option_number):
-        '''Add a vote to an existing voting topic.'''
+        try:
+            vote = self.voting_topics.header(title)
+        except KeyError:
+            self.metrics.incr("bot.actions.unknown_topic")
+            msg["type"] = "private"
+            self.send_voting_help(msg)
+            return
 
-        vote = self.voting_topics[title]
-        print vote
+        mode = vote.get("mode", PLURALITY)
+        choices = ballot_choices(ballot)
 
-        if option_number in vote["options"].keys():
+        if mode == PLURALITY and len(choices) > 1:
+            msg["content"] = self.templates.render(
+                "single_choice", options=self._range_options(vote))
 
-            if msg["sender_email"] not in vote["people_who_have_voted"]:
-                vote["options"][option_number][1] += 1
-                vote["people_who_have_voted"][
-                    (msg["sender_email"])] = option_number
-                msg["content"] = self._get_add_vote_msg(msg, vote,
-                                                        option_number, False,
-                                                        title)
+        elif all(option in vote["options"] for option in choices):
+            ballot = self._normalize_ballot(mode, choices)
+            old_ballot = self.voting_topics.cast_vote(
+                title.strip(), msg["sender_email"], ballot)
+
+            tally = self.tallies.get(title.strip())
+            if tally:
+                tally.vote(ballot, old_ballot)
+
+            if self.scoreboard:
+                self.scoreboard.update(title.strip())
+            if self._live(vote):
+                # the poll's live message is the confirmation
+                return
+
+            msg["content"] = self._get_add_vote_msg(msg, vote, ballot,
+                                                    old_ballot is not None,
+                                                    title)
 
-            else:
-                old_vote_option = vote[
-                    "people_who_have_voted"][msg["sender_email"]]
-                vote["options"][old_vote_option][1] += -1
-                vote["options"][option_number][1] += 1
-                vote["people_who_have_voted"][
-                    (msg["sender_email"])] = option_number
-                msg["content"] = self._get_add_vote_msg(msg, vote,
-                                                        option_number,
-                                                        True, title)
         else:
-            # print "option in range", type(option_number),
-            # vote["options"].keys()
-            msg["content"] = " ".join(["That option is not in the range of the",
-                                       "voting options. Here are your options:",
-                                       " \n"])
-            options_list = []
-            for i in xrange(len(vote["options"])):
-                new_option = unicode(i) + ". " + vote["options"][i][0]
-                options_list.append(new_option)
-
-            msg["content"] += "\n".join(options_list)
+            msg["content"] = self.templates.render(
+                "out_of_range", options=self._range_options(vote))
 
         msg["type"] = "private"
         self.send_message(msg)
 
-        print vote
-        self.voting_topics[title.strip()] = vote
+    def _live(self, voting):
+        '''Whether the poll has a live message where it was created.'''
+        return self.scoreboard is not None and bool(voting.get("stream"))
 
-    def _get_add_vote_msg(self, msg, vote, option_number, changed_vote, title):
+    @staticmethod
+    def _normalize_ballot(mode, choices):
+        '''The ballot to store: an option number on plurality polls, the
+            approved options in order or the ranking without repeats.
+        '''
+        if mode == PLURALITY:
+            return choices[0]
+
+        if mode == APPROVAL:
+            return sorted(set(choices))
+
+        seen = set()
+        return [option for option in choices
+                if not (option in seen or seen.add(option))]
+
+    def _range_options(self, vote):
+        names = [vote["options"][i][0] for i in xrange(len(vote["options"]))]
+
+        return render_options(names, line=RANGE_OPTION_LINE, sep="\n")
+
+    def _get_add_vote_msg(self, msg, vote, ballot, changed_vote, title):
         '''Creates a different msg if the vote was private or public.'''
 
-        option_desc = vote["options"][option_number][0]
+        sep = " > " if vote.get("mode") == RANKED else ", "
+        option_desc = sep.join(vote["options"][option][0]
+                               for option in ballot_choices(ballot))
 
         if changed_vote:
-            msg_content = "You have changed your vote. \n"
+            msg_content = self.templates.render("changed_vote")
         else:
             msg_content = ""
         if msg["type"] == "private":
-            msg_content += "One vote in this topic: " + vote["title"] + \
-                " for this option: " + option_desc
+            msg_content += self.templates.render(
+                "private_vote", title=vote["title"], option=option_desc)
         else:
-            msg_content += "".join(["You just voted for '",
-                                    option_desc, "' in ", title])
+            msg_content += self.templates.render(
+                "public_vote", option=option_desc, title=title)
 
         return msg_content
 
     def send_help(self, msg):
-        with open("messages/complete_help.md") as f:
-            msg["content"] = f.read()
+        msg["content"] = self.templates["complete_help"]
         self.send_message(msg)
 
     def send_repeated_voting(self, msg):
-        msg["content"] = "This topic already exists! Choose another name."
+        msg["content"] = self.templates.render("repeated_topic")
+        self.send_message(msg)
+
+    def send_too_long(self, msg):
+        msg["type"] = "private"
+        msg["content"] = self.templates.render("too_long",
+                                               limit=MAX_MESSAGE_LENGTH)
+        self.send_message(msg)
+
+    def send_too_many_options(self, msg):
+        self.metrics.incr("bot.actions.too_many_options")
+        msg["type"] = "private"
+        msg["content"] = self.templates.render("too_many_options",
+                                               limit=MAX_OPTIONS)
         self.send_message(msg)
 
     def send_voting_help(self, msg):
-        with open("messages/voting_help.md") as f:
-            msg["content"] = f.read()
+        msg["content"] = self.templates["voting_help"]
         self.send_message(msg)
 
     def post_error(self, msg):
@@ -405,35 +697,203 @@ class VotingBot():
         if title.lower() in self.voting_topics:
             msg["content"] = self._get_topic_results(title)
             del self.voting_topics[title.lower()]
+            self.tallies.delete(title.lower())
+            self.scheduler.cancel(title.lower())
+            if self.scoreboard:
+                self.scoreboard.forget(title.lower())
             self.send_message(msg)
 
-    def _get_topic_results(self, title):
+    def expire_polls(self, titles, now):
+        '''Publish the results of polls whose deadline has passed, where
+            they were created (or to their owner), then delete them at once.
+            Other expired polls are left to the bot instance that scheduled
+            them, which hasn't published their results yet.
+        '''
+        for title in titles:
+            try:
+                voting = self.voting_topics.header(title)
+            except KeyError:
+                # closed with "results" in the meantime
+                continue
+
+            msg = self._poll_msg(voting)
+            msg["content"] = self._get_topic_results(title)
+            self.send_message(msg)
+
+        for title in self.voting_topics.delete_expired(now, titles):
+            self.tallies.delete(title)
+            if self.scoreboard:
+                self.scoreboard.forget(title)
+            self.metrics.incr("polls.expired")
+
+    @staticmethod
+    def _poll_msg(voting):
+        '''Message to where the poll was created, or to its owner.'''
+        if voting.get("stream"):
+            return {"type": "stream", "display_recipient": voting["stream"],
+                    "to": voting["stream"], "subject": voting["subject"]}
+
+        return {"type": "private", "sender_email": voting["owner_email"],
+                "to": voting["owner_email"]}
+
+    def render_scoreboard(self, title):
+        '''The live results message of a poll. It's counted from the
+            storage: the scoreboard runs on its own thread, and the cached
+            tallies are only built and updated by the poll's handler.
+            Plurality counts are in the poll's header; only approval and
+            ranked results need its ballots loaded.
+        '''
+        voting = self.voting_topics.header(title)
+        if voting.get("mode") in (APPROVAL, RANKED):
+            voting = self.voting_topics[title]
+        msg = self._poll_msg(voting)
+        msg["content"] = tally_from_voting(voting).render_results(
+            self.templates.render("live_results"))
+
+        return msg
 
-        vote = self.voting_topics[title.lower().strip()]
-        results = "The results are in!!!! \nTopic: " + vote["title"]
+    def _get_tally(self, title):
+        title = title.lower().strip()
+        tally = self.tallies.get(title)
 
-        for option in vote["options"].values():
-            results += "\n{0} has {1} votes.".format(
-                option[0], unicode(option[1]))
+        if tally is None:
+            tally = tally_from_voting(self.voting_topics[title])
+            self.tallies.set(title, tally)
+
+        return tally
+
+    def _get_topic_results(self, title):
+        '''Final results text, options with most votes first. Counted from
+            the storage rather than the cached tally, which only sees this
+            bot's votes.
+        '''
+        title = title.lower().strip()
+        self.tallies.delete(title)
 
-        return results
+        return self._stored_tally(title).render_results()
+
+    def _stored_tally(self, title):
+        '''Tally of the poll as the storage has it, with the votes cast
+            through every bot instance.
+        '''
+        return tally_from_voting(self.voting_topics.reload(title))
 
     def delete_voting_topic(self, voting_title):
-        print "deleting", voting_title
+        del self.voting_topics[unicode(voting_title)]
+        if self.scoreboard:
+            self.scoreboard.forget(unicode(voting_title))
+
+        log.info("voting topic %s deleted", voting_title)
+
+    def main(self, concurrency=0, queue_size=1000, narrow=False,
+             resume=False):
+        ''' Blocking call that runs until stop() is called. Calls
+            self.respond() on every message received, on a pool of
+            concurrency worker threads when concurrency is set.
+
+            With narrow, the server only sends private messages and messages
+            mentioning the key word, on one event queue per narrow. With
+            resume, event queues are checkpointed in the storage after every
+            handled batch and picked up again on restart. Event queues are
+            listened to concurrently, so their messages always go through the
+            pipeline (with a single worker if concurrency isn't set) to keep
+            each poll's messages in order.
+
+            A bot following every stream also listens for stream events and
+            subscribes to new streams as they are created; its queue is
+            checkpointed too with resume, so streams created while the bot
+            was down come in on restart.
+        '''
+        self._start_scheduler()
+        if self.scoreboard:
+            self.scoreboard.start()
+        self._follow_streams(resume)
 
-        dict_params = {self.voting_topics.KEY_FIELD: unicode(voting_title)}
+        try:
+            if not (concurrency or narrow or resume):
+                self.client.call_on_each_message(self.respond)
+                return
 
-        with self.voting_topics.db as db:
-            db[self.voting_topics.TABLE].delete(**dict_params)
+            pipeline = MessagePipeline(self.respond, self.message_key,
+                                       concurrency or 1, queue_size).start()
 
-        print voting_title, "deleted from voting_bot.py!"
+            def submit(msg):
+                if self.accepts(msg):
+                    pipeline.submit(msg)
 
-    def main(self):
-        ''' Blocking call that runs forever. Calls self.respond() on every
-            message received.
+            try:
+                if narrow or resume:
+                    narrows = self.message_narrows() if narrow else [[]]
+                    self._listen(submit, narrows, resume, pipeline.join)
+                else:
+                    self.client.call_on_each_message(submit)
+            finally:
+                pipeline.join()
+                pipeline.stop()
+
+        finally:
+            self.stop()
+            if self.scoreboard:
+                self.scoreboard.flush()
+            if self.outbound:
+                self.outbound.flush()
+
+    def _start_scheduler(self):
+        # deadlines that passed while the bot was down are due right away
+        self.scheduler.rebuild(self.voting_topics.deadlines())
+        self.scheduler.start()
+
+    def _follow_streams(self, resume):
+        if self.subscribed_streams:
+            return
+
+        checkpoints = self.voting_topics if resume else None
+        listener = EventListener(self.client, checkpoints, "streams",
+                                 event_types=["stream"],
+                                 on_register=self._streams_registered)
+        self.listeners.append(listener)
+
+        thread = threading.Thread(target=listener.run,
+                                  args=(self.on_stream_event,))
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self, callback, narrows, resume, after_batch):
+        checkpoints = self.voting_topics if resume else None
+        listeners = [EventListener(self.client, checkpoints,
+                                   self._queue_name(narrow), narrow,
+                                   self.seen_messages)
+                     for narrow in narrows]
+        self.listeners.extend(listeners)
+
+        threads = [threading.Thread(target=listener.run,
+                                    args=(callback, after_batch))
+                   for listener in listeners]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def _queue_name(narrow):
+        return " ".join(":".join(term) for term in narrow) or "messages"
+
+    def stop(self):
+        '''Stop listening to event queues, main() returns once the
+            messages already received are handled.
         '''
-        self.client.call_on_each_message(lambda msg: self.respond(msg))
-        # print msg
+        for listener in self.listeners:
+            listener.stop()
+        self.scheduler.stop()
+        if self.scoreboard:
+            self.scoreboard.stop()
+
+
+def zulip_client(zulip_username, zulip_api_key, **kwargs):
+    # zulip pulls in requests, only load them for a real client
+    import zulip
+    return zulip.Client(zulip_username, zulip_api_key, **kwargs)
 
 
 def main():
@@ -442,10 +902,43 @@ def main():
     key_word = 'VotingBot'
 
     subscribed_streams = []
+    concurrency = int(os.environ.get("BOT_CONCURRENCY", 0))
+    queue_size = int(os.environ.get("BOT_QUEUE_SIZE", 1000))
+
+    send_rate = float(os.environ.get("ZULIP_SEND_RATE", ZULIP_SEND_RATE))
+    coalesce_window = float(os.environ.get("COALESCE_WINDOW", 0.5))
+    narrow = os.environ.get("BOT_NARROW", "1") != "0"
+    resume = os.environ.get("BOT_RESUME", "1") != "0"
+
+    logging.basicConfig(level=LOG_LEVEL,
+                        format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    profiler = None
+    if PROFILE_INTERVAL:
+        profiler = SamplingProfiler(PROFILE_INTERVAL).start()
+    if METRICS_PORT:
+        MetricsServer(METRICS_PORT, profiler=profiler).start()
+    if STATS_INTERVAL:
+        StatsReporter(STATS_INTERVAL).start()
+
+    client = zulip_client(zulip_username, zulip_api_key)
+    outbound = OutboundDispatcher(client, send_rate,
+                                  coalesce_window=coalesce_window).start()
+
+    voting_topics = get_voting_topics()
+    if WRITE_BEHIND:
+        vote_log = VoteLog(VOTE_LOG) if VOTE_LOG else None
+        voting_topics = WriteBehindStorage(voting_topics,
+                                           vote_log=vote_log).start()
 
     new_bot = VotingBot(zulip_username, zulip_api_key, key_word,
-                        subscribed_streams)
-    new_bot.main()
+                        subscribed_streams, client=client,
+                        voting_topics=voting_topics, outbound=outbound)
+    try:
+        new_bot.main(concurrency, queue_size, narrow, resume)
+    finally:
+        if WRITE_BEHIND:
+            voting_topics.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,100 @@
+import Queue
+import itertools
+import threading
+import time
+import logging
+import metrics
+
+"""
+Concurrent message processing for VotingBot.
+
+MessagePipeline sits between the Zulip event receiver and the bot handlers.
+Messages are sharded by key (the poll title) over a fixed set of worker
+threads, each with its own bounded queue: messages for the same poll are
+handled in arrival order by one worker while different polls run in parallel.
+When a shard's queue is full, submit() blocks the receiver, which pushes back
+on the event queue instead of buffering without limit.
+"""
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class MessagePipeline(object):
+
+    """Bounded, key ordered worker pool in front of a message handler."""
+
+    def __init__(self, handler, key_func=None, concurrency=4,
+                 queue_size=1000, registry=metrics.registry):
+        self.handler = handler
+        self.key_func = key_func or (lambda msg: None)
+        self.concurrency = concurrency
+        self.metrics = registry
+        shard_size = max(1, queue_size // concurrency)
+        self.queues = [Queue.Queue(shard_size) for _ in range(concurrency)]
+        self.threads = []
+        self._round_robin = itertools.cycle(range(concurrency))
+
+        self.metrics.gauge("pipeline.queue_depth", self.queue_depth)
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def start(self):
+        for queue in self.queues:
+            thread = threading.Thread(target=self._work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        return self
+
+    def _shard(self, key):
+        if key is None:
+            return next(self._round_robin)
+
+        return hash(key) % self.concurrency
+
+    def submit(self, msg):
+        '''Queue msg for its key's worker, blocking while that queue is full.
+        '''
+        queue = self.queues[self._shard(self.key_func(msg))]
+        queue.put((time.time(), msg))
+        self.metrics.incr("pipeline.submitted")
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+
+            try:
+                if item is _STOP:
+                    return
+
+                queued_at, msg = item
+                start = time.time()
+                self.metrics.observe("pipeline.queue_wait", start - queued_at)
+
+                try:
+                    self.handler(msg)
+                except Exception:
+                    self.metrics.incr("pipeline.errors")
+                    log.exception("handler failed")
+
+                self.metrics.observe("pipeline.handler", time.time() - start)
+
+            finally:
+                queue.task_done()
+
+    def join(self):
+        '''Block until every submitted message has been handled.'''
+        for queue in self.queues:
+            queue.join()
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
@@ -0,0 +1,352 @@
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+from codec import ballot_choices, first_choice
+from database import VotingStorage
+import metrics
+
+"""
+Write-behind buffer for vote floods.
+
+WriteBehindStorage wraps a storage. A vote is applied to an in-memory copy of
+its poll, which is loaded once and is authoritative from then on, and is
+confirmed right away. The ballots are written to the storage later, one
+cast_votes group commit per poll, once flush_votes votes are pending or every
+flush_interval seconds. Anything other than a vote flushes first and goes
+straight to the storage. Poll copies are dropped once a flush finds they got
+no votes since the last one.
+
+Ballots that are confirmed but not yet flushed only live in this process, so
+the buffer suits a single bot writing to the storage. With a vote log every
+vote is also appended to that file before it's confirmed. Each flush starts
+a new log and deletes the old one after its commit. replay() rewrites any
+votes left in the logs by a crash into the storage. Replaying is safe to
+repeat: casting a ballot that's already in place changes nothing.
+"""
+
+log = logging.getLogger(__name__)
+
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "") not in ("", "0")
+WRITE_BEHIND_VOTES = int(os.environ.get("WRITE_BEHIND_VOTES", 200))
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", 0.2))
+VOTE_LOG = os.environ.get("VOTE_LOG", "")
+VOTE_LOG_FSYNC = os.environ.get("VOTE_LOG_FSYNC", "") not in ("", "0")
+
+
+class VoteLog(object):
+
+    """Append-only file of (title, voter, option_number) ballots, one JSON
+        list per line. rotate() moves the current file aside for a flush.
+    """
+
+    def __init__(self, path, fsync=VOTE_LOG_FSYNC):
+        self.path = path
+        self.flushing_path = path + ".flushing"
+        self.fsync = fsync
+        self.file = None
+
+    def open(self):
+        self.file = io.open(self.path, "ab")
+
+    def append(self, voting_title, voter, option_number):
+        self.file.write(json.dumps([voting_title, voter, option_number]) +
+                        b"\n")
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def rotate(self):
+        '''Start a new log, the old one is kept until done() is called.'''
+        self.file.close()
+
+        if os.path.exists(self.flushing_path):
+            # the last flush failed, its ballots are pending again
+            with io.open(self.flushing_path, "ab") as flushing, \
+                    io.open(self.path, "rb") as current:
+                shutil.copyfileobj(current, flushing)
+            os.remove(self.path)
+        else:
+            os.rename(self.path, self.flushing_path)
+
+        self.open()
+
+    def done(self):
+        os.remove(self.flushing_path)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def ballots(self):
+        '''Ballots left over from a previous run, oldest first.'''
+        for path in [self.flushing_path, self.path]:
+            if not os.path.exists(path):
+                continue
+
+            with io.open(path, "rb") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # a line cut short by the crash
+                        log.warning("skipping torn vote log line %r", line)
+
+    def clear(self):
+        for path in [self.flushing_path, self.path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class WriteBehindStorage(VotingStorage):
+
+    """Applies votes in memory and writes them to storage in group commits."""
+
+    def __init__(self, storage, flush_votes=WRITE_BEHIND_VOTES,
+                 flush_interval=WRITE_BEHIND_INTERVAL, vote_log=None,
+                 registry=metrics.registry):
+        self.storage = storage
+        self.flush_votes = flush_votes
+        self.flush_interval = flush_interval
+        self.vote_log = vote_log
+        self.metrics = registry
+        # title -> authoritative voting, for polls voted on recently
+        self.polls = {}
+        # title -> [(voter, option_number)] not written to storage yet
+        self.pending = {}
+        self.pending_votes = 0
+        self.stopped = threading.Event()
+        self._wake = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        # titles being written through, None for every poll
+        self._writing = set()
+        self._written = threading.Condition(self._lock)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def start(self):
+        '''Replay the vote log and start the periodic flushes.'''
+        if self.vote_log:
+            self.replay()
+            self.vote_log.open()
+
+        self.thread.start()
+        return self
+
+    def replay(self):
+        ballots = {}
+        for voting_title, voter, option_number in self.vote_log.ballots():
+            ballots.setdefault(voting_title, []).append((voter,
+                                                         option_number))
+
+        for voting_title, poll_ballots in ballots.iteritems():
+            try:
+                self.storage.cast_votes(voting_title, poll_ballots)
+            except KeyError:
+                # the poll was closed before the crash
+                continue
+            self.metrics.incr("writebehind.replayed", len(poll_ballots))
+
+        self.vote_log.clear()
+
+    def close(self):
+        '''Stop the periodic flushes and write out every pending vote.'''
+        self.stopped.set()
+        self._wake.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+        self.flush()
+        if self.vote_log:
+            self.vote_log.close()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # every flush_interval, or as soon as flush_votes are pending
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("vote flush failed")
+
+    def flush(self):
+        '''Write the pending votes, a group commit per poll.'''
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            self.pending_votes = 0
+            if pending and self.vote_log:
+                self.vote_log.rotate()
+
+        flushed = set()
+        try:
+            for voting_title, ballots in pending.iteritems():
+                with self.metrics.timer("writebehind.commit"):
+                    try:
+                        self.storage.cast_votes(voting_title, ballots)
+                    except KeyError:
+                        # deleted by someone else, the votes go with it
+                        log.warning("dropped %d votes on missing poll %s",
+                                    len(ballots), voting_title)
+                flushed.add(voting_title)
+                self.metrics.incr("writebehind.flushed", len(ballots))
+
+        except Exception:
+            self._requeue(pending, flushed)
+            raise
+
+        if pending and self.vote_log:
+            self.vote_log.done()
+
+        with self._lock:
+            # keep the copies of polls that are still being voted on
+            for voting_title in list(self.polls):
+                if voting_title not in pending and \
+                        voting_title not in self.pending:
+                    del self.polls[voting_title]
+
+    def _requeue(self, pending, flushed):
+        with self._lock:
+            for voting_title, ballots in pending.iteritems():
+                if voting_title not in flushed:
+                    self.pending[voting_title] = \
+                        ballots + self.pending.get(voting_title, [])
+                    self.pending_votes += len(ballots)
+
+    def _poll(self, voting_title):
+        poll = self.polls.get(voting_title)
+        if poll is None:
+            poll = self.polls[voting_title] = self.storage[voting_title]
+
+        return poll
+
+    def cast_vote(self, voting_title, voter, option_number):
+        with self._lock:
+            while voting_title in self._writing or None in self._writing:
+                self._written.wait()
+
+            vote = self._poll(voting_title)
+            for option in ballot_choices(option_number):
+                if option not in vote["options"]:
+                    raise KeyError(option)
+
+            if self.vote_log:
+                self.vote_log.append(voting_title, voter, option_number)
+
+            old_option = vote["people_who_have_voted"].get(voter)
+            if old_option is not None:
+                vote["options"][first_choice(old_option)][1] -= 1
+            vote["options"][first_choice(option_number)][1] += 1
+            vote["people_who_have_voted"][voter] = option_number
+
+            self.pending.setdefault(voting_title, []).append(
+                (voter, option_number))
+            self.pending_votes += 1
+            if self.pending_votes >= self.flush_votes:
+                self._wake.set()
+
+        return old_option
+
+    def header(self, voting_title):
+        with self._lock:
+            if voting_title in self.polls:
+                return self._copy_header(self.polls[voting_title])
+
+        return self.storage.header(voting_title)
+
+    def __getitem__(self, voting_title):
+        with self._lock:
+            if voting_title in self.polls:
+                return self._copy_voting(self.polls[voting_title])
+
+        return self.storage[voting_title]
+
+    def __contains__(self, voting_title):
+        return voting_title in self.polls or voting_title in self.storage
+
+    def _write_through(self, voting_title, method, *args):
+        '''Flush, then call method on the storage with the poll's copy
+            dropped, or every copy without a voting_title. Votes on the poll
+            (on every poll without a voting_title) wait until it's done;
+            votes on other polls go on while the storage is written.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                self._writing.add(voting_title)
+                if voting_title is None:
+                    self.polls.clear()
+                else:
+                    self.polls.pop(voting_title, None)
+
+            try:
+                self._flush()
+                return getattr(self.storage, method)(*args)
+
+            finally:
+                with self._lock:
+                    self._writing.discard(voting_title)
+                    self._written.notify_all()
+
+    def __setitem__(self, voting_title, voting_dict):
+        return self._write_through(voting_title, "__setitem__", voting_title,
+                                   voting_dict)
+
+    def __delitem__(self, voting_title):
+        return self._write_through(voting_title, "__delitem__", voting_title)
+
+    def reload(self, voting_title):
+        return self._write_through(voting_title, "reload", voting_title)
+
+    def add_option(self, voting_title, description):
+        return self._write_through(voting_title, "add_option", voting_title,
+                                   description)
+
+    def cast_votes(self, voting_title, ballots):
+        return self._write_through(voting_title, "cast_votes", voting_title,
+                                   ballots)
+
+    def clear(self):
+        return self._write_through(None, "clear")
+
+    def delete_expired(self, now, titles=None):
+        return self._write_through(None, "delete_expired", now, titles)
+
+    def deadlines(self):
+        return self.storage.deadlines()
+
+    def summary(self, limit=10):
+        return self.storage.summary(limit)
+
+    def iterkeys(self):
+        return self.storage.iterkeys()
+
+    def itervalues(self):
+        self.flush()
+        return self.storage.itervalues()
+
+    def iteritems(self):
+        self.flush()
+        return self.storage.iteritems()
+
+    def get_checkpoint(self, name):
+        return self.storage.get_checkpoint(name)
+
+    def set_checkpoint(self, name, queue_id, last_event_id):
+        return self.storage.set_checkpoint(name, queue_id, last_event_id)
+
+    def get_subscriptions(self):
+        return self.storage.get_subscriptions()
+
+    def set_subscriptions(self, streams):
+        return self.storage.set_subscriptions(streams)